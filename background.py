@@ -0,0 +1,27 @@
+import asyncio
+from typing import Coroutine, Optional, Set
+
+
+class BackgroundTasks:
+    """Задачи, которые запускаются в фоне без ожидания результата.
+
+    Event loop хранит на задачи только слабые ссылки, и задачу без сильной ссылки сборщик мусора может удалить
+    посреди работы. Набор держит ссылку, пока задача не завершится.
+    """
+
+    def __init__(self):
+        self._tasks: Set[asyncio.Task] = set()
+
+    def spawn(self, coro: Coroutine, name: Optional[str] = None) -> asyncio.Task:
+        task = asyncio.create_task(coro, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def wait(self):
+        """Дожидается всех задач, включая запущенные уже во время ожидания."""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
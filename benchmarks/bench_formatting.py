@@ -0,0 +1,59 @@
+"""Микробенчмарк рендера Markdown -> Telegram HTML на больших ответах.
+
+Запуск из корня репозитория: python benchmarks/bench_formatting.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from formatting import render_html  # noqa: E402
+
+
+def legacy_clean_text(text):
+    """Прежняя реализация clean_text из main.py - для сравнения."""
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = text.strip()
+    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
+    text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
+    text = re.sub(r'\_(.*?)\_', r'<i>\1</i>', text)
+    text = re.sub(r'```(.*?)```', r'<pre><code>\1</code></pre>', text, flags=re.DOTALL)
+    text = re.sub(r'`(.*?)`', r'<pre><code>\1</code></pre>', text, flags=re.DOTALL)
+    text = re.sub(r'~~(.*?)~~', r'<strike>\1</strike>', text)
+    text = re.sub(r'\s*([.,?!])', r'\1', text)
+    return text
+
+
+PROSE = ("## Разбор задачи\n"
+         "Это **важный** момент: *курсив*, `inline_code()` и ~~зачеркнутое~~. "
+         "Сравнение a < b && c > d, snake_case_name и 2 * 3 = 6.\n"
+         "* первый пункт с [ссылкой](https://example.com/?a=1&b=2)\n"
+         "* второй пункт\n\n")
+CODE = ("```python\n"
+        "def f(items):\n"
+        "    return [x * 2 for x in items if x > 0]  # <tag> & more\n"
+        "```\n\n")
+# Незакрытые маркеры - худший случай для нежадных шаблонов прежней реализации
+UNCLOSED = "`" + "текст без закрывающей кавычки * и _ " * 50 + "\n\n"
+
+SAMPLES = {
+    "prose_64k": PROSE * (64 * 1024 // len(PROSE)),
+    "code_heavy_64k": (PROSE + CODE * 4) * (64 * 1024 // len(PROSE + CODE * 4)),
+    "unclosed_16k": UNCLOSED * (16 * 1024 // len(UNCLOSED)),
+    "prose_1m": PROSE * (1024 * 1024 // len(PROSE)),
+}
+
+
+def bench(name, func, text, number):
+    seconds = min(timeit.repeat(lambda: func(text), number=number, repeat=3)) / number
+    print(f"{name:<16} {func.__name__:<18} {len(text):>9} chars  {seconds * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    for name, text in SAMPLES.items():
+        number = 1 if len(text) > 100_000 else 5
+        bench(name, legacy_clean_text, text, number)
+        bench(name, render_html, text, number)
@@ -0,0 +1,32 @@
+"""Бенчмарк разбиения длинных ответов на сообщения Telegram на многомегабайтных входах.
+
+Запуск из корня репозитория: python benchmarks/bench_split.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from formatting import render_html, split_html, split_text  # noqa: E402
+
+PARAGRAPH = ("Это **важный** момент: *курсив*, `inline_code()` и ~~зачеркнутое~~ 😀. "
+             "Сравнение a < b && c > d.\n"
+             "```python\n" + "for item in items:\n    print(item)  # <tag> & more\n" * 20 + "```\n\n")
+# Одно длинное «предложение» без пробелов и переносов - худший случай для поиска места разреза
+NO_BREAKS = "x" * (1024 * 1024)
+
+
+def bench(name, func, text):
+    seconds = min(timeit.repeat(lambda: func(text), number=1, repeat=3))
+    chunks = func(text)
+    print(f"{name:<22} {len(text):>9} chars  {len(chunks):>5} chunks  {seconds * 1000:9.2f} ms")
+
+
+if __name__ == "__main__":
+    for megabytes in (1, 4):
+        markdown = PARAGRAPH * (megabytes * 1024 * 1024 // len(PARAGRAPH))
+        bench(f"split_html {megabytes}MB", split_html, render_html(markdown))
+        bench(f"split_text {megabytes}MB", split_text, markdown)
+    bench("split_text no breaks", split_text, NO_BREAKS)
+    bench("split_html no breaks", split_html, f"<b>{NO_BREAKS}</b>")
@@ -0,0 +1,124 @@
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from background import BackgroundTasks
+
+
+load_dotenv()
+
+# Бюджет истории в символах (~4 символа на токен) и сколько записей максимум читать из базы
+CONTEXT_CHAR_BUDGET = int(os.getenv("CONTEXT_CHAR_BUDGET", "24000"))
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "100"))
+# Сворачивание вытесненных из окна записей в краткую сводку
+CONTEXT_SUMMARY = os.getenv("CONTEXT_SUMMARY", "0") == "1"
+CONTEXT_SUMMARY_BATCH = int(os.getenv("CONTEXT_SUMMARY_BATCH", "6"))
+CONTEXT_SUMMARY_MAX_CHARS = int(os.getenv("CONTEXT_SUMMARY_MAX_CHARS", "2000"))
+
+TURN_OVERHEAD = len("User: \nBot: \n")
+
+SUMMARY_PROMPT = """Сократи переписку пользователя с ассистентом до краткой сводки (не более {max_chars} символов).
+Сохрани факты о пользователе, его цели, договоренности и незакрытые вопросы. Пиши в третьем лице, без вступлений.
+
+Предыдущая сводка:
+{summary}
+
+Новые сообщения:
+{turns}"""
+
+logger = logging.getLogger("bot.context")
+
+
+@dataclass
+class PromptStats:
+    history_chars: int = 0
+    summary_chars: int = 0
+    turns_fetched: int = 0
+    turns_used: int = 0
+    turns_dropped: int = 0
+
+    @property
+    def approx_tokens(self) -> int:
+        return (self.history_chars + self.summary_chars) // 4
+
+
+@dataclass
+class Context:
+    turns: List[Dict] = field(default_factory=list)
+    summary: Optional[str] = None
+    stats: PromptStats = field(default_factory=PromptStats)
+
+
+def turn_cost(record: Dict) -> int:
+    return len(record["query"] or "") + len(record["response"] or "") + TURN_OVERHEAD
+
+
+class ContextWindow:
+    """Ограничивает историю, попадающую в промпт, бюджетом символов."""
+
+    def __init__(self, db, summarize: Callable[[str], Awaitable[str]] = None,
+                 char_budget: int = CONTEXT_CHAR_BUDGET, max_turns: int = CONTEXT_MAX_TURNS):
+        self.db = db
+        self.summarize = summarize if CONTEXT_SUMMARY else None
+        self.char_budget = char_budget
+        self.max_turns = max_turns
+        self._summarizing = set()
+        self.tasks = BackgroundTasks()
+
+    def select(self, history: List[Dict], budget: int):
+        """Берет самые свежие записи, пока они помещаются в бюджет. Возвращает (окно, вытесненные)."""
+        used = 0
+        start = len(history)
+        while start > 0:
+            cost = turn_cost(history[start - 1])
+            if used + cost > budget:
+                break
+            used += cost
+            start -= 1
+        return history[start:], history[:start], used
+
+    async def build(self, user_id, reserved_chars: int = 0) -> Context:
+        history = await self.db.get_history(user_id, limit=self.max_turns)
+        summary = await self.db.get_summary(user_id) if self.summarize else None
+
+        budget = max(self.char_budget - reserved_chars, 0)
+        summary_text = summary["summary"] if summary else None
+        if summary_text:
+            budget = max(budget - len(summary_text), 0)
+
+        turns, dropped, used = self.select(history, budget)
+        context = Context(
+            turns=turns,
+            summary=summary_text,
+            stats=PromptStats(
+                history_chars=used,
+                summary_chars=len(summary_text) if summary_text else 0,
+                turns_fetched=len(history),
+                turns_used=len(turns),
+                turns_dropped=len(dropped),
+            ),
+        )
+
+        if self.summarize and dropped:
+            covered_until = summary["covered_until"] if summary else None
+            pending = [record for record in dropped if covered_until is None or record["timestamp"] > covered_until]
+            if len(pending) >= CONTEXT_SUMMARY_BATCH and user_id not in self._summarizing:
+                # Сводка обновляется в фоне и будет использована со следующего запроса
+                self._summarizing.add(user_id)
+                self.tasks.spawn(self._update_summary(user_id, summary_text, pending))
+        return context
+
+    async def _update_summary(self, user_id, summary_text: Optional[str], pending: List[Dict]):
+        try:
+            turns = "\n".join(f"User: {record['query']}\nBot: {record['response']}" for record in pending)
+            prompt = SUMMARY_PROMPT.format(max_chars=CONTEXT_SUMMARY_MAX_CHARS, summary=summary_text or "нет", turns=turns)
+            new_summary = (await self.summarize(prompt)).strip()[:CONTEXT_SUMMARY_MAX_CHARS]
+            await self.db.set_summary(user_id, new_summary, pending[-1]["timestamp"])
+            logger.info(f"Context summary updated for user {user_id}: {len(pending)} turns folded")
+        except Exception as e:
+            logger.error(f"Error updating context summary for user {user_id}: {e}")
+        finally:
+            self._summarizing.discard(user_id)
@@ -0,0 +1,188 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from google.genai import errors
+
+from background import BackgroundTasks
+from gemini_api import PromptCache
+
+load_dotenv()
+
+# Кэш контекста Gemini: системная инструкция и неизменное начало истории обрабатываются моделью один раз
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "0") == "1"
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+# Кэш меньше этого размера не создается: API его не примет, а выигрыш был бы небольшим
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096"))
+# Сколько новых записей может накопиться после кэша, прежде чем он будет пересоздан
+CONTEXT_CACHE_REBUILD_TURNS = int(os.getenv("CONTEXT_CACHE_REBUILD_TURNS", "8"))
+CONTEXT_CACHE_MAX_ENTRIES = 1000
+EXPIRY_MARGIN = 60
+# После отказа API модель не кэшируется какое-то время (например, модель кэш не поддерживает)
+UNSUPPORTED_RETRY = 3600
+
+logger = logging.getLogger("bot.context_cache")
+
+
+@dataclass
+class CacheEntry:
+    name: str
+    turn_keys: Tuple
+    summary: Optional[str]
+    expires_at: float
+    tokens: int
+    requests: int = 0
+
+
+def turn_key(record: Dict) -> Tuple:
+    return record["timestamp"], len(record["query"] or ""), len(record["response"] or "")
+
+
+class ContextCacheManager:
+    """Кэши начала промпта в Gemini, по одному на пользователя и модель.
+
+    В кэш попадают системная инструкция, инструменты, сводка и записи истории на момент создания. Пока
+    к истории только добавляются записи, запрос отправляет кэш и текст после него. Кэш пересоздается
+    в фоне, когда после него накопилось много записей, сменилась сводка или он скоро истечет;
+    /clear и смена модели его удаляют. Изображения в кэш не входят и отправляются с каждым запросом.
+    """
+
+    def __init__(self, model_for: Callable, system_chars: Callable[[str], int] = None, ttl: float = CONTEXT_CACHE_TTL,
+                 min_tokens: int = CONTEXT_CACHE_MIN_TOKENS, rebuild_turns: int = CONTEXT_CACHE_REBUILD_TURNS,
+                 max_entries: int = CONTEXT_CACHE_MAX_ENTRIES, enabled: bool = CONTEXT_CACHE):
+        self.enabled = enabled
+        self.model_for = model_for
+        self.system_chars = system_chars or (lambda model_id: 0)
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.rebuild_turns = rebuild_turns
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[int, str], CacheEntry]" = OrderedDict()
+        self.unsupported: Dict[str, float] = {}
+        self._building = set()
+        self.tasks = BackgroundTasks()  # создание и удаление кэшей в Gemini
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.create_errors = 0
+        self.invalidated = 0
+        self.rejected = 0
+
+    def prompt(self, user_id: int, model_id: str, header: List[str], turns: List[Tuple[Dict, str]],
+               tail: List[str]) -> Tuple[str, Optional[PromptCache]]:
+        """Собирает промпт из заголовка, блоков истории (запись, текст) и хвоста с текущим сообщением.
+
+        Возвращает полный текст и, если для пользователя есть подходящий кэш, ссылку на него с остатком промпта.
+        """
+        history = ["История запросов:"] + [text for _, text in turns] if turns else []
+        full_text = "\n".join(header + history + tail)
+        if not self.enabled:
+            return full_text, None
+
+        summary = "\n".join(header)
+        keys = [turn_key(record) for record, _ in turns]
+        entry = self._valid_entry(user_id, model_id)
+
+        cache = None
+        cached_turns = 0
+        if entry is not None and entry.summary == summary and entry.turn_keys and entry.turn_keys[-1] in keys:
+            cached_turns = keys.index(entry.turn_keys[-1]) + 1
+            rest = [text for _, text in turns[cached_turns:]]
+            cache = PromptCache(entry.name, model_id, "\n".join(rest + tail))
+            entry.requests += 1
+            self.hits += 1
+        else:
+            if entry is not None:
+                self.invalidate(user_id, model_id)
+            self.misses += 1
+
+        fresh_turns = len(turns) - cached_turns
+        if turns and (cache is None or fresh_turns >= self.rebuild_turns or self._expiring(entry)):
+            prefix = "\n".join(header + history)
+            tokens = (len(prefix) + self.system_chars(model_id)) // 4
+            if tokens >= self.min_tokens:
+                self._schedule_build(user_id, model_id, prefix, tuple(keys), summary, tokens)
+        return full_text, cache
+
+    def _valid_entry(self, user_id: int, model_id: str) -> Optional[CacheEntry]:
+        entry = self.entries.get((user_id, model_id))
+        if entry is None:
+            return None
+        if entry.expires_at - EXPIRY_MARGIN <= time.monotonic():
+            self.entries.pop((user_id, model_id), None)
+            return None
+        self.entries.move_to_end((user_id, model_id))
+        return entry
+
+    def _expiring(self, entry: Optional[CacheEntry]) -> bool:
+        return entry is not None and entry.expires_at - time.monotonic() < self.ttl / 4
+
+    def _schedule_build(self, user_id: int, model_id: str, prefix: str, keys: Tuple, summary: str, tokens: int):
+        key = (user_id, model_id)
+        if key in self._building or self.unsupported.get(model_id, 0) > time.monotonic():
+            return
+        self._building.add(key)
+        # Кэш создается в фоне: текущий запрос уходит как есть, кэш пригодится со следующего
+        self.tasks.spawn(self._build(key, prefix, keys, summary, tokens))
+
+    async def _build(self, key: Tuple[int, str], prefix: str, keys: Tuple, summary: str, tokens: int):
+        user_id, model_id = key
+        try:
+            name = await self.model_for(model_id).create_cache(prefix, self.ttl)
+        except Exception as e:
+            self.create_errors += 1
+            if isinstance(e, errors.APIError) and e.code in (400, 403, 404):
+                self.unsupported[model_id] = time.monotonic() + UNSUPPORTED_RETRY
+                logger.warning(f"Context cache for {model_id} rejected, disabled for {UNSUPPORTED_RETRY}s: {e}")
+            else:
+                logger.warning(f"Context cache for user {user_id}, {model_id} could not be created: {e}")
+            return
+        finally:
+            self._building.discard(key)
+        self.created += 1
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self._delete_remote(model_id, old.name)
+        self.entries[key] = CacheEntry(name, keys, summary, time.monotonic() + self.ttl, tokens)
+        while len(self.entries) > self.max_entries:
+            (_, evicted_model), evicted = self.entries.popitem(last=False)
+            self._delete_remote(evicted_model, evicted.name)
+        logger.info("Context cache %s created for user %s, %s: %d turns, ~%d tokens", name, user_id, model_id, len(keys),
+                    tokens)
+
+    def release(self, user_id: int, cache: Optional[PromptCache]):
+        """Вызывается после запроса: кэш, который отверг API, больше не используется."""
+        if cache is not None and cache.failed:
+            self.rejected += 1
+            self.invalidate(user_id, cache.model_id)
+
+    def invalidate(self, user_id: int, model_id: str = None):
+        """Удаляет кэши пользователя: одной модели или всех (после /clear или смены модели)."""
+        for key in [key for key in self.entries if key[0] == user_id and model_id in (None, key[1])]:
+            entry = self.entries.pop(key)
+            self.invalidated += 1
+            self._delete_remote(key[1], entry.name)
+
+    def _delete_remote(self, model_id: str, name: str):
+        async def delete():
+            try:
+                await self.model_for(model_id).delete_cache(name)
+            except Exception as e:
+                logger.debug("Context cache %s was not deleted, it will expire by TTL: %s", name, e)
+        self.tasks.spawn(delete())
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "create_errors": self.create_errors,
+            "invalidated": self.invalidated,
+            "rejected": self.rejected,
+        }
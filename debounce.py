@@ -0,0 +1,155 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, List
+
+from dotenv import load_dotenv
+
+from state import MemoryBackend, StateBackend
+
+load_dotenv()
+
+# Пауза, после которой буфер отправляется в обработку. Куски длинного сообщения, порезанного Telegram,
+# приходят почти целиком заполненными - после них ждем дольше, вдруг придет продолжение
+TEXT_DEBOUNCE = float(os.getenv("TEXT_DEBOUNCE", "1.5"))
+TEXT_DEBOUNCE_LONG = float(os.getenv("TEXT_DEBOUNCE_LONG", "3"))
+ALBUM_DEBOUNCE = float(os.getenv("ALBUM_DEBOUNCE", "1"))
+# Дольше этого буфер не копится, даже если сообщения продолжают приходить
+DEBOUNCE_MAX_AGE = float(os.getenv("DEBOUNCE_MAX_AGE", "15"))
+DEBOUNCE_MAX_BUFFERS = int(os.getenv("DEBOUNCE_MAX_BUFFERS", "10000"))
+DEBOUNCE_MAX_MESSAGES = 50
+
+ALBUM_MAX_ITEMS = 10  # больше в одну медиагруппу Telegram не кладет
+LONG_TEXT_THRESHOLD = 4000
+
+logger = logging.getLogger("bot.debounce")
+
+
+@dataclass
+class Buffer:
+    started: float
+    deadline: float = 0.0
+    size: int = 0
+
+
+class DebounceScheduler:
+    """Копит сообщения по ключу и отдает их пачкой после паузы.
+
+    Все таймеры живут в одной куче и обслуживаются одной фоновой задачей, вместо отдельной
+    задачи asyncio.sleep на каждое сообщение. Сами сообщения лежат в StateBackend: для общего
+    хранилища их нужно сериализовать функциями encode/decode.
+    """
+
+    def __init__(self, flush: Callable[[Hashable, List], None], store: StateBackend = None,
+                 encode: Callable = None, decode: Callable = None, max_age: float = DEBOUNCE_MAX_AGE,
+                 max_buffers: int = DEBOUNCE_MAX_BUFFERS, max_messages: int = DEBOUNCE_MAX_MESSAGES):
+        self.flush = flush
+        self.store = store or MemoryBackend()
+        self.encode = encode or (lambda message: message)
+        self.decode = decode or (lambda value: value)
+        self.max_age = max_age
+        self.max_buffers = max_buffers
+        self.max_messages = max_messages
+        self.buffers: Dict[Hashable, Buffer] = {}
+        self.heap = []  # (срок, порядковый номер, ключ); устаревшие записи пропускаются при извлечении
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Метрики
+        self.buffered_messages = 0
+        self.peak_buffers = 0
+        self.flushed = {"idle": 0, "full": 0, "max_age": 0, "overflow": 0, "shutdown": 0}
+        self.errors = 0
+
+    async def add(self, key: Hashable, message, idle: float, complete: bool = False):
+        """Добавляет сообщение в буфер key; complete=True отправляет буфер сразу."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if key not in self.buffers and len(self.buffers) >= self.max_buffers:
+            # Память ограничена: самый старый буфер уходит в обработку досрочно
+            await self._flush(next(iter(self.buffers)), "overflow")
+        size = await self.store.append(self._store_key(key), self.encode(message), ttl=self.max_age * 2)
+        # Буфер ищется после await: пока шла запись, прежний мог уже уйти в обработку
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = Buffer(started=now)
+            self.peak_buffers = max(self.peak_buffers, len(self.buffers))
+        buffer.size = size
+        self.buffered_messages += 1
+
+        if complete or buffer.size >= self.max_messages:
+            await self._flush(key, "full")
+            return
+
+        buffer.deadline = min(now + idle, buffer.started + self.max_age)
+        heapq.heappush(self.heap, (buffer.deadline, next(self._counter), key))
+        if self.heap[0][2] == key:
+            self._wakeup.set()  # срок раньше того, до которого спит фоновая задача
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="debounce")
+
+    async def add_text(self, user_id, message):
+        text = message.text or ""
+        idle = TEXT_DEBOUNCE_LONG if len(text) >= LONG_TEXT_THRESHOLD else TEXT_DEBOUNCE
+        await self.add(("text", user_id), message, idle)
+
+    async def add_album(self, media_group_id, message):
+        key = ("album", media_group_id)
+        complete = key in self.buffers and self.buffers[key].size + 1 >= ALBUM_MAX_ITEMS
+        await self.add(key, message, ALBUM_DEBOUNCE, complete=complete)
+
+    @staticmethod
+    def _store_key(key: Hashable) -> str:
+        return "debounce:" + ":".join(map(str, key)) if isinstance(key, tuple) else f"debounce:{key}"
+
+    async def _flush(self, key: Hashable, reason: str):
+        buffer = self.buffers.pop(key, None)
+        if buffer is None:
+            return
+        self.buffered_messages -= buffer.size
+        self.flushed[reason] += 1
+        try:
+            messages = [self.decode(value) for value in await self.store.pop_all(self._store_key(key))]
+            if messages:
+                self.flush(key, messages)
+        except Exception as e:
+            self.errors += 1
+            logger.exception(f"Error flushing buffer {key}: {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self.buffers:
+            self._wakeup.clear()
+            now = loop.time()
+            while self.heap and self.heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self.heap)
+                buffer = self.buffers.get(key)
+                if buffer is not None and buffer.deadline == deadline:
+                    await self._flush(key, "max_age" if deadline >= buffer.started + self.max_age else "idle")
+            if not self.heap:
+                break
+            now = loop.time()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.heap[0][0] - now)
+            except asyncio.TimeoutError:
+                pass
+        self.heap.clear()
+
+    async def flush_all(self):
+        """Отправляет все накопленное, например при остановке бота."""
+        for key in list(self.buffers):
+            await self._flush(key, "shutdown")
+        self.heap.clear()
+
+    def stats(self) -> dict:
+        return {
+            "buffers": len(self.buffers),
+            "peak_buffers": self.peak_buffers,
+            "buffered_messages": self.buffered_messages,
+            "heap": len(self.heap),
+            "flushed": dict(self.flushed),
+            "errors": self.errors,
+        }
@@ -0,0 +1,341 @@
+import html
+import re
+
+# Все шаблоны скомпилированы один раз; разбор идет одним проходом слева направо без возвратов
+TOKEN_RE = re.compile(r"```|`|\*\*\*|\*\*|\*|___|__|_|~~|\[|\n")
+# Текст ссылки не содержит "[": иначе каждая незакрытая скобка заново просматривала бы текст до следующей
+LINK_RE = re.compile(r"\[([^\[\]\n]{1,1000})\]\((https?://[^\s()<>]{1,2000})\)")
+HEADING_RE = re.compile(r"#{1,6}[ \t]+")
+BULLET_RE = re.compile(r"[*\-+][ \t]+")
+SPACES_RE = re.compile(r"[ \t]+")
+
+# Маркдаун-разметка Gemini и соответствующие теги Telegram HTML
+EMPHASIS_TAGS = {"**": "b", "*": "i", "__": "u", "_": "i", "~~": "s"}
+# Тройной маркер - два выделения сразу: ***x*** = <b><i>x</i></b>
+TRIPLE_MARKERS = {"***": ("**", "*"), "___": ("__", "_")}
+HEADING = "#"
+
+
+def escape(text: str) -> str:
+    return html.escape(text, quote=False)
+
+
+def _text(segment: str) -> str:
+    if "  " in segment or "\t" in segment:
+        segment = SPACES_RE.sub(" ", segment)
+    if "&" in segment or "<" in segment or ">" in segment:
+        segment = escape(segment)
+    return segment
+
+
+def _unwind(out: list, stack: list, open_at: dict, depth: int):
+    """Закрывает незакрытую разметку выше depth: выделение становится обычным текстом, заголовок закрывается."""
+    while len(stack) > depth:
+        marker, index = stack.pop()
+        open_at[marker].pop()
+        if marker == HEADING:
+            out.append("</b>")
+        else:
+            out[index] = marker
+
+
+def _emphasis(out: list, stack: list, open_at: dict, marker: str, can_open: bool, can_close: bool):
+    if can_close and open_at[marker]:
+        depth = open_at[marker][-1]
+        if depth == len(stack) - 2 and stack[-1][1] == stack[depth][1] + 1:
+            # Выделения открыты вплотную (***x** y*) - меняем их местами, чтобы закрыть внешнее без разрыва
+            inner = stack[-1]
+            out[stack[depth][1]], out[inner[1]] = out[inner[1]], out[stack[depth][1]]
+            stack[depth][0], inner[0] = inner[0], marker
+            open_at[stack[depth][0]][-1] = depth
+            open_at[marker][-1] = depth + 1
+        _unwind(out, stack, open_at, open_at[marker][-1] + 1)
+        stack.pop()
+        open_at[marker].pop()
+        out.append(f"</{EMPHASIS_TAGS[marker]}>")
+    elif can_open:
+        open_at[marker].append(len(stack))
+        stack.append([marker, len(out)])
+        out.append(f"<{EMPHASIS_TAGS[marker]}>")
+    else:
+        out.append(marker)
+
+
+def render_html(text: str) -> str:
+    """Превращает Markdown из ответа Gemini в корректный HTML для Telegram за один линейный проход."""
+    if not text:
+        return ""
+
+    out = []
+    stack = []  # открытые элементы: [маркер, индекс открывающего тега в out]
+    open_at = {marker: [] for marker in (*EMPHASIS_TAGS, HEADING)}  # позиции в stack по маркеру
+    pos = 0
+    length = len(text)
+    line_start = True
+
+    while pos < length:
+        if line_start:
+            line_start = False
+            match = HEADING_RE.match(text, pos)
+            if match:
+                open_at[HEADING].append(len(stack))
+                stack.append([HEADING, len(out)])
+                out.append("<b>")
+                pos = match.end()
+                continue
+            match = BULLET_RE.match(text, pos)
+            if match:
+                out.append("• ")
+                pos = match.end()
+                continue
+
+        match = TOKEN_RE.search(text, pos)
+        if not match:
+            out.append(_text(text[pos:]))
+            break
+        start = match.start()
+        if start > pos:
+            out.append(_text(text[pos:start]))
+        token = match.group()
+        pos = match.end()
+
+        if token == "\n":
+            while pos < length and text[pos] == "\n":
+                pos += 1
+            if pos - start >= 2:
+                # Выделение не переходит через абзац
+                _unwind(out, stack, open_at, 0)
+            elif open_at[HEADING]:
+                _unwind(out, stack, open_at, open_at[HEADING][-1])
+            out.append("\n\n" if pos - start >= 2 else "\n")
+            line_start = True
+
+        elif token == "```":
+            close = text.find("```", pos)
+            if close == -1:
+                out.append(token)
+                continue
+            body = text[pos:close]
+            language, newline, code = body.partition("\n")
+            language = language.strip()
+            if not newline or not language or " " in language:
+                language, code = "", body
+            opening = f'<pre><code class="language-{escape(language)}">' if language else "<pre><code>"
+            out.append(opening + escape(code.strip("\n")) + "</code></pre>")
+            pos = close + 3
+
+        elif token == "`":
+            close = text.find("`", pos)
+            if close <= pos:
+                out.append(token)
+                continue
+            out.append("<code>" + escape(text[pos:close]) + "</code>")
+            pos = close + 1
+
+        elif token == "[":
+            match = LINK_RE.match(text, start)
+            if match:
+                out.append(f'<a href="{html.escape(match.group(2))}">{escape(match.group(1))}</a>')
+                pos = match.end()
+            else:
+                out.append(token)
+
+        else:
+            previous = text[start - 1] if start > 0 else " "
+            following = text[pos] if pos < length else " "
+            can_open = not following.isspace()
+            can_close = not previous.isspace()
+            if token[0] == "_":
+                # snake_case и подобные слова не считаются разметкой
+                can_open = can_open and not previous.isalnum()
+                can_close = can_close and not following.isalnum()
+
+            markers = TRIPLE_MARKERS.get(token, (token,))
+            if len(markers) == 2 and can_close and open_at[markers[0]] and open_at[markers[1]] \
+                    and open_at[markers[1]][-1] > open_at[markers[0]][-1]:
+                markers = markers[::-1]  # первым закрывается внутреннее выделение
+            for marker in markers:
+                _emphasis(out, stack, open_at, marker, can_open, can_close)
+
+    _unwind(out, stack, open_at, 0)
+    return "".join(out).strip()
+
+
+# --- Разбиение длинных сообщений ---
+
+MAX_MESSAGE_LENGTH = 4096
+HTML_TOKEN_RE = re.compile(r"<[^<>]*>|&[#\w]+;|[^<&]+|[<&]")
+TAG_NAME_RE = re.compile(r"<(/?)([a-zA-Z]+)")
+
+
+def utf16_len(text: str) -> int:
+    """Длина в единицах UTF-16 - так длину сообщения считает Telegram."""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+class _Splitter:
+    """Набирает куски не длиннее limit, закрывая открытые теги в конце куска и открывая их заново в следующем.
+
+    Все размеры - в единицах UTF-16. Заново открытые теги, рядом с которыми в куске не остается места на MIN_ROOM
+    единиц текста или на целую сущность, отбрасываются вместе с закрывающими: текст остается, пропадает только
+    форматирование.
+    """
+
+    MIN_ROOM = 2  # один символ вне BMP
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.chunks = []
+        self.stack = []  # открытые теги: [имя, открывающий тег, выводится ли тег]
+        self.closing_size = 0
+        self.parts = []
+        self.size = 0
+        self.base = 0  # размер заново открытых тегов в начале куска
+        self.visible = 0
+
+    def flush(self, need: int = MIN_ROOM):
+        if self.visible:
+            closing = "".join(f"</{name}>" for name, _, shown in reversed(self.stack) if shown)
+            self.chunks.append("".join(self.parts) + closing)
+        # Заново открытые теги не должны съедать весь кусок - лишние, начиная с внутренних, отбрасываем
+        for entry in reversed(self.stack):
+            if self.limit - self._reopen_size() >= need:
+                break
+            if entry[2]:
+                entry[2] = False
+                self.closing_size -= utf16_len(entry[0]) + 3
+        self.parts = [opening for _, opening, shown in self.stack if shown]
+        self.size = self.base = sum(utf16_len(opening) for opening in self.parts)
+        self.visible = 0
+
+    def _reopen_size(self) -> int:
+        return sum(utf16_len(opening) for _, opening, shown in self.stack if shown) + self.closing_size
+
+    def room(self) -> int:
+        return self.limit - self.size - self.closing_size
+
+    def add_tag(self, tag: str):
+        match = TAG_NAME_RE.match(tag)
+        if not match:
+            self.add_text(tag)
+            return
+        closing, name = match.groups()
+        units = utf16_len(tag)
+        closing_units = utf16_len(name) + 3
+        if closing:
+            if self.stack and self.stack[-1][0] == name:
+                _, _, shown = self.stack.pop()
+                if not shown:
+                    return
+                # Закрывающий тег уже учтен в closing_size - выводим ровно его
+                self.closing_size -= closing_units
+                tag, units = f"</{name}>", closing_units
+            elif units > self.room():
+                self.flush()
+            self.parts.append(tag)
+            self.size += units
+            return
+        if units + closing_units > self.room() - self.MIN_ROOM:
+            self.flush()
+        shown = units + closing_units <= self.room() - self.MIN_ROOM
+        self.stack.append([name, tag, shown])
+        if shown:
+            self.parts.append(tag)
+            self.size += units
+            self.closing_size += closing_units
+
+    def add_atom(self, atom: str):
+        """Неделимый фрагмент - HTML-сущность."""
+        units = utf16_len(atom)
+        if units > self.room():
+            self.flush(units)
+            if units > self.room():
+                self.add_text(atom)  # сущность длиннее всего лимита - режем как текст
+                return
+        self.parts.append(atom)
+        self.size += units
+        self.visible += 1
+
+    def add_text(self, run: str):
+        units = utf16_len(run)
+        if units <= self.room():
+            self.parts.append(run)
+            self.size += units
+            if not run.isspace():
+                self.visible += 1
+            return
+
+        start = 0
+        length = len(run)
+        while start < length:
+            room = self.room()
+            end = min(start + max(room, 0), length)
+            units = utf16_len(run[start:end])
+            if units <= room and end == length:
+                self.parts.append(run[start:])
+                self.size += units
+                if not run[start:].isspace():
+                    self.visible += 1
+                return
+
+            # Символы вне BMP занимают две единицы - уменьшаем кусок на половину излишка, пока не поместится
+            while units > room and end > start:
+                end -= (units - room + 1) // 2
+                units = utf16_len(run[start:end])
+            cut = self._break(run, start, end)
+            if cut == start:
+                if self.visible or self.size > self.base:
+                    self.flush()  # слово целиком переносим в следующий кусок
+                    continue
+                cut = end if end > start else start + 1  # слово длиннее лимита - режем как есть
+            self.parts.append(run[start:cut])
+            self.size += utf16_len(run[start:cut])
+            if not run[start:cut].isspace():
+                self.visible += 1
+            self.flush()
+            start = cut
+
+    @staticmethod
+    def _break(run: str, start: int, end: int) -> int:
+        """Последний перенос строки или пробел в run[start:end], но не в первой половине."""
+        for separator in ("\n", " "):
+            index = run.rfind(separator, start, end)
+            if index >= start + (end - start) // 2:
+                return index + 1
+        return start
+
+
+def split_html(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    """Делит HTML на куски не длиннее limit, не разрывая теги, сущности и слова."""
+    if utf16_len(text) <= limit:
+        return [text] if text else []
+    splitter = _Splitter(limit)
+    for token in HTML_TOKEN_RE.findall(text):
+        if token[0] == "<" and len(token) > 1:
+            splitter.add_tag(token)
+        elif token[0] == "&" and len(token) > 1:
+            splitter.add_atom(token)
+        else:
+            splitter.add_text(token)
+    splitter.flush()
+    return splitter.chunks
+
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH) -> list:
+    """Делит обычный текст на куски не длиннее limit по границам строк и слов."""
+    if utf16_len(text) <= limit:
+        return [text] if text else []
+    splitter = _Splitter(limit)
+    splitter.add_text(text)
+    splitter.flush()
+    return splitter.chunks
+
+
+HTML_TAG_RE = re.compile(r"<[^<>]*>")
+
+
+def html_to_plain(text: str) -> str:
+    """Убирает теги и раскрывает сущности - для отправки куска без форматирования."""
+    return html.unescape(HTML_TAG_RE.sub("", text))
@@ -1,15 +1,34 @@
 from google import genai
-from google.genai.types import Tool, GoogleSearch, GenerateContentConfig, Content, Part
+from google.genai import errors
+from google.genai._api_client import ApiClient, HttpRequest, HttpResponse, RequestJsonEncoder
+from google.genai.types import (Tool, GoogleSearch, GenerateContentConfig, CreateCachedContentConfig, Content, Part,
+                                FileData)
 import os
-import io
+import asyncio
+import json
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from dotenv import load_dotenv
-from PIL import Image
-from typing import List
+from typing import List, NamedTuple, Optional, Union
 import logging
+from image_cache import CachedImage
+from logging_setup import Clip
+from gemini_resilience import GEMINI_TIMEOUT
 
 load_dotenv()
 
 API = os.getenv("GEMINI_KEY")
+# Другой адрес API, например локальный стенд для тестов: http://127.0.0.1:8081/
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")
+# Размер пула потоков для блокирующих вызовов SDK и лимит одновременных генераций
+GEMINI_MAX_WORKERS = int(os.getenv("GEMINI_MAX_WORKERS", "16"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", str(GEMINI_MAX_WORKERS)))
+# HTTP-таймаут чуть длиннее таймаута попытки: первым срабатывает asyncio.wait_for, а брошенный поток
+# все равно завершается вскоре после него и освобождает слот пула
+GEMINI_HTTP_SLACK = float(os.getenv("GEMINI_HTTP_SLACK", "5"))
+GEMINI_CONNECT_TIMEOUT = 10
 system_instruction = """Ты - многофункциональный ассистент, способный адаптироваться к различным задачам.
 
 Для общения в диалоговом режиме: Поддерживай дружелюбный и эмпатичный тон. Отвечай развернуто, стараясь понять чувства пользователя. Используй разговорный стиль, как если бы ты общался с другом. Добавляй смайлики (но не перебарщивай), чтобы сделать общение более живым и эмоциональным. Не стесняйся задавать уточняющие вопросы для лучшего понимания запроса. Добавляй немного юмора и непринужденности в свои ответы.
@@ -18,90 +37,377 @@ system_instruction = """Ты - многофункциональный ассис
 
 # Настройка логгера
 logger = logging.getLogger("gemini_api")
-logger.setLevel(logging.DEBUG)
-LOG_DIR = "logs"
-os.makedirs(LOG_DIR, exist_ok=True)
-file_handler = logging.FileHandler(os.path.join(LOG_DIR, "gemini_api.log"), encoding="utf-8")
-file_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
-
-
-class Gemini:
-    def __init__(self):
-        self.client = genai.Client(api_key=API)
-        self.model_id = 'gemini-2.0-flash-exp'
-        self.google_search_tool = Tool(google_search=GoogleSearch())
-        logger.debug("Gemini model initialized")
-
-    async def generate_content(self, query: str, files: List[Image.Image] = None) -> str:
-        parts = []
-        parts.append(Part(text=query))
-
-        if files:
-            for image in files:
-                image_bytes = io.BytesIO()
-                image.save(image_bytes, format="JPEG")
-                image_bytes = image_bytes.getvalue()
-                parts.append(Part(inline_data={"mime_type": "image/jpeg", "data": image_bytes}))
-        
-        logger.debug(f"Gemini model generating with query: {query}, images: {bool(files)}")
-
-        contents = [Content(parts=parts)]
-
-        response = self.client.models.generate_content(
-            model=self.model_id,
-            contents=contents,           
-            config=GenerateContentConfig(
-                tools=[self.google_search_tool],
-                response_modalities=['TEXT'],
-                system_instruction=system_instruction
-            )
+
+
+NO_RESPONSE = "No response from Gemini"
+
+_STREAM_END = object()
+_http_timeout = threading.local()  # таймаут попытки для HTTP-запроса SDK в текущем потоке пула
+
+
+class _StreamError:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class GenerationPool:
+    """Выполняет блокирующие вызовы Gemini SDK в пуле потоков, не блокируя event loop."""
+
+    def __init__(self, max_workers: int, max_concurrency: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gemini")
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Метрики очереди
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def _acquire(self, timeout: Optional[float]):
+        """Ждет слот не дольше timeout: если все слоты заняты зависшими запросами, сработают таймаут и повторы."""
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.failed += 1
+            raise
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    @staticmethod
+    def _call(timeout: Optional[float], func, *args, **kwargs):
+        _http_timeout.value = timeout
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _http_timeout.value = None
+
+    async def run(self, func, *args, timeout: float = None, **kwargs):
+        """timeout ограничивает всю попытку: ожидание слота в пуле и само выполнение."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await self._acquire(timeout)
+        if timeout is not None:
+            timeout = max(timeout - (loop.time() - started), 0)
+
+        future = self.executor.submit(self._call, timeout, func, *args, **kwargs)
+        # Слот освобождается только когда поток действительно завершился,
+        # даже если ожидающая корутина была отменена
+        future.add_done_callback(lambda _: self._release_from_thread(loop))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except Exception:
+            self.failed += 1
+            raise
+
+    async def stream(self, func, *args, timeout: float = None, **kwargs):
+        """Итерирует блокирующий генератор SDK в пуле потоков, отдавая чанки в event loop.
+
+        timeout - максимальное ожидание слота в пуле и максимальная пауза между чанками.
+        """
+        await self._acquire(timeout)
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                stop.set()  # event loop уже закрыт
+
+        def worker():
+            _http_timeout.value = timeout
+            try:
+                for chunk in func(*args, **kwargs):
+                    if stop.is_set():
+                        break
+                    put(chunk)
+            except Exception as e:
+                put(_StreamError(e))
+            finally:
+                _http_timeout.value = None
+                put(_STREAM_END)
+
+        future = self.executor.submit(worker)
+        future.add_done_callback(lambda _: self._release_from_thread(loop))
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    self.failed += 1
+                    raise
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, _StreamError):
+                    self.failed += 1
+                    raise item.error
+                yield item
+        finally:
+            stop.set()
+
+    def _release_from_thread(self, loop):
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # поток, брошенный по таймауту, завершился уже после остановки event loop
+
+    def _release(self):
+        self.in_flight -= 1
+        self.completed += 1
+        self.semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    def shutdown(self, wait: bool = False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+generation_pool = GenerationPool(GEMINI_MAX_WORKERS, GEMINI_MAX_CONCURRENCY)
+
+
+class UploadedFile(NamedTuple):
+    """Изображение, уже загруженное в Files API: в запрос уходит только ссылка на него."""
+    uri: str
+    mime_type: str
+    file_id: Optional[str] = None
+
+
+@dataclass
+class PromptCache:
+    """Закэшированное в Gemini начало промпта и остаток запроса после него.
+
+    Используется только моделью model_id: запасная модель получает полный промпт. failed выставляется,
+    если API отверг кэш, и тогда запрос уходит без него.
+    """
+    name: str
+    model_id: str
+    query: str
+    failed: bool = False
+
+
+def build_contents(query: str, files: List[Union[CachedImage, UploadedFile]] = None) -> List[Content]:
+    """Собирает запрос к модели из текста и изображений."""
+    parts = []
+    parts.append(Part(text=query))
+
+    if files:
+        for image in files:
+            if isinstance(image, UploadedFile):
+                parts.append(Part(file_data=FileData(file_uri=image.uri, mime_type=image.mime_type)))
+            else:
+                # Байты отправляются как есть, без декодирования и повторного сжатия
+                parts.append(Part(inline_data={"mime_type": image.mime_type, "data": image.data}))
+
+    return [Content(parts=parts)]
+
+
+def chunk_text(chunk) -> str:
+    """Достает текст из очередного чанка потокового ответа."""
+    if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+        return ""
+    return "".join(part.text for part in chunk.candidates[0].content.parts if part.text)
+
+
+class GeminiApiClient(ApiClient):
+    """ApiClient с общим пулом соединений и таймаутом на HTTP-запросы.
+
+    В google-genai 0.3.0 каждый запрос открывает новую requests.Session (и новое TCP/TLS-соединение) и уходит
+    без таймаута, поэтому поток, брошенный по asyncio.wait_for, мог навсегда зависнуть на мертвом соединении,
+    занимая слот GenerationPool. Метод повторяет _request_unauthorized закрепленной в requirements.txt версии SDK
+    и меняет только отправку: запрос идет через одну сессию на клиент, а таймаут чтения - таймаут попытки,
+    переданный в GenerationPool, плюс GEMINI_HTTP_SLACK. При обновлении SDK адаптер нужно сверить с новой версией.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Соединений в пуле столько же, сколько потоков может одновременно ходить в API
+        self.http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=GEMINI_MAX_WORKERS)
+        self.http_session.mount("https://", adapter)
+        self.http_session.mount("http://", adapter)
+
+    def _request_unauthorized(self, http_request: HttpRequest, stream: bool = False) -> HttpResponse:
+        data = None
+        if http_request.data:
+            if not isinstance(http_request.data, bytes):
+                data = json.dumps(http_request.data, cls=RequestJsonEncoder)
+            else:
+                data = http_request.data
+
+        request = requests.Request(
+            method=http_request.method,
+            url=http_request.url,
+            headers=http_request.headers,
+            data=data,
+        ).prepare()
+        timeout = getattr(_http_timeout, "value", None)
+        read_timeout = (GEMINI_TIMEOUT if timeout is None else timeout) + GEMINI_HTTP_SLACK
+        response = self.http_session.send(request, stream=stream, timeout=(GEMINI_CONNECT_TIMEOUT, read_timeout))
+        errors.APIError.raise_for_response(response)
+        return HttpResponse(response.headers, response if stream else [response.text])
+
+
+class GeminiClient(genai.Client):
+    """genai.Client поверх GeminiApiClient."""
+
+    @staticmethod
+    def _get_api_client(debug_config=None, **kwargs):
+        return GeminiApiClient(**kwargs)
+
+
+def create_client(api_key: str = API, base_url: str = GEMINI_BASE_URL) -> genai.Client:
+    """Один клиент и один пул HTTP-соединений на все модели бота.
+
+    Попытку ограничивает GenerationPool через asyncio.wait_for с таймаутом из ModelSpec, а GeminiApiClient
+    ставит на HTTP-запрос тот же таймаут с небольшим запасом, чтобы брошенный поток не висел вечно.
+    """
+    if base_url:
+        return GeminiClient(api_key=api_key, http_options={"base_url": base_url})
+    return GeminiClient(api_key=api_key)
+
+
+class GeminiModel:
+    """Одна модель Gemini из реестра: конфиг запроса собирается из ModelSpec, клиент общий."""
+
+    def __init__(self, spec, client: genai.Client):
+        self.spec = spec
+        self.model_id = spec.id
+        self.client = client
+        tools = [Tool(google_search=GoogleSearch())] if "google_search" in spec.tools else None
+        self.config = GenerateContentConfig(
+            tools=tools,
+            response_modalities=['TEXT'],
+            system_instruction=spec.system_instruction or system_instruction,
+            max_output_tokens=spec.max_output_tokens,
         )
-        if response.text:
-           logger.debug(f"Gemini model answer is TEXT")
-           return response.text
-        elif response.candidates:
-             logger.debug(f"Gemini model answer is CANDIDATES")
-             return response.candidates[0].content.parts[0].text
-        else:
-          logger.warning(f"Gemini model answer is NO RESPONSE")
-          return "No response from Gemini"
-
-class GeminiThinking:
-    def __init__(self):
-        self.client = genai.Client(api_key=API)
-        self.model_id = 'gemini-2.0-flash-thinking-exp-1219'
-        logger.debug("GeminiThinking model initialized")
-
-    async def generate_content(self, query: str, files: List[Image.Image] = None) -> str:
-        parts = []
-        parts.append(Part(text=query))
-
-        if files:
-            for image in files:
-                image_bytes = io.BytesIO()
-                image.save(image_bytes, format="JPEG")
-                image_bytes = image_bytes.getvalue()
-                parts.append(Part(inline_data={"mime_type": "image/jpeg", "data": image_bytes}))
-
-        logger.debug(f"GeminiThinking model generating with query: {query}, images: {bool(files)}")
-
-        contents = [Content(parts=parts)]
-
-        response = self.client.models.generate_content(
-            model=self.model_id,
-            contents=contents,           
-            config=GenerateContentConfig(
-                response_modalities=['TEXT'],
-                system_instruction=system_instruction
+        # Счетчики токенов: сколько входных токенов пришло из кэша контекста, а сколько обработано заново
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.output_tokens = 0
+        logger.debug("Model %s initialized", self.model_id)
+
+    def _request(self, query: str, files, cache: Optional[PromptCache]):
+        """Содержимое и конфиг запроса: с кэшем уходит только остаток промпта, инструкция и инструменты уже в кэше."""
+        if cache is None or cache.failed or cache.model_id != self.model_id:
+            return build_contents(query, files), self.config
+        config = GenerateContentConfig(
+            response_modalities=self.config.response_modalities,
+            max_output_tokens=self.config.max_output_tokens,
+            cached_content=cache.name,
+        )
+        return build_contents(cache.query, files), config
+
+    def _cache_rejected(self, error: Exception, cache: Optional[PromptCache]) -> bool:
+        if cache is None or cache.failed or cache.model_id != self.model_id:
+            return False
+        if isinstance(error, errors.APIError) and error.code in (400, 403, 404):
+            logger.warning(f"{self.model_id}: cached content {cache.name} rejected ({error.code}), sending full prompt")
+            cache.failed = True
+            return True
+        return False
+
+    def _record_usage(self, usage, cached: bool):
+        if usage is None:
+            return
+        prompt_tokens = usage.prompt_token_count or 0
+        cached_tokens = usage.cached_content_token_count or 0
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        self.output_tokens += usage.candidates_token_count or 0
+        logger.info("%s usage: %d input tokens (%d cached, %d fresh), %d output%s", self.model_id, prompt_tokens,
+                    cached_tokens, prompt_tokens - cached_tokens, usage.candidates_token_count or 0,
+                    ", context cache" if cached else "")
+
+    async def generate_content(self, query: str, files: List[Union[CachedImage, UploadedFile]] = None, timeout: float = None,
+                               cache: PromptCache = None) -> str:
+        contents, config = self._request(query, files, cache)
+        logger.debug("%s generating with query: %s, images: %d, pool: %s", self.model_id, Clip(query), len(files or ()),
+                     generation_pool.stats())
+
+        try:
+            response = await generation_pool.run(
+                self.client.models.generate_content,
+                model=self.model_id,
+                contents=contents,
+                config=config,
+                timeout=timeout
             )
+        except Exception as e:
+            if not self._cache_rejected(e, cache):
+                raise
+            return await self.generate_content(query, files, timeout, cache)
+        self._record_usage(response.usage_metadata, config is not self.config)
+        text = chunk_text(response)
+        if text:
+            return text
+        logger.warning(f"{self.model_id} answer is NO RESPONSE")
+        return NO_RESPONSE
+
+    async def generate_content_stream(self, query: str, files: List[Union[CachedImage, UploadedFile]] = None, timeout: float = None,
+                                      cache: PromptCache = None):
+        """Отдает ответ модели по частям по мере генерации."""
+        contents, config = self._request(query, files, cache)
+        logger.debug("%s streaming with query: %s, images: %d, pool: %s", self.model_id, Clip(query), len(files or ()),
+                     generation_pool.stats())
+
+        usage = None
+        yielded = False
+        try:
+            async for chunk in generation_pool.stream(
+                self.client.models.generate_content_stream,
+                model=self.model_id,
+                contents=contents,
+                config=config,
+                timeout=timeout
+            ):
+                usage = chunk.usage_metadata or usage  # итоговые счетчики приходят в последнем чанке
+                text = chunk_text(chunk)
+                if text:
+                    yielded = True
+                    yield text
+        except Exception as e:
+            if yielded or not self._cache_rejected(e, cache):
+                raise
+            async for text in self.generate_content_stream(query, files, timeout, cache):
+                yield text
+            return
+        self._record_usage(usage, config is not self.config)
+
+    async def create_cache(self, text: str, ttl: float) -> str:
+        """Создает в Gemini кэш из системной инструкции, инструментов и текста; возвращает имя кэша."""
+        cached = await generation_pool.run(
+            self.client.caches.create,
+            model=self.model_id,
+            config=CreateCachedContentConfig(
+                contents=[Content(role="user", parts=[Part(text=text)])],
+                system_instruction=self.config.system_instruction,
+                tools=self.config.tools,
+                ttl=f"{int(ttl)}s",
+            ),
+            timeout=self.spec.timeout,
         )
+        return cached.name
+
+    async def delete_cache(self, name: str):
+        await generation_pool.run(self.client.caches.delete, name=name, timeout=self.spec.timeout)
 
-        if response.candidates:
-            logger.debug(f"GeminiThinking model answer is CANDIDATES")
-            return response.candidates[0].content.parts[0].text
-        else:
-          logger.warning(f"GeminiThinking model answer is NO RESPONSE")
-          return "No response from Gemini"
\ No newline at end of file
+    def usage(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "output_tokens": self.output_tokens,
+        }
@@ -0,0 +1,160 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Union
+
+from dotenv import load_dotenv
+from sqlalchemy import delete
+
+from db import Database, GeminiFile
+from gemini_api import UploadedFile, generation_pool
+from gemini_resilience import GEMINI_TIMEOUT
+from image_cache import CachedImage
+
+load_dotenv()
+
+# Загружать изображения в Files API один раз и дальше ссылаться на них по URI, вместо байт в каждом запросе
+GEMINI_FILES_API = os.getenv("GEMINI_FILES_API", "1") == "1"
+# Файлы живут в Files API 48 часов; ссылка перестает использоваться заранее, чтобы не истечь посреди запроса
+GEMINI_FILE_TTL = timedelta(hours=48)
+GEMINI_FILE_EXPIRY_MARGIN = timedelta(hours=1)
+GEMINI_FILES_CACHE_SIZE = 10000
+PURGE_INTERVAL = 3600
+
+logger = logging.getLogger("bot.gemini_files")
+
+
+class GeminiFileUploader:
+    """Заменяет изображения запроса ссылками на файлы в Gemini Files API.
+
+    Файлы различаются по sha256 отправляемых байт, поэтому одно изображение загружается один раз, сколько бы
+    пользователей и запросов на него ни ссылались. Ссылки лежат в таблице gemini_files и в LRU в памяти;
+    истекшие загружаются заново. Если загрузка не удалась, изображение уходит в запрос байтами, как раньше.
+    """
+
+    def __init__(self, client, db: Database, cache_size: int = GEMINI_FILES_CACHE_SIZE):
+        self.client = client
+        self.db = db
+        self.cache_size = cache_size
+        self.refs: "OrderedDict[str, GeminiFile]" = OrderedDict()
+        self._uploads: Dict[str, asyncio.Future] = {}  # одна загрузка на хэш, остальные ждут ее результата
+        self._last_purge = time.monotonic()
+        # Метрики
+        self.uploaded = 0
+        self.reused = 0
+        self.reuploaded = 0
+        self.failed = 0
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+
+    async def resolve(self, files: List[CachedImage]) -> List[Union[CachedImage, UploadedFile]]:
+        return list(await asyncio.gather(*(self._resolve(image) for image in files)))
+
+    async def _resolve(self, image: CachedImage) -> Union[CachedImage, UploadedFile]:
+        sha256 = hashlib.sha256(image.data).hexdigest()
+        try:
+            ref = await self._lookup(sha256)
+            if ref is not None:
+                self.reused += 1
+                self.bytes_saved += len(image.data)
+            else:
+                upload = self._uploads.get(sha256)
+                if upload is None:
+                    upload = self._uploads[sha256] = asyncio.ensure_future(self._upload(sha256, image))
+                    upload.add_done_callback(lambda _: self._uploads.pop(sha256, None))
+                ref = await asyncio.shield(upload)
+            return UploadedFile(ref.uri, ref.mime_type, image.file_id)
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Files API upload failed for image {image.file_id}, sending it inline: {e}")
+            return image
+
+    @staticmethod
+    def _valid(ref: GeminiFile) -> bool:
+        return ref.expires_at - GEMINI_FILE_EXPIRY_MARGIN > datetime.utcnow()
+
+    async def _lookup(self, sha256: str) -> Optional[GeminiFile]:
+        ref = self.refs.get(sha256)
+        if ref is None:
+            async with self.db.Session() as session:
+                ref = await session.get(GeminiFile, sha256)
+            if ref is None:
+                return None
+            self._remember(ref)
+        else:
+            self.refs.move_to_end(sha256)
+        if not self._valid(ref):
+            self.reuploaded += 1
+            return None
+        return ref
+
+    def _remember(self, ref: GeminiFile):
+        self.refs[ref.sha256] = ref
+        self.refs.move_to_end(ref.sha256)
+        while len(self.refs) > self.cache_size:
+            self.refs.popitem(last=False)
+
+    async def _upload(self, sha256: str, image: CachedImage) -> GeminiFile:
+        started = time.perf_counter()
+        # SDK загружает только файлы с диска
+        path = await asyncio.to_thread(self._write_temp, image.data)
+        try:
+            uploaded = await generation_pool.run(
+                self.client.files.upload,
+                path=path,
+                config={"mime_type": image.mime_type, "display_name": sha256},
+                timeout=GEMINI_TIMEOUT,
+            )
+        finally:
+            await asyncio.to_thread(os.remove, path)
+
+        expires_at = uploaded.expiration_time
+        if expires_at is not None:
+            expires_at = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+        else:
+            expires_at = datetime.utcnow() + GEMINI_FILE_TTL
+        ref = GeminiFile(sha256=sha256, name=uploaded.name, uri=uploaded.uri, mime_type=uploaded.mime_type or image.mime_type,
+                         size=len(image.data), expires_at=expires_at, created_at=datetime.utcnow())
+        async with self.db.Session() as session:
+            await session.merge(ref)
+            await session.commit()
+        self._remember(ref)
+        self.uploaded += 1
+        self.bytes_uploaded += len(image.data)
+        logger.info(f"Uploaded image {image.file_id} to Files API as {uploaded.name}, {len(image.data)} bytes, "
+                    f"{(time.perf_counter() - started) * 1000:.0f} ms")
+        await self._purge_expired()
+        return ref
+
+    @staticmethod
+    def _write_temp(data: bytes) -> str:
+        with tempfile.NamedTemporaryFile(prefix="gemini_upload_", delete=False) as f:
+            f.write(data)
+            return f.name
+
+    async def _purge_expired(self):
+        """Не чаще раза в PURGE_INTERVAL удаляет из базы ссылки на истекшие файлы."""
+        if time.monotonic() - self._last_purge < PURGE_INTERVAL:
+            return
+        self._last_purge = time.monotonic()
+        async with self.db.Session() as session:
+            result = await session.execute(delete(GeminiFile).where(GeminiFile.expires_at < datetime.utcnow()))
+            await session.commit()
+        if result.rowcount:
+            logger.info(f"Purged {result.rowcount} expired Files API references")
+
+    def stats(self) -> dict:
+        return {
+            "cached_refs": len(self.refs),
+            "uploaded": self.uploaded,
+            "reused": self.reused,
+            "reuploaded": self.reuploaded,
+            "failed": self.failed,
+            "bytes_uploaded": self.bytes_uploaded,
+            "bytes_saved": self.bytes_saved,
+        }
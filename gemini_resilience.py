@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import requests
+from dotenv import load_dotenv
+from google.genai import errors
+
+load_dotenv()
+
+# Таймаут одной попытки (для потока - максимальная пауза между чанками) и общий срок на весь запрос с повторами
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+GEMINI_DEADLINE = float(os.getenv("GEMINI_DEADLINE", "120"))
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "3"))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1"))
+GEMINI_BACKOFF_MAX = 10.0
+# Сколько сбоев подряд размыкают предохранитель модели и через сколько секунд пробовать снова
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5"))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+GEMINI_FALLBACK = os.getenv("GEMINI_FALLBACK", "1") == "1"
+
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+
+logger = logging.getLogger("gemini_api.resilience")
+
+
+class CircuitOpenError(Exception):
+    """Модель временно отключена предохранителем."""
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_CODES
+    return isinstance(error, (asyncio.TimeoutError, requests.ConnectionError, requests.Timeout))
+
+
+def backoff_delay(attempt: int) -> float:
+    return min(GEMINI_BACKOFF_MAX, GEMINI_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold сбоев подряд; через reset_timeout пропускает один пробный запрос."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = GEMINI_BREAKER_FAILURES,
+                 reset_timeout: float = GEMINI_BREAKER_RESET):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            logger.info(f"Circuit {self.name}: half-open, sending probe request")
+            return True
+        return False  # разомкнут или пробный запрос уже идет
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit {self.name}: closed")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+                logger.warning(f"Circuit {self.name}: open after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Попытка завершилась без вердикта (ошибкой запроса, отменой) - пробный слот освобождается."""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+
+class ResilientModel:
+    """Обертка над GeminiModel: таймауты, повторы с разбросом, предохранитель и запасная модель.
+
+    Повторяются только временные ошибки (429, 5xx, таймауты, обрывы соединения). Поток повторяется,
+    только пока пользователю не отдан ни один чанк.
+    """
+
+    def __init__(self, model, fallback: "ResilientModel" = None, timeout: float = GEMINI_TIMEOUT,
+                 deadline: float = GEMINI_DEADLINE, retries: int = GEMINI_RETRIES):
+        if retries < 1:
+            raise ValueError(f"{model.model_id}: retries must be at least 1, got {retries}")
+        self.model = model
+        self.model_id = model.model_id
+        self.fallback = fallback if GEMINI_FALLBACK else None
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.breaker = CircuitBreaker(model.model_id)
+        self.calls = 0
+        self.retried = 0
+        self.failed = 0
+        self.fallbacks = 0
+
+    def _target(self):
+        """Модель для нового запроса: своя, запасная, если предохранитель разомкнут, или ошибка."""
+        if self.breaker.allow():
+            return self
+        if self.fallback:
+            self.fallbacks += 1
+            logger.warning(f"Circuit {self.model_id} is open, falling back to {self.fallback.model_id}")
+            return self.fallback
+        raise CircuitOpenError(f"Модель {self.model_id} временно недоступна")
+
+    async def generate_content(self, query: str, files=None, cache=None) -> str:
+        target = self._target()
+        if target is not self:
+            return await target.generate_content(query, files, cache)
+
+        self.calls += 1
+        started = time.monotonic()
+        succeeded = False
+        try:
+            for attempt in range(self.retries):
+                remaining = self.deadline - (time.monotonic() - started)
+                try:
+                    result = await self.model.generate_content(query, files, timeout=min(self.timeout, remaining),
+                                                               cache=cache)
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, started)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                self.breaker.record_success()
+                succeeded = True
+                return result
+            raise RuntimeError(f"{self.model_id}: no attempts were made")
+        finally:
+            if not succeeded:
+                # Отмена (WORK_POLICY=cancel, остановка) не дает вердикта - пробный слот нельзя оставлять занятым
+                self.breaker.release()
+
+    async def generate_content_stream(self, query: str, files=None, cache=None):
+        target = self._target()
+        if target is not self:
+            async for text in target.generate_content_stream(query, files, cache):
+                yield text
+            return
+
+        self.calls += 1
+        started = time.monotonic()
+        succeeded = False
+        try:
+            for attempt in range(self.retries):
+                yielded = False
+                # Ожидание слота в пуле тоже укладывается в общий срок
+                remaining = self.deadline - (time.monotonic() - started)
+                try:
+                    async for text in self.model.generate_content_stream(query, files,
+                                                                         timeout=min(self.timeout, remaining),
+                                                                         cache=cache):
+                        yielded = True
+                        yield text
+                except Exception as e:
+                    if yielded:
+                        # Часть ответа уже показана - повтор продублировал бы текст
+                        self._record(e)
+                        self.failed += 1
+                        raise
+                    delay = self._retry_delay(e, attempt, started)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                self.breaker.record_success()
+                succeeded = True
+                return
+            raise RuntimeError(f"{self.model_id}: no attempts were made")
+        finally:
+            if not succeeded:
+                # Отмена или закрытый поток (GeneratorExit) тоже должны освободить пробный слот
+                self.breaker.release()
+
+    def _record(self, error: Exception):
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            self.breaker.release()
+
+    def _retry_delay(self, error: Exception, attempt: int, started: float):
+        """Учитывает ошибку в предохранителе и возвращает паузу перед повтором или None, если повторять не стоит."""
+        self._record(error)
+        delay = backoff_delay(attempt)
+        retry = (is_retryable(error) and attempt < self.retries - 1 and self.breaker.allow()
+                 and time.monotonic() - started + delay < self.deadline)
+        if not retry:
+            self.failed += 1
+            logger.error(f"{self.model_id}: giving up after {attempt + 1} attempts: {error!r}")
+            return None
+        self.retried += 1
+        logger.warning(f"{self.model_id}: attempt {attempt + 1}/{self.retries} failed: {error!r}, retry in {delay:.1f}s")
+        return delay
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model_id,
+            "circuit": self.breaker.state,
+            "trips": self.breaker.trips,
+            "calls": self.calls,
+            "retried": self.retried,
+            "failed": self.failed,
+            "fallbacks": self.fallbacks,
+            **self.model.usage(),
+        }
@@ -0,0 +1,125 @@
+import logging
+import os
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import aiofiles
+from dotenv import load_dotenv
+
+from state import MemoryBackend, StateBackend
+
+load_dotenv()
+
+# Сколько байт закодированных изображений держать в памяти
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Сколько хранить изображения в общем StateBackend, чтобы их видели другие воркеры
+IMAGE_BLOB_TTL = float(os.getenv("IMAGE_BLOB_TTL", str(7 * 24 * 3600)))
+
+logger = logging.getLogger("bot.image_cache")
+
+
+class CachedImage(NamedTuple):
+    """Готовые к отправке в Gemini байты изображения и их MIME-тип."""
+    data: bytes
+    mime_type: str
+    file_id: Optional[str] = None
+
+
+def detect_mime_type(data: bytes) -> str:
+    """Определяет MIME-тип изображения по сигнатуре файла."""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return "image/jpeg"  # Telegram отдает фото в JPEG
+
+
+class ImageCache:
+    """LRU-кэш изображений по file_id Telegram, ограниченный суммарным размером в байтах.
+
+    Промахи читаются с локального диска, а если его нет (изображение скачал другой воркер) - из общего StateBackend.
+    """
+
+    def __init__(self, max_bytes: int = IMAGE_CACHE_MAX_BYTES, blobs: StateBackend = None):
+        self.max_bytes = max_bytes
+        self.blobs = blobs or MemoryBackend()
+        self.items: "OrderedDict[str, CachedImage]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.blob_hits = 0
+
+    def __contains__(self, file_id: str) -> bool:
+        return file_id in self.items
+
+    def get(self, file_id: str) -> Optional[CachedImage]:
+        image = self.items.get(file_id)
+        if image is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(file_id)
+        self.hits += 1
+        return image
+
+    def put(self, file_id: str, image: CachedImage):
+        if len(image.data) > self.max_bytes:
+            return  # Не вытесняем весь кэш ради одного огромного файла
+        self.discard(file_id)
+        self.items[file_id] = image
+        self.size += len(image.data)
+        while self.size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= len(evicted.data)
+            self.evictions += 1
+
+    def discard(self, file_id: str):
+        image = self.items.pop(file_id, None)
+        if image is not None:
+            self.size -= len(image.data)
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+    async def save(self, image: CachedImage):
+        """Кладет только что скачанное изображение в кэш и, если хранилище общее, в StateBackend."""
+        self.put(image.file_id, image)
+        if self.blobs.shared:
+            await self.blobs.set(f"image:{image.file_id}", image.data, ttl=IMAGE_BLOB_TTL)
+
+    async def load(self, file_id: str, file_path: str) -> Optional[CachedImage]:
+        """Возвращает изображение из кэша, при промахе читает его с диска или из общего хранилища."""
+        image = self.get(file_id)
+        if image is not None:
+            return image
+        try:
+            async with aiofiles.open(file_path, "rb") as f:
+                data = await f.read()
+        except FileNotFoundError:
+            data = await self.blobs.get(f"image:{file_id}") if self.blobs.shared else None
+            if data is None:
+                logger.error(f"Image {file_id} not found on disk or in shared storage")
+                return None
+            self.blob_hits += 1
+        except Exception as e:
+            logger.error(f"Error loading image from disk: {e}")
+            return None
+        image = CachedImage(data, detect_mime_type(data), file_id)
+        self.put(file_id, image)
+        return image
+
+    def stats(self) -> dict:
+        return {
+            "items": len(self.items),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "blob_hits": self.blob_hits,
+        }
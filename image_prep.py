@@ -0,0 +1,98 @@
+import asyncio
+import io
+import logging
+import os
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+from PIL import Image
+
+from image_cache import CachedImage, ImageCache
+
+load_dotenv()
+
+# Максимальная сторона изображения и общий бюджет байт изображений на один запрос к Gemini
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1536"))
+IMAGE_REQUEST_BUDGET = int(os.getenv("IMAGE_REQUEST_BUDGET", str(4 * 1024 * 1024)))
+IMAGE_PREP_CACHE_BYTES = int(os.getenv("IMAGE_PREP_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+JPEG_QUALITIES = (85, 75, 65, 50, 40)
+MIN_EDGE = 384
+
+logger = logging.getLogger("bot.image_prep")
+
+
+@dataclass
+class ImagePrepStats:
+    images: int = 0
+    resized: int = 0
+    cache_hits: int = 0
+    bytes_before: int = 0
+    bytes_after: int = 0
+
+
+def fit_image(image: CachedImage, max_edge: int, max_bytes: int) -> CachedImage:
+    """Уменьшает изображение до max_edge и подбирает качество JPEG, чтобы уложиться в max_bytes."""
+    with Image.open(io.BytesIO(image.data)) as source:
+        # Размер известен из заголовка, декодировать файл для проверки не нужно
+        if max(source.size) <= max_edge and len(image.data) <= max_bytes:
+            return image
+        if source.format == "JPEG":
+            source.draft("RGB", (max_edge, max_edge))  # JPEG декодируется сразу в уменьшенном масштабе
+        picture = source.convert("RGB")
+
+    edge = max_edge
+    while True:
+        if max(picture.size) > edge:
+            picture.thumbnail((edge, edge), Image.Resampling.BILINEAR)
+        for quality in JPEG_QUALITIES:
+            output = io.BytesIO()
+            picture.save(output, format="JPEG", quality=quality)
+            if output.tell() <= max_bytes:
+                return CachedImage(output.getvalue(), "image/jpeg", image.file_id)
+        if edge <= MIN_EDGE:
+            # Меньше уже не ужимаем, отдаем самый компактный вариант
+            return CachedImage(output.getvalue(), "image/jpeg", image.file_id)
+        edge = max(int(edge * 0.75), MIN_EDGE)
+
+
+class ImagePreprocessor:
+    """Готовит изображения запроса к отправке: ограничивает размер и общий объем в байтах."""
+
+    def __init__(self, max_edge: int = IMAGE_MAX_EDGE, request_budget: int = IMAGE_REQUEST_BUDGET,
+                 cache_bytes: int = IMAGE_PREP_CACHE_BYTES):
+        self.max_edge = max_edge
+        self.request_budget = request_budget
+        self.cache = ImageCache(max_bytes=cache_bytes)
+
+    async def prepare(self, files: List[CachedImage], shared_budget: bool = True) -> Tuple[List[CachedImage], ImagePrepStats]:
+        """shared_budget=False ограничивает каждое изображение всем бюджетом сразу: для загрузки в Files API,
+        где размер запроса не растет с числом изображений, а одинаковые байты позволяют не загружать файл повторно."""
+        stats = ImagePrepStats(images=len(files))
+        if not files:
+            return files, stats
+
+        max_bytes = self.request_budget // len(files) if shared_budget else self.request_budget
+        prepared = []
+        for image in files:
+            stats.bytes_before += len(image.data)
+            key = f"{image.file_id}:{self.max_edge}:{max_bytes}" if image.file_id else None
+            result = self.cache.get(key) if key else None
+            if result is not None:
+                stats.cache_hits += 1
+                stats.resized += 1
+            else:
+                try:
+                    result = await asyncio.to_thread(fit_image, image, self.max_edge, max_bytes)
+                except Exception as e:
+                    logger.error(f"Error preprocessing image {image.file_id}: {e}")
+                    result = image
+                if result is not image:
+                    stats.resized += 1
+                    # Кэшируются только измененные изображения, исходные и так лежат в ImageCache
+                    if key:
+                        self.cache.put(key, result)
+            stats.bytes_after += len(result.data)
+            prepared.append(result)
+        return prepared, stats
@@ -0,0 +1,363 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterable, Dict, List, Optional, Tuple
+
+import aiofiles
+import aiofiles.os
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, or_, select, tuple_, update
+
+from background import BackgroundTasks
+from db import Database, UserHistory, UserImage
+from image_cache import CachedImage, ImageCache, detect_mime_type
+
+load_dotenv()
+
+# Лимиты диска: на одного пользователя и на все хранилище (уникальные файлы)
+IMAGE_USER_QUOTA_BYTES = int(os.getenv("IMAGE_USER_QUOTA_BYTES", str(50 * 1024 * 1024)))
+IMAGE_GLOBAL_QUOTA_BYTES = int(os.getenv("IMAGE_GLOBAL_QUOTA_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Изображения, к которым не обращались дольше, удаляются сборщиком мусора
+IMAGE_MAX_AGE_DAYS = float(os.getenv("IMAGE_MAX_AGE_DAYS", "30"))
+IMAGE_GC_INTERVAL = float(os.getenv("IMAGE_GC_INTERVAL", "3600"))
+# Недавно скачанные изображения GC не трогает: ответ с ними еще может не попасть в историю
+IMAGE_GC_GRACE = timedelta(hours=1)
+TOUCH_FLUSH_SIZE = 1000
+DELETE_BATCH = 500
+GC_BATCH = 500  # пользователей и записей истории за один запрос сборщика мусора
+
+EXTENSIONS = {"image/jpeg": "jpg", "image/png": "png", "image/webp": "webp", "image/gif": "gif"}
+
+logger = logging.getLogger("bot.image_store")
+
+
+class ImageStore:
+    """Хранилище изображений пользователей с адресацией по содержимому.
+
+    Файл лежит по sha256 в двухуровневых подкаталогах (ab/cd/abcd....jpg), одинаковые изображения хранятся
+    один раз. Какие file_id есть у пользователя, сколько они весят и когда использовались, хранится в таблице
+    user_images, поэтому квоты, LRU и сборка мусора не требуют обхода каталогов.
+    """
+
+    def __init__(self, db: Database, root: str, cache: ImageCache,
+                 user_quota: int = IMAGE_USER_QUOTA_BYTES, global_quota: int = IMAGE_GLOBAL_QUOTA_BYTES,
+                 max_age_days: float = IMAGE_MAX_AGE_DAYS):
+        self.db = db
+        self.root = root
+        self.partial_dir = os.path.join(root, "partial")
+        self.cache = cache
+        self.user_quota = user_quota
+        self.global_quota = global_quota
+        self.max_age = timedelta(days=max_age_days)
+        self._touched: Dict[Tuple[int, str], datetime] = {}  # last_used копится в памяти и пишется пачкой
+        self._task = None
+        # Сохранение и удаление файлов по одному sha256 не должны перекрываться: иначе удаление может снести файл,
+        # который другой пользователь только что сохранил и посчитал уже лежащим на диске
+        self._files_lock = asyncio.Lock()
+        self._flushes = BackgroundTasks()  # записи last_used, запущенные из _touch
+        # Метрики
+        self.saved = 0
+        self.deduplicated = 0
+        self.evicted = 0
+        self.files_deleted = 0
+        self.gc_runs = 0
+        self.last_gc_ms = 0.0
+
+    def path(self, sha256: str, mime_type: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], f"{sha256}.{EXTENSIONS.get(mime_type, 'bin')}")
+
+    def legacy_path(self, file_id: str) -> str:
+        """Раньше все фото лежали плоско в photos/{file_id}.jpg."""
+        return os.path.join(self.root, f"{file_id}.jpg")
+
+    async def save(self, user_id: int, file_id: str, data: bytes) -> CachedImage:
+        async def single():
+            yield data
+        return await self.save_stream(user_id, file_id, single())
+
+    async def save_stream(self, user_id: int, file_id: str, chunks: AsyncIterable[bytes]) -> CachedImage:
+        """Пишет изображение на диск по мере прихода чанков, считая sha256 на ходу, и добавляет его пользователю.
+
+        Запись идет во временный файл в partial/ и переименованием переносится на место: читатели не увидят
+        недописанный файл. В памяти остаются только байты для модели.
+        """
+        await aiofiles.os.makedirs(self.partial_dir, exist_ok=True)
+        tmp_path = os.path.join(self.partial_dir, f"{os.getpid()}.{uuid.uuid4().hex}.tmp")
+        hasher = hashlib.sha256()
+        parts = []
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    hasher.update(chunk)
+                    parts.append(chunk)
+                    await f.write(chunk)
+            data = parts[0] if len(parts) == 1 else b"".join(parts)
+            return await self._commit(user_id, file_id, data, hasher.hexdigest(), tmp_path)
+        finally:
+            try:
+                await aiofiles.os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    async def _commit(self, user_id: int, file_id: str, data: bytes, sha256: str, tmp_path: str) -> CachedImage:
+        image = CachedImage(data, detect_mime_type(data), file_id)
+        now = datetime.utcnow()
+        path = self.path(sha256, image.mime_type)
+        async with self._files_lock:
+            # Сначала запись в базе: сборщик мусора не удалит файл, на который уже есть ссылка
+            async with self.db.Session() as session:
+                await session.merge(UserImage(user_id=user_id, file_id=file_id, sha256=sha256, size=len(data),
+                                              mime_type=image.mime_type, created_at=now, last_used=now))
+                await session.commit()
+
+            if await aiofiles.os.path.exists(path):
+                self.deduplicated += 1
+            else:
+                await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+                await aiofiles.os.replace(tmp_path, path)
+        self.saved += 1
+        await self.cache.save(image)
+        await self.enforce_user_quota(user_id, keep=file_id)
+        return image
+
+    async def load(self, user_id: int, file_id: str) -> Optional[CachedImage]:
+        image = self.cache.get(file_id)
+        if image is None:
+            async with self.db.Session() as session:
+                record = await session.get(UserImage, (user_id, file_id))
+            if record is not None:
+                # Если файла нет на диске (его скачал другой воркер), ImageCache возьмет его из общего хранилища
+                image = await self.cache.load(file_id, self.path(record.sha256, record.mime_type))
+            else:
+                image = await self._import_legacy(user_id, file_id)
+        if image is not None:
+            self._touch(user_id, file_id)
+        return image
+
+    async def _import_legacy(self, user_id: int, file_id: str) -> Optional[CachedImage]:
+        """Переносит фото из старой плоской папки в хранилище при первом обращении."""
+        legacy_path = self.legacy_path(file_id)
+        if not await aiofiles.os.path.exists(legacy_path):
+            return await self.cache.load(file_id, legacy_path) if self.cache.blobs.shared else None
+        async with aiofiles.open(legacy_path, "rb") as f:
+            data = await f.read()
+        image = await self.save(user_id, file_id, data)
+        await aiofiles.os.remove(legacy_path)
+        logger.info(f"Imported legacy image {file_id} for user {user_id}")
+        return image
+
+    def _touch(self, user_id: int, file_id: str):
+        self._touched[(user_id, file_id)] = datetime.utcnow()
+        if len(self._touched) >= TOUCH_FLUSH_SIZE:
+            self._flushes.spawn(self.flush_touches())
+
+    async def flush_touches(self):
+        """Записывает накопленные last_used одной транзакцией."""
+        touched, self._touched = self._touched, {}
+        if not touched:
+            return
+        async with self.db.Session() as session:
+            for (user_id, file_id), last_used in touched.items():
+                await session.execute(update(UserImage)
+                                      .where(UserImage.user_id == user_id, UserImage.file_id == file_id)
+                                      .values(last_used=last_used))
+            await session.commit()
+
+    async def clear_user(self, user_id: int):
+        """Удаляет изображения пользователя; файлы, на которые ссылаются другие пользователи, остаются."""
+        async with self.db.Session() as session:
+            rows = (await session.execute(select(UserImage.user_id, UserImage.file_id, UserImage.sha256, UserImage.mime_type)
+                                          .where(UserImage.user_id == user_id))).all()
+        await self._delete(rows)
+        logger.info(f"Images cleared for user {user_id}: {len(rows)} files")
+
+    async def enforce_user_quota(self, user_id: int, keep: str = None):
+        """Вытесняет давно не использованные изображения пользователя, пока он не уложится в квоту."""
+        async with self.db.Session() as session:
+            total = await session.scalar(select(func.coalesce(func.sum(UserImage.size), 0))
+                                         .where(UserImage.user_id == user_id))
+        if total <= self.user_quota:
+            return
+        await self.flush_touches()
+        async with self.db.Session() as session:
+            rows = (await session.execute(select(UserImage.user_id, UserImage.file_id, UserImage.sha256,
+                                                 UserImage.mime_type, UserImage.size)
+                                          .where(UserImage.user_id == user_id, UserImage.file_id != keep)
+                                          .order_by(UserImage.last_used))).all()
+        victims = []
+        for row in rows:
+            if total <= self.user_quota:
+                break
+            victims.append(row[:4])
+            total -= row.size
+        self.evicted += len(victims)
+        await self._delete(victims)
+        logger.info(f"User {user_id} is over the image quota, evicted {len(victims)} least recently used images")
+
+    async def enforce_global_quota(self) -> int:
+        """Вытесняет файлы, к которым дольше всех не обращался ни один пользователь. Возвращает размер хранилища."""
+        async with self.db.Session() as session:
+            blobs = (await session.execute(select(UserImage.sha256, func.max(UserImage.size).label("size"))
+                                           .group_by(UserImage.sha256)
+                                           .order_by(func.max(UserImage.last_used)))).all()
+        total = sum(blob.size for blob in blobs)
+        if total <= self.global_quota:
+            return total
+        hashes = []
+        for sha256, size in blobs:
+            if total <= self.global_quota:
+                break
+            hashes.append(sha256)
+            total -= size
+        victims = []
+        async with self.db.Session() as session:
+            for start in range(0, len(hashes), DELETE_BATCH):
+                victims += (await session.execute(
+                    select(UserImage.user_id, UserImage.file_id, UserImage.sha256, UserImage.mime_type)
+                    .where(UserImage.sha256.in_(hashes[start:start + DELETE_BATCH])))).all()
+        self.evicted += len(victims)
+        await self._delete(victims)
+        logger.info(f"Image store is over the global quota, evicted {len(hashes)} files ({len(victims)} images)")
+        return total
+
+    async def _delete(self, rows: List[Tuple[int, str, str, str]]):
+        """Удаляет записи (user_id, file_id, sha256, mime_type) и файлы, на которые больше никто не ссылается."""
+        for start in range(0, len(rows), DELETE_BATCH):
+            batch = rows[start:start + DELETE_BATCH]
+            keys = [(user_id, file_id) for user_id, file_id, _, _ in batch]
+            hashes = list({sha256 for _, _, sha256, _ in batch})
+            async with self._files_lock:
+                async with self.db.Session() as session:
+                    await session.execute(delete(UserImage).where(tuple_(UserImage.user_id, UserImage.file_id).in_(keys)))
+                    still_used = set((await session.scalars(
+                        select(UserImage.sha256).distinct().where(UserImage.sha256.in_(hashes)))).all())
+                    await session.commit()
+                for sha256, mime_type in {(sha256, mime_type) for _, _, sha256, mime_type in batch}:
+                    if sha256 in still_used:
+                        continue
+                    try:
+                        await aiofiles.os.remove(self.path(sha256, mime_type))
+                        self.files_deleted += 1
+                    except FileNotFoundError:
+                        pass
+            for user_id, file_id, _, _ in batch:
+                self._touched.pop((user_id, file_id), None)
+                self.cache.discard(file_id)
+
+    async def collect_garbage(self):
+        """Удаляет устаревшие изображения и те, что не упоминаются в истории, затем применяет общую квоту.
+
+        Пользователи обходятся пачками по GC_BATCH, а их история читается страницами по id, поэтому память
+        и длина одного запроса не зависят от размера таблиц.
+        """
+        started = time.perf_counter()
+        await self.flush_touches()
+        now = datetime.utcnow()
+        removed = 0
+        last_user = None
+        while True:
+            users = await self._gc_users(now, last_user)
+            if not users:
+                break
+            removed += await self._collect_users(users, now)
+            last_user = users[-1]
+
+        total = await self.enforce_global_quota()
+        removed_legacy = await asyncio.to_thread(self._remove_legacy_files, now - self.max_age)
+        await asyncio.to_thread(self._remove_partial_files, now - IMAGE_GC_GRACE)
+        self.gc_runs += 1
+        self.last_gc_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"Image GC: removed {removed} unreferenced or expired images, {removed_legacy} legacy files, "
+                    f"store {total} bytes, {self.last_gc_ms:.0f} ms")
+
+    def _gc_condition(self, now: datetime):
+        # Недавно скачанные изображения пропускаются: ответ с ними еще может быть не записан в историю
+        return or_(UserImage.last_used < now - self.max_age, UserImage.created_at < now - IMAGE_GC_GRACE)
+
+    async def _gc_users(self, now: datetime, after: Optional[int]) -> List[int]:
+        """Следующая пачка пользователей, у которых есть кандидаты на удаление."""
+        query = select(UserImage.user_id).distinct().where(self._gc_condition(now))
+        if after is not None:
+            query = query.where(UserImage.user_id > after)
+        async with self.db.Session() as session:
+            return list((await session.scalars(query.order_by(UserImage.user_id).limit(GC_BATCH))).all())
+
+    async def _collect_users(self, users: List[int], now: datetime) -> int:
+        async with self.db.Session() as session:
+            images = (await session.execute(select(UserImage.user_id, UserImage.file_id, UserImage.sha256,
+                                                   UserImage.mime_type, UserImage.last_used)
+                                            .where(UserImage.user_id.in_(users), self._gc_condition(now)))).all()
+            unreferenced = {(row.user_id, row.file_id) for row in images if row.last_used >= now - self.max_age}
+            last_id = 0
+            # История читается, только пока остаются изображения без ссылок
+            while unreferenced:
+                history = (await session.execute(select(UserHistory.id, UserHistory.user_id, UserHistory.image_ids)
+                                                 .where(UserHistory.user_id.in_(users), UserHistory.id > last_id,
+                                                        UserHistory.image_ids.is_not(None), UserHistory.image_ids != "")
+                                                 .order_by(UserHistory.id).limit(GC_BATCH))).all()
+                if not history:
+                    break
+                for _, user_id, image_ids in history:
+                    unreferenced.difference_update((user_id, file_id) for file_id in image_ids.split(","))
+                last_id = history[-1].id
+
+        victims = [(row.user_id, row.file_id, row.sha256, row.mime_type) for row in images
+                   if row.last_used < now - self.max_age or (row.user_id, row.file_id) in unreferenced]
+        await self._delete(victims)
+        return len(victims)
+
+    def _remove_legacy_files(self, cutoff: datetime) -> int:
+        """Старые файлы плоской раскладки: просматривается только верхний уровень, и он со временем пустеет."""
+        removed = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".jpg") and \
+                        datetime.utcfromtimestamp(entry.stat().st_mtime) < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+    def _remove_partial_files(self, cutoff: datetime):
+        """Недописанные файлы, оставшиеся после падения процесса посреди скачивания."""
+        try:
+            with os.scandir(self.partial_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and datetime.utcfromtimestamp(entry.stat().st_mtime) < cutoff:
+                        os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def start(self, interval: float = IMAGE_GC_INTERVAL):
+        self._task = asyncio.create_task(self._run(interval), name="image_gc")
+
+    async def _run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.collect_garbage()
+            except Exception as e:
+                logger.exception(f"Image GC failed: {e}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._flushes.wait()
+        await self.flush_touches()
+
+    def stats(self) -> dict:
+        return {
+            "saved": self.saved,
+            "deduplicated": self.deduplicated,
+            "evicted": self.evicted,
+            "files_deleted": self.files_deleted,
+            "gc_runs": self.gc_runs,
+            "last_gc_ms": self.last_gc_ms,
+        }
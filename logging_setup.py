@@ -0,0 +1,137 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Все логи пишутся одним фоновым потоком: обработчик в event loop только кладет запись в очередь
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+# Длинные сообщения (промпты, история) обрезаются; DEBUG-записи можно писать выборочно, например 0.1 - каждую десятую
+LOG_MAX_MESSAGE_CHARS = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "4000"))
+LOG_DEBUG_SAMPLE = float(os.getenv("LOG_DEBUG_SAMPLE", "1"))
+LOG_QUEUE_SIZE = 10000
+
+FILE_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+CONSOLE_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+
+# Логгер -> файл; дочерние логгеры (bot.sessions, gemini_api.resilience) пишут в файл родителя
+LOG_FILES = {
+    "bot": "bot.log",
+    "db": "db.log",
+    "gemini_api": "gemini_api.log",
+}
+
+_listener = None
+
+
+class Clip:
+    """Аргумент лога, который обрезается только если запись действительно будет записана.
+
+    logger.debug("Prompt: %s", Clip(prompt_text)) не строит строку, когда DEBUG выключен.
+    """
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value, limit: int = None):
+        self.value = value
+        self.limit = limit or LOG_MAX_MESSAGE_CHARS
+
+    def __str__(self):
+        text = str(self.value)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... [{len(text) - self.limit} more chars]"
+
+
+class DebugSampler(logging.Filter):
+    """Пропускает только долю DEBUG-записей; записи важнее DEBUG проходят всегда."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который ограничивает длину сообщения и не блокирует, если очередь переполнена."""
+
+    def __init__(self, log_queue, max_chars: int):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        # Ошибки с трейсбеком не обрезаются
+        if record.levelno <= logging.INFO and len(record.msg) > self.max_chars:
+            record.msg = f"{record.msg[:self.max_chars]}... [{len(record.msg) - self.max_chars} more chars]"
+            record.message = record.msg
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    """Настраивает логгеры бота один раз при запуске: файлы с ротацией по размеру, консоль и фоновую запись."""
+    global _listener
+    if _listener is not None:
+        return
+    os.makedirs(LOG_DIR, exist_ok=True)
+    level = getattr(logging, LOG_LEVEL, logging.DEBUG)
+
+    handlers = []
+    for name, file_name in LOG_FILES.items():
+        file_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(LOG_DIR, file_name), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8")
+        file_handler.setLevel(level)
+        file_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+        file_handler.addFilter(logging.Filter(name))
+        handlers.append(file_handler)
+
+    # Консоль: INFO и выше от бота и короткие строки "пользователь - запрос - ответ" от логгера console
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    console_handler.addFilter(logging.Filter("bot"))
+    handlers.append(console_handler)
+
+    dialog_handler = logging.StreamHandler()
+    dialog_handler.setLevel(logging.INFO)
+    dialog_handler.setFormatter(logging.Formatter('%(message)s'))
+    dialog_handler.addFilter(logging.Filter("console"))
+    handlers.append(dialog_handler)
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = TruncatingQueueHandler(log_queue, LOG_MAX_MESSAGE_CHARS)
+    queue_handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE))
+    for name in [*LOG_FILES, "console"]:
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO if name == "console" else level)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает фоновый поток."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
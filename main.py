@@ -1,56 +1,59 @@
-import io
 import asyncio
 import logging
 import os
 import re
+import hashlib
 import html
+import io
+import json
+import signal
+import time
+from typing import List, NamedTuple, Optional
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
 from dotenv import load_dotenv
-from PIL import Image
-from gemini_api import Gemini, GeminiThinking
+from logging_setup import Clip, setup_logging
+from metrics import current_trace, registry as metrics, stage, timed, trace_request
+from gemini_api import NO_RESPONSE, PromptCache, generation_pool
+from gemini_files import GEMINI_FILES_API, GeminiFileUploader
+from gemini_resilience import CircuitOpenError
+from model_registry import ModelRegistry
 from db import Database
-import aiofiles
-import aiofiles.os
+from context import ContextWindow
+from context_cache import ContextCacheManager
+from response_cache import ResponseCache, response_key
+from formatting import render_html, utf16_len, MAX_MESSAGE_LENGTH
+from sessions import SessionStore
+from image_cache import ImageCache
+from image_store import ImageStore
+from image_prep import ImagePreprocessor
+from telegram_send import MessageSender, SendLimiter
+from work_queue import UserWorkQueue
+from debounce import DebounceScheduler
+from state import create_backend
+from routing import FORWARDED_HEADER, SECRET_HEADER, WorkerRouter, update_user_id
 
 
 load_dotenv()
 
 TELEGRAM_API_KEY = os.getenv("TELEGRAM_TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID"))  # Получаем ADMIN_ID из переменных окружения
-
-# Настройка логирования
-LOG_DIR = "logs"
-LOG_FILE = os.path.join(LOG_DIR, "bot.log")
-os.makedirs(LOG_DIR, exist_ok=True)
-
-# Настройка базового логгера
+# Режим webhook включается, если задан WEBHOOK_URL; иначе бот работает через long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT") or (8080 if WEBHOOK_URL else 0))  # 0 - HTTP-сервер в режиме polling не нужен
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "60"))  # сколько ждать завершения начатых ответов
+
+# Логи пишутся в фоновом потоке, настройки - в logging_setup.py
+setup_logging()
 logger = logging.getLogger("bot")
-logger.setLevel(logging.DEBUG)  # Устанавливаем общий уровень логирования DEBUG
-
-# Создание обработчика для записи в файл
-file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
-file_handler.setLevel(logging.DEBUG)  # Все пишем в файл
-file_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
-
-# Создание обработчика для вывода в консоль
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)  # Только INFO и выше в консоль
-console_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
-console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
-
-# Новый логгер для консоли, он будет записывать только имя, айди, запрос и ответ.
+# Отдельный логгер для консоли: только имя, айди, запрос и ответ
 console_logger = logging.getLogger('console')
-console_logger.setLevel(logging.INFO)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_formatter = logging.Formatter('%(message)s')
-console_handler.setFormatter(console_formatter)
-console_logger.addHandler(console_handler)
 
 
 bot = Bot(token=TELEGRAM_API_KEY)
@@ -58,42 +61,40 @@ dp = Dispatcher()
 
 # ---  setup ---
 db = Database()
-gemini = Gemini()
-gemini_thinking = GeminiThinking()  # Создаем экземпляр GeminiThinking
+models = ModelRegistry()
+# Состояние, общее для воркеров: в памяти процесса по умолчанию или в Redis (STATE_BACKEND_URL)
+state = create_backend()
+sessions = SessionStore(db, state)
+context_window = ContextWindow(sessions, summarize=models.default.generate_content)
+# Готовые ответы на одинаковые запросы без истории (RESPONSE_CACHE=1)
+response_cache = ResponseCache()
+# Кэш контекста Gemini на пользователя и модель (CONTEXT_CACHE=1)
+context_cache = ContextCacheManager(lambda model_id: models.get(model_id).model,
+                                    system_chars=lambda model_id: len(models.get(model_id).model.config.system_instruction or ""))
+image_cache = ImageCache(blobs=state)
+image_preprocessor = ImagePreprocessor()
+# Изображения загружаются в Gemini Files API один раз, в запросах - только ссылки на них
+file_uploader = GeminiFileUploader(models.client, db)
+# Общий лимитер для отправок и правок: глобальный лимит бота и лимит на чат
+send_limiter = SendLimiter()
+message_sender = MessageSender(bot, send_limiter)
 
 PHOTOS_DIR = "photos"
 os.makedirs(PHOTOS_DIR, exist_ok=True)
+# Фото хранятся по хэшу содержимого, с квотами и фоновой очисткой
+image_store = ImageStore(db, PHOTOS_DIR, image_cache)
+
+# Потоковая выдача ответа: сообщение-заглушка редактируется по мере генерации
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # секунды между правками
 
 
 # Функция для очистки текста от лишних символов и форматирования
 def clean_text(text):
     if text is None:
         return ""
-    # Заменяем множественные пробелы на один, но сохраняем \n для абзацев
-    text = re.sub(r'[ \t]+', ' ', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)  # Убираем более 2-х переносов
-    text = text.strip()
-
-
-    # Заменяем markdown на html
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
-    text = re.sub(r'\*(.*?)\*', r'<i>\1</i>', text)
-    text = re.sub(r'\_(.*?)\_', r'<i>\1</i>', text)
-    text = re.sub(r'```(.*?)```', r'<pre><code>\1</code></pre>', text, flags=re.DOTALL) # Моноширинный
-    text = re.sub(r'`(.*?)`', r'<pre><code>\1</code></pre>', text, flags=re.DOTALL)
-    text = re.sub(r'~~(.*?)~~', r'<strike>\1</strike>', text) # Зачеркнутый
-    
+    return render_html(text)
 
-    
-    # Удаляем пробелы перед точками и другими знаками
-    text = re.sub(r'\s*([.,?!])', r'\1', text)
-    
-    # Экранирование HTML спецсимволов
-    text = text.replace("&", "&")
-    text = text.replace("<", "<")
-    text = text.replace(">", ">")
-    return text
- 
 
 def truncate_text(text, max_length, end_chars=".!?",):
     if len(text) <= max_length:
@@ -107,98 +108,133 @@ def truncate_text(text, max_length, end_chars=".!?",):
     return text[:max_length] + "..."
 
 
-async def send_message_with_retry(bot: Bot, chat_id: int, text: str, original_text: str, retries=3, delay=2):
-    """Отправляет сообщение, разделяя его на части и пробует несколько раз при ошибке."""
-    max_message_length = 4096
-    
-    for attempt in range(retries):
-      try:
-          if len(text) <= max_message_length:
-            await bot.send_message(chat_id, text, parse_mode="HTML", disable_web_page_preview=True)
+@timed("telegram_send")
+async def send_message_with_retry(chat_id: int, text: str):
+    """Отправляет сообщение частями; повторы и лимиты Telegram обрабатывает message_sender."""
+    result = await message_sender.send_html(chat_id, text)
+    if result.plain:
+        logger.warning(f"Chat {chat_id}: parts {result.plain} sent without formatting")
+    if not result.ok:
+        logger.error(f"Chat {chat_id}: delivered {len(result.delivered)} parts, failed {result.failed}")
+
+
+class StreamingReply:
+    """Показывает ответ по мере генерации, редактируя сообщения вместо ожидания полного ответа."""
+
+    def __init__(self, bot: Bot, chat_id: int, placeholder: Message):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.messages = [placeholder]
+        self.shown = [placeholder.text]  # текст, который сейчас виден в каждом сообщении
+        self.starts = [0]  # смещение начала каждого сообщения в полном тексте
+        self.text = ""
+        self.next_edit = 0.0
+
+    async def feed(self, chunk: str):
+        self.text += chunk
+        if time.monotonic() >= self.next_edit:
+            await self._flush()
+
+    async def finish(self) -> str:
+        """Выводит остаток текста и применяет HTML-форматирование к каждому сообщению."""
+        if not self.text:
+            self.text = NO_RESPONSE
+        await self._flush(force=True)
+        for index, message in enumerate(self.messages):
+            formatted = clean_text(self._piece(index))
+            if not formatted or utf16_len(formatted) > MAX_MESSAGE_LENGTH:
+                continue
+            try:
+                await send_limiter.acquire(self.chat_id)
+                await self.bot.edit_message_text(formatted, chat_id=self.chat_id, message_id=message.message_id,
+                                                 parse_mode="HTML", disable_web_page_preview=True)
+            except TelegramBadRequest as e:
+                # Оставляем текст без форматирования, он уже показан пользователю
+                logger.debug("Streaming: HTML edit rejected for message %s: %s", message.message_id, e)
+        return self.text
+
+    async def abort(self):
+        for message in self.messages:
+            try:
+                await self.bot.delete_message(self.chat_id, message.message_id)
+            except Exception as e:
+                logger.debug("Streaming: failed to delete message %s: %s", message.message_id, e)
+
+    def _piece(self, index: int) -> str:
+        end = self.starts[index + 1] if index + 1 < len(self.starts) else len(self.text)
+        return self.text[self.starts[index]:end]
+
+    async def _flush(self, force: bool = False):
+        # Переносим текст в новое сообщение, когда текущее упирается в лимит Telegram (в единицах UTF-16)
+        while utf16_len(self.text[self.starts[-1]:]) > MAX_MESSAGE_LENGTH:
+            start = self.starts[-1]
+            end = start + MAX_MESSAGE_LENGTH
+            units = utf16_len(self.text[start:end])
+            while units > MAX_MESSAGE_LENGTH:
+                # Эмодзи и другие символы вне BMP занимают две единицы: убираем не больше, чем нужно
+                end -= (units - MAX_MESSAGE_LENGTH + 1) // 2
+                units = utf16_len(self.text[start:end])
+            middle = start + (end - start) // 2
+            cut = self.text.rfind("\n", start, end)
+            if cut <= middle:
+                cut = self.text.rfind(" ", start, end)
+            if cut <= middle:
+                cut = end
+            self.starts.append(cut)
+            await self._edit(len(self.messages) - 1, force=True)
+            await send_limiter.acquire(self.chat_id)
+            message = await self.bot.send_message(self.chat_id, "…", disable_web_page_preview=True)
+            self.messages.append(message)
+            self.shown.append("…")
+        await self._edit(len(self.messages) - 1, force=force)
+
+    async def _edit(self, index: int, force: bool = False):
+        piece = self._piece(index).strip()
+        if not piece or piece == self.shown[index]:
             return
-          else:
-             parts = []
-             current_part = ""
-             for sentence in re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s', text):
-                  if len(current_part) + len(sentence) <= max_message_length:
-                        current_part += sentence + " "
-                  else:
-                        parts.append(current_part.strip())
-                        current_part = sentence + " "
-             parts.append(current_part.strip())
-             for part in parts:
-               await bot.send_message(chat_id, part, parse_mode="HTML", disable_web_page_preview=True)
-             return
-      except Exception as e:
-           logger.error(f"Ошибка отправки сообщения (попытка {attempt + 1}/{retries}) c HTML: {e}")
-           if attempt < retries - 1:
-               await asyncio.sleep(delay)
-           else:
-               logger.error(f"Не удалось отправить сообщение c HTML после {retries} попыток, отправляю без форматирования")
-               
-               for attempt in range(retries):
-                   try:
-                     if len(original_text) <= max_message_length:
-                         await bot.send_message(chat_id, f"Форматировать текст не удалось, текст без него:\n{original_text}", disable_web_page_preview=True)
-                         return
-                     else:
-                       parts = []
-                       current_part = ""
-                       for sentence in re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s', original_text):
-                            if len(current_part) + len(sentence) <= max_message_length:
-                                  current_part += sentence + " "
-                            else:
-                                  parts.append(current_part.strip())
-                                  current_part = sentence + " "
-                       parts.append(current_part.strip())
-                       for part in parts:
-                            await bot.send_message(chat_id, f"Форматировать текст не удалось, текст без него:\n{part}", disable_web_page_preview=True)
-                       return
-
-                   except Exception as e:
-                      logger.error(f"Ошибка отправки сообщения без HTML (попытка {attempt + 1}/{retries}): {e}")
-                      if attempt < retries - 1:
-                          await asyncio.sleep(delay)
-               logger.error(f"Не удалось отправить сообщение после {retries} попыток (без форматирования)")
-
-
-async def save_image_to_disk(file_id, file_bytes):
-    """Сохраняет изображение на диск."""
-    file_path = os.path.join(PHOTOS_DIR, f"{file_id}.jpg")
-    try:
-        async with aiofiles.open(file_path, "wb") as f:
-            await f.write(file_bytes)
-        logger.debug(f"Saved image to disk: {file_path}")
-        return file_path
-    except Exception as e:
-        logger.error(f"Error saving image to disk: {e}")
-        return None
-
-
-async def load_image_from_disk(file_path):
-    """Загружает изображение с диска."""
+        if not force and time.monotonic() < self.next_edit:
+            return
+        try:
+            await send_limiter.acquire(self.chat_id)
+            await self.bot.edit_message_text(piece, chat_id=self.chat_id, message_id=self.messages[index].message_id,
+                                             disable_web_page_preview=True)
+            self.shown[index] = piece
+            self.next_edit = time.monotonic() + STREAM_EDIT_INTERVAL
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать - откладываем следующую правку
+            logger.debug("Streaming: edit rate limited for %ss", e.retry_after)
+            self.next_edit = time.monotonic() + e.retry_after
+            send_limiter.block(self.chat_id, e.retry_after)
+            if force:
+                await self._edit(index, force=True)
+        except TelegramBadRequest as e:
+            logger.debug("Streaming: edit rejected for message %s: %s", self.messages[index].message_id, e)
+
+
+async def ingest_photo(bot: Bot, user_id: int, file_id: str):
+    """Скачивает фото одним проходом, записывая его на диск по мере прихода чанков, и добавляет пользователю."""
     try:
-        async with aiofiles.open(file_path, "rb") as f:
-            image_bytes = await f.read()
-            image = Image.open(io.BytesIO(image_bytes))
-            return image
+        with stage("photo_download"):
+            file_info = await bot.get_file(file_id)
+            if bot.session.api.is_local:
+                buffer = io.BytesIO()
+                await bot.download_file(file_info.file_path, destination=buffer)
+                image = None
+            else:
+                url = bot.session.api.file_url(bot.token, file_info.file_path)
+                # Чанки пишутся на диск по мере скачивания, sha256 считается на ходу
+                chunks = bot.session.stream_content(url=url, timeout=30, chunk_size=65536, raise_for_status=True)
+                image = await image_store.save_stream(user_id, file_id, chunks)
+        if image is None:
+            with stage("image_save"):
+                image = await image_store.save(user_id, file_id, buffer.getvalue())
+        logger.debug("Saved image %s for user %s, %d bytes", file_id, user_id, len(image.data))
+        return image
     except Exception as e:
-        logger.error(f"Error loading image from disk: {e}")
+        logger.error(f"Error downloading image {file_id}: {e}")
         return None
 
 
-async def clear_photos_dir():
-    """Удаляет все файлы из папки с фотографиями"""
-    try:
-        for file_name in os.listdir(PHOTOS_DIR):
-            file_path = os.path.join(PHOTOS_DIR, file_name)
-            if os.path.isfile(file_path):
-                await aiofiles.os.remove(file_path)
-        logger.info("Photos directory cleaned")
-    except Exception as e:
-        logger.error(f"Error cleaning photos directory: {e}")
-
-
 @dp.message(CommandStart())
 async def start_handler(message: Message):
     keyboard = ReplyKeyboardMarkup(
@@ -221,8 +257,9 @@ async def start_handler(message: Message):
 async def clear_history(message: Message):
     try:
         logger.info(f'{message.from_user.id}, {message.from_user.full_name} cleared history and photos')
-        db.clear_history(message.from_user.id)
-        await clear_photos_dir()
+        await sessions.clear_history(message.from_user.id)
+        await image_store.clear_user(message.from_user.id)
+        context_cache.invalidate(message.from_user.id)
         await message.answer("История запросов для модели и все изображения очищены!")
     except Exception as e:
         logger.exception(f"Error clearing history and photos for user {message.from_user.id}: {e}")
@@ -232,30 +269,25 @@ async def clear_history(message: Message):
 @dp.message(Command('model'))
 async def model_handler(message: Message):
     keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="Gemini 2.0 Flash"),
-                KeyboardButton(text="Gemini 2.0 Flash Thinking"),
-            ],
-        ],
+        keyboard=[[KeyboardButton(text=spec.title) for spec in models.list()]],
         resize_keyboard=True,
         one_time_keyboard=True,
     )
+    descriptions = "\n\n".join(f"<b>{html.escape(spec.title)}</b> - {html.escape(spec.description)}" for spec in models.list())
     await message.answer(
-        """Выберите модель:\n
-*Gemini 2.0 Flash* - Молниеносные ответы и всегда свежие новости. Анализирует изображения и обрабатывает информацию как целую библиотеку книг. Идеально для скорости и точности.\n
-*Gemini 2.0 Flash Thinking* - Глубокий анализ и развернутые ответы, анализирует изображения. Может погрузиться в детали, как в несколько книг, опираясь на знания, полученные в процессе обучения. Подходит для сложных задач и экспертного мнения.""",
+        f"Выберите модель:\n\n{descriptions}",
         reply_markup=keyboard,
-        parse_mode="MarkdownV2",
+        parse_mode="HTML",
     )
 
 
-@dp.message(lambda message: message.text in ["Gemini 2.0 Flash", "Gemini 2.0 Flash Thinking"])
+@dp.message(lambda message: message.text is not None and models.find(message.text) is not None)
 async def set_model_handler(message: Message):
     try:
-        model_type = message.text
-        db.set_model(message.from_user.id, model_type)
-        logger.info(f'{message.from_user.id}, {message.from_user.full_name} selected model - {model_type}')
+        spec = models.find(message.text)
+        await sessions.set_model(message.from_user.id, spec.id)
+        context_cache.invalidate(message.from_user.id)
+        logger.info(f'{message.from_user.id}, {message.from_user.full_name} selected model - {spec.id}')
 
         keyboard = ReplyKeyboardMarkup(
             keyboard=[
@@ -267,7 +299,7 @@ async def set_model_handler(message: Message):
             resize_keyboard=True,
         )
 
-        await message.answer(f"Выбрана модель: {model_type}", reply_markup=keyboard)
+        await message.answer(f"Выбрана модель: {spec.title}", reply_markup=keyboard)
     except Exception as e:
          logger.exception(f"Error setting model for user {message.from_user.id}: {e}")
          await message.answer("Произошла ошибка при выборе модели.")
@@ -283,159 +315,162 @@ async def send_agreement(message: Message):
         await message.answer("Произошла ошибка при отправке соглашения.")
 
 
-# Кэш для альбомов и текстовых сообщений
-album_cache = {}
-text_cache = {}
-
-
-async def process_album(bot, user_id, user_name, query, album_id, message):
-    if album_id not in album_cache:
-        album_cache[album_id] = {
-            "messages": [],
-            "timer": None,
-        }
-
-    album_cache[album_id]["messages"].append(message)
-
-    if album_cache[album_id]["timer"]:
-        album_cache[album_id]["timer"].cancel()
-
-    async def send_cached_album():
-        try:
-            messages = album_cache.get(album_id, {}).get("messages")
-            if messages:
-                await process_messages(bot, user_id, user_name, query, messages)
-                del album_cache[album_id]
-        except Exception as e:
-            logger.exception(f"Error processing cached album for user {user_id}: {e}")
-
-    # Запуск таймера
-    album_cache[album_id]["timer"] = asyncio.create_task(asyncio.sleep(10), name="album_timer")
-    try:
-        await album_cache[album_id]["timer"]
-        await send_cached_album()
-
-    except asyncio.CancelledError:
-        pass  # Таймер отменен
+class Prompt(NamedTuple):
+    text: str
+    model_type: Optional[str]
+    cache: Optional[PromptCache] = None
+    response_key: Optional[str] = None  # ключ кэша ответов; только для запросов без истории
 
 
-async def process_text_message(bot, user_id, user_name, query, message):
-    if user_id not in text_cache:
-        text_cache[user_id] = {
-            "messages": [],
-            "timer": None,
-        }
-
-    text_cache[user_id]["messages"].append(message)
-
-    if text_cache[user_id]["timer"]:
-        text_cache[user_id]["timer"].cancel()
-
-    async def send_cached_text():
-        try:
-            messages = text_cache.get(user_id, {}).get("messages")
-            if messages:
-                await process_messages(bot, user_id, user_name, query, messages)
-                del text_cache[user_id]
-        except Exception as e:
-            logger.exception(f"Error processing cached text for user {user_id}: {e}")
-
-    # Запуск таймера
-    text_cache[user_id]["timer"] = asyncio.create_task(asyncio.sleep(3), name="text_timer")  # 3 секунды таймер
-    try:
-        await text_cache[user_id]["timer"]
-        await send_cached_text()
-
-    except asyncio.CancelledError:
-        pass  # Таймер отменен
-
-
-async def prepare_prompt(bot, user_id, query, files, media):
+@timed("prepare_prompt")
+async def prepare_prompt(bot, user_id, query, files, media) -> Prompt:
     """Подготавливает промпт для Gemini."""
     try:
-        history = db.get_history(user_id)
-        prompt_parts = []
+        reserved_chars = len(query or "") + sum(len(caption) for caption in media if caption)
+        with stage("db_history"):
+            context = await context_window.build(user_id, reserved_chars)
+        history = context.turns
+        header = []
+        turns = []
         processed_image_ids = set()
-        model_type = db.get_current_model(user_id)
-
-        if history:
-            prompt_parts.append("История запросов:")
-            for record in history:
-                if record['image_ids']:
-                    for file_id in record['image_ids'].split(','):
-                      if file_id and file_id not in processed_image_ids:
-                        try:
-                            file_path = os.path.join(PHOTOS_DIR, f"{file_id}.jpg")
-                            if os.path.exists(file_path):
-                                image = await load_image_from_disk(file_path)
-                                if image:
-                                    files.append(image)
-                                    prompt_parts.append(f"Image : {file_id}")
-                                    processed_image_ids.add(file_id)
-                                else:
-                                    prompt_parts.append(f"Image : {file_id} - Error loading")
-                            else:
-                                    prompt_parts.append(f"Image : {file_id} - File not found")
-                        except Exception as e:
-                            logger.error(f"Error loading image from disk or saving: {e}")
-
-
-                prompt_parts.append(f"User: {record['query']}")
-                prompt_parts.append(f"Bot: {record['response']}")
-
-                if record['image_ids']:
-                    for file_id in record['image_ids'].split(','):
-                        if file_id:
-                            prompt_parts.append(f"Image file_id: {file_id} -  this is a description")
-
-
-        prompt_parts.append("---")
-        prompt_parts.append(f"Current User Message: {query if query else 'Фотографии'}")
+        model_type = await sessions.get_current_model(user_id)
+
+        if context.summary:
+            header.append("Краткое содержание более ранней переписки:")
+            header.append(context.summary)
+
+        for record in history:
+            block = []
+            if record['image_ids']:
+                for file_id in record['image_ids'].split(','):
+                  if file_id and file_id not in processed_image_ids:
+                    try:
+                        with stage("image_load"):
+                            image = await image_store.load(user_id, file_id)
+                        if image:
+                            files.append(image)
+                            block.append(f"Image : {file_id}")
+                            processed_image_ids.add(file_id)
+                        else:
+                            block.append(f"Image : {file_id} - File not found")
+                    except Exception as e:
+                        logger.error(f"Error loading image from disk or saving: {e}")
+
+
+            block.append(f"User: {record['query']}")
+            block.append(f"Bot: {record['response']}")
+
+            if record['image_ids']:
+                for file_id in record['image_ids'].split(','):
+                    if file_id:
+                        block.append(f"Image file_id: {file_id} -  this is a description")
+            turns.append((record, "\n".join(block)))
+
+
+        tail = ["---", f"Current User Message: {query if query else 'Фотографии'}"]
         if media:
             for i, caption in enumerate(media):
                 if caption:
-                    prompt_parts.append(f"Caption {i+1} : {caption}")
+                    tail.append(f"Caption {i+1} : {caption}")
                 else:
-                    prompt_parts.append(f"Image {i+1}: No caption")
-
-        prompt_text = "\n".join(prompt_parts)
-        logger.debug(f"Prompt for Gemini {user_id}:\n{prompt_text}")
-        return prompt_text, model_type
+                    tail.append(f"Image {i+1}: No caption")
+
+        # Неизменное начало промпта может уже лежать в кэше контекста Gemini
+        prompt_text, cache = context_cache.prompt(user_id, model_type, header, turns, tail)
+        stats = context.stats
+        logger.info("Prompt stats for %s: %d chars (~%d tokens), history %d/%d turns (%d chars), dropped %d, "
+                    "summary %d chars, images %d, context cache %s",
+                    user_id, len(prompt_text), len(prompt_text) // 4, stats.turns_used, stats.turns_fetched,
+                    stats.history_chars, stats.turns_dropped, stats.summary_chars, len(files), "hit" if cache else "miss")
+        if logger.isEnabledFor(logging.DEBUG):
+            # stats() собирают словари - на каждом запросе только при включенном DEBUG
+            logger.debug("Caches: image %s, sessions %s, history writer %s", image_cache.stats(), sessions.stats(),
+                         db.writer.stats())
+        logger.debug("Prompt for Gemini %s:\n%s", user_id, Clip(prompt_text))
+
+        memo_key = None
+        if response_cache.enabled and context.stats.turns_fetched == 0 and not context.summary:
+            # Без истории ответ зависит только от модели, инструкции, текста и самих изображений.
+            # Проверяется сохраненная история, а не окно: длинный запрос может вытеснить из окна все записи
+            spec = models.spec(model_type)
+            instruction = models.get(spec.id).model.config.system_instruction
+            memo_key = response_key(spec.id, instruction, prompt_text,
+                                    (hashlib.sha256(image.data).hexdigest() for image in files))
+        return Prompt(prompt_text, model_type, cache, memo_key)
     except Exception as e:
         logger.exception(f"Error preparing prompt for user {user_id}: {e}")
-        return "", None
+        return Prompt("", None)
 
 
-async def generate_response(bot, message, prompt_text, model_type, files, user_id, query):
+async def generate_response(bot, message, prompt: Prompt, files, user_id, query):
     """Генерирует ответ от Gemini и отправляет пользователю."""
     generation_message = await bot.send_message(message.chat.id, 'Готовлю подходящий ответ...')
+    streaming_reply = None
+    model_type = prompt.model_type
+    trace = current_trace()
+    if trace:
+        trace.model = models.spec(model_type).id
     try:
-        if model_type == 'gemini-2.0-flash-exp':
-            response_text = await gemini.generate_content(prompt_text, files)
-        elif model_type == 'gemini-2.0-flash-thinking-exp-1219':
-            response_text = await gemini_thinking.generate_content(prompt_text, files)
-        else:
-            response_text = await gemini.generate_content(prompt_text, files)
-
-        cleaned_response = clean_text(response_text)
-        truncated_response = truncate_text(cleaned_response, 4000)
-
-        # Устраняем нумерацию в конце
-        truncated_response = re.sub(r'\s+\d+\s*$', '', truncated_response)  # Удаляет цифры в конце
+        model = models.get(model_type)
+
+        async def generate() -> str:
+            nonlocal streaming_reply
+            if STREAM_RESPONSES:
+                streaming_reply = StreamingReply(bot, message.chat.id, generation_message)
+                async for chunk in model.generate_content_stream(prompt.text, files, prompt.cache):
+                    await streaming_reply.feed(chunk)
+                return await streaming_reply.finish()
+            return await model.generate_content(prompt.text, files, prompt.cache)
+
+        with stage("gemini", model.model_id):
+            if prompt.response_key:
+                # Одинаковые запросы без истории получают сохраненный ответ или ждут уже идущую генерацию
+                response_text = await response_cache.get_or_generate(prompt.response_key, generate,
+                                                                     cacheable=lambda text: text.strip() and text != NO_RESPONSE)
+            else:
+                response_text = await generate()
+
+        with stage("clean_text"):
+            cleaned_response = clean_text(response_text)
+            truncated_response = truncate_text(cleaned_response, 4000)
+
+            # Устраняем нумерацию в конце
+            truncated_response = re.sub(r'\s+\d+\s*$', '', truncated_response)  # Удаляет цифры в конце
         
-        db.add_record(user_id, query if query else 'Файлы', cleaned_response, [], model_type)
-        logger.info(f"Gemini({model_type}) answered to {user_id}")
+        with stage("history_write"):
+            await sessions.add_record(user_id, query if query else 'Файлы', cleaned_response, [], model_type)
+        logger.info("Gemini(%s) answered to %s", model_type, user_id)
         
-        console_logger.info(f"{message.from_user.full_name} - {user_id} - {query if query else 'Фото'} - {truncated_response}")
-        
-        await bot.delete_message(message.chat.id, generation_message.message_id)
-        await send_message_with_retry(bot, message.chat.id, text=cleaned_response, original_text = response_text)
+        console_logger.info("%s - %s - %s - %s", message.from_user.full_name, user_id, Clip(query or 'Фото', 500), truncated_response)
+
+        if not streaming_reply:
+            await bot.delete_message(message.chat.id, generation_message.message_id)
+            await send_message_with_retry(message.chat.id, cleaned_response)
         
 
+    except asyncio.CancelledError:
+        # Генерацию прервал более новый запрос пользователя (политика cancel)
+        logger.info("Generation for %s cancelled", user_id)
+        if streaming_reply:
+            await streaming_reply.abort()
+        else:
+            try:
+                await bot.delete_message(message.chat.id, generation_message.message_id)
+            except Exception as e:
+                logger.debug("Failed to delete placeholder for %s: %s", user_id, e)
+        raise
     except Exception as e:
+            if trace:
+                trace.outcome = "error"
             logger.exception(f"ERROR! {user_id} {message.from_user.full_name} : {query}")
-            await bot.delete_message(message.chat.id, generation_message.message_id)
-            await bot.send_message(message.chat.id, "Произошла ошибка при обработке запроса. Попробуйте еще раз.")
+            if streaming_reply:
+                await streaming_reply.abort()
+            else:
+                await bot.delete_message(message.chat.id, generation_message.message_id)
+            if isinstance(e, CircuitOpenError):
+                await bot.send_message(message.chat.id, "Модель сейчас перегружена. Попробуйте через минуту или выберите другую модель.")
+            else:
+                await bot.send_message(message.chat.id, "Произошла ошибка при обработке запроса. Попробуйте еще раз.")
 
 
 async def process_messages(bot, user_id, user_name, query, messages):
@@ -445,61 +480,95 @@ async def process_messages(bot, user_id, user_name, query, messages):
     log_message = ""
     message_type = "unknown"
 
-    for item in messages:
-        try:
-            if item.photo:
-                message_type = "photo"
-                photo = item.photo[-1]
-                file_id = photo.file_id
-                file_info = await bot.get_file(file_id)
-                file_bytes = await bot.download_file(file_info.file_path)
-
-                file_path = await save_image_to_disk(file_id, file_bytes.read())
-                if file_path:
-                    image = await load_image_from_disk(file_path)
-                    if image:
-                        files.append(image)
-                        image_ids.append(file_id)
-                else:
-                   logger.error(f"Failed to save file {file_id}")
-
-
-                if item.caption:
-                  media.append(item.caption)
-                else:
-                    media.append(None)
-
-                if item.caption:
-                    log_message = f"Photo + Caption: {item.caption}"
-                else:
-                    log_message = "Photo"
+    # Фото альбома скачиваются параллельно, порядок сохраняется
+    photo_items = [item for item in messages if item.photo]
+    images = await asyncio.gather(*(ingest_photo(bot, user_id, item.photo[-1].file_id) for item in photo_items))
 
+    for item, image in zip(photo_items, images):
+        message_type = "photo"
+        file_id = item.photo[-1].file_id
+        if image:
+            files.append(image)
+            image_ids.append(file_id)
+        else:
+            logger.error(f"Failed to save file {file_id}")
 
-        except Exception as e:
-            logger.error(f"Error processing media for user {user_id}: {e}")
+        media.append(item.caption if item.caption else None)
+        log_message = f"Photo + Caption: {item.caption}" if item.caption else "Photo"
 
     if not messages[0].text:
         logger.info(f'User {user_id}, {user_name} sent {message_type} - {log_message}')
     else:
         message_type = "text"
-        logger.info(f'User {user_id}, {user_name} sent {message_type} - {messages[0].text}')
+        logger.info("User %s, %s sent %s - %s", user_id, user_name, message_type, Clip(messages[0].text, 500))
     try:
-        prompt_text, model_type = await prepare_prompt(bot,user_id, query, files, media)
-        if prompt_text:
-           await generate_response(bot, messages[0], prompt_text, model_type, files, user_id, query)
+        prompt = await prepare_prompt(bot,user_id, query, files, media)
+        model_type = prompt.model_type
+        if files:
+            with stage("image_prep"):
+                files, image_stats = await image_preprocessor.prepare(files, shared_budget=not GEMINI_FILES_API)
+            logger.info("Images for %s: %d images, %d resized (%d from cache), %d -> %d bytes", user_id, image_stats.images,
+                        image_stats.resized, image_stats.cache_hits, image_stats.bytes_before, image_stats.bytes_after)
+            if GEMINI_FILES_API:
+                with stage("files_upload"):
+                    files = await file_uploader.resolve(files)
+        if prompt.text:
+           await generate_response(bot, messages[0], prompt, files, user_id, query)
+           context_cache.release(user_id, prompt.cache)
         else:
-          await bot.send_message(message.chat.id, "Не удалось сформировать запрос.")
+          await bot.send_message(messages[0].chat.id, "Не удалось сформировать запрос.")
 
     except Exception as e:
           logger.exception(f"Error generating response for user {user_id}: {e}")
-          await bot.send_message(message.chat.id, "Произошла ошибка при обработке запроса. Попробуйте еще раз.")
+          await bot.send_message(messages[0].chat.id, "Произошла ошибка при обработке запроса. Попробуйте еще раз.")
     
     try:
-       db.add_record(user_id, query if query else "photo", response = ' ', image_ids=image_ids, model_type = model_type)
+       await sessions.add_record(user_id, query if query else "photo", response = ' ', image_ids=image_ids, model_type = model_type)
     except Exception as e:
         logger.exception(f"Error adding record to database for user {user_id}: {e}")
 
 
+class UserRequest(NamedTuple):
+    user_name: str
+    query: Optional[str]
+    messages: List[Message]
+
+
+async def handle_user_requests(user_id, requests: List[UserRequest]):
+    """Обработчик work_queue. При политике coalesce приходит сразу несколько запросов - они объединяются в один."""
+    queries = [request.query for request in requests if request.query]
+    query = "\n".join(queries) if queries else requests[0].query
+    messages = [message for request in requests for message in request.messages]
+    with trace_request(user_id):
+        await process_messages(bot, user_id, requests[-1].user_name, query, messages)
+
+
+# Запросы пользователя выполняются по одному, пользователи обслуживаются по кругу
+work_queue = UserWorkQueue(handle_user_requests)
+
+
+def submit_buffered(key, messages: List[Message]):
+    """Отдает накопленные части сообщения или альбом в очередь пользователя одним запросом."""
+    user = messages[0].from_user
+    texts = [message.text for message in messages if message.text]
+    # Telegram режет длинный текст на несколько сообщений - в запрос идут все части
+    query = "\n".join(texts) if texts else None
+    work_queue.submit(user.id, UserRequest(user.full_name, query, messages))
+
+
+def encode_message(message: Message) -> bytes:
+    return message.model_dump_json(exclude_none=True).encode()
+
+
+def decode_message(data: bytes) -> Message:
+    return Message.model_validate_json(data).as_(bot)
+
+
+# В общем хранилище буферы лежат в JSON; в памяти процесса сообщения хранятся как есть
+debouncer = DebounceScheduler(submit_buffered, store=state, encode=encode_message if state.shared else None,
+                              decode=decode_message if state.shared else None)
+
+
 @dp.message()
 async def message_handler(message: Message, bot: Bot):
     user_id = message.from_user.id
@@ -509,34 +578,147 @@ async def message_handler(message: Message, bot: Bot):
 
     try:
       if message.media_group_id:
-          await process_album(bot, user_id, user_name, query, message.media_group_id, message)
+          await debouncer.add_album(message.media_group_id, message)
       elif message.photo:
-          await process_messages(bot, user_id, user_name, query, [message])
+          work_queue.submit(user_id, UserRequest(user_name, query, [message]))
       elif message.text:
-          await process_text_message(bot, user_id, user_name, query, message)
+          await debouncer.add_text(user_id, message)
     except Exception as e:
         logger.exception(f"Error handling message for user {user_id}: {e}")
         await bot.send_message(message.chat.id, "Произошла ошибка при обработке вашего сообщения.")
 
-async def keep_alive(bot):
-    while True:
-        try:
-            await bot.send_message(ADMIN_ID, "Бот все еще работает")
-            logger.info(f"Sent keep-alive message to ADMIN_ID {ADMIN_ID}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения keep-alive ADMIN_ID: {e}")
-        await asyncio.sleep(20 * 60)  # Каждые 20 минут
+draining = False
+
+
+async def healthz(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика: 503 во время остановки, чтобы новые запросы шли другим воркерам."""
+    status = 503 if draining else 200
+    return web.json_response({
+        "status": "draining" if draining else "ok",
+        "mode": "webhook" if WEBHOOK_URL else "polling",
+        "work_queue": work_queue.stats(),
+        "debounce": debouncer.stats(),
+        "generation_pool": generation_pool.stats(),
+        "routing": router.stats(),
+        "image_store": image_store.stats(),
+    }, status=status)
+
+
+@web.middleware
+async def reject_while_draining(request: web.Request, handler):
+    # Telegram повторит доставку позже, и балансировщик отдаст обновление живому воркеру
+    if draining and request.path == WEBHOOK_PATH:
+        return web.Response(status=503, text="Shutting down")
+    return await handler(request)
+
+
+router = WorkerRouter(webhook_path=WEBHOOK_PATH)
+
+
+@web.middleware
+async def route_to_owner(request: web.Request, handler):
+    """Пересылает обновление воркеру, за которым закреплен пользователь (WORKER_URLS)."""
+    if not router.enabled or request.path != WEBHOOK_PATH or request.headers.get(FORWARDED_HEADER):
+        return await handler(request)
+    body = await request.read()  # aiohttp запоминает тело, обработчик webhook прочитает его снова
+    try:
+        user_id = update_user_id(json.loads(body))
+    except ValueError:
+        user_id = None
+    owner = router.owner(user_id) if user_id is not None else router.worker_id
+    if owner != router.worker_id:
+        status = await router.forward(owner, body, request.headers.get(SECRET_HEADER))
+        if status is not None:
+            return web.Response(status=status)
+    router.local += 1
+    return await handler(request)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Метрики в текстовом формате Prometheus."""
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+# Числовые поля stats() компонентов отдаются в /metrics как gauge
+for name, source in (
+    ("work_queue", work_queue.stats), ("debounce", debouncer.stats), ("generation_pool", generation_pool.stats),
+    ("model", models.stats), ("telegram_send", message_sender.stats), ("image_cache", image_cache.stats),
+    ("image_store", image_store.stats), ("sessions", sessions.stats), ("files_api", file_uploader.stats),
+    ("context_cache", context_cache.stats), ("response_cache", response_cache.stats),
+    ("history_writer", lambda: db.writer.stats() if db.writer else {}), ("routing", router.stats),
+):
+    metrics.register_stats(name, source)
+
+
+async def start_http_server() -> web.AppRunner:
+    app = web.Application(middlewares=[reject_while_draining, route_to_owner])
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/metrics", metrics_handler)
+    if WEBHOOK_URL:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, HTTP_HOST, HTTP_PORT).start()
+    logger.info(f"HTTP server listening on {HTTP_HOST}:{HTTP_PORT}")
+    return runner
+
+
+async def run_webhook():
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET is not set, webhook requests are not authenticated")
+    await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+    logger.info(f"Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+async def drain():
+    """Дожидается ответов на уже принятые сообщения перед остановкой."""
+    global draining
+    draining = True
+    await debouncer.flush_all()
+    logger.info(f"Draining {work_queue.stats()['running']} running requests (timeout {SHUTDOWN_TIMEOUT}s)")
+    if not await work_queue.drain(SHUTDOWN_TIMEOUT):
+        logger.warning(f"Shutdown timeout reached, abandoning requests: {work_queue.stats()}")
 
 
 async def main():
     logger.info("Бот начал запуск...")
-    asyncio.create_task(keep_alive(bot))  # Запускаем задачу keep_alive
+    await db.init()
+    image_store.start()
+    runner = await start_http_server() if HTTP_PORT else None
     try:
-       await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Если бот раньше работал через webhook, Telegram не отдаст обновления через getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем")
     except Exception as e:
         logger.exception(f"Critical error during bot polling: {e}")
+    finally:
+        await drain()
+        if runner:
+            await runner.cleanup()
+        logger.info(f"Gemini pool stats on shutdown: {generation_pool.stats()}, "
+                    f"models: {models.stats()}")
+        logger.info(f"Telegram send stats on shutdown: {message_sender.stats()}, work queue: {work_queue.stats()}, "
+                    f"debounce: {debouncer.stats()}, image store: {image_store.stats()}, files API: {file_uploader.stats()}, "
+                    f"context cache: {context_cache.stats()}, "
+                    f"response cache: {response_cache.stats()}")
+        generation_pool.shutdown()
+        await image_store.stop()
+        await db.close()
+        await state.close()
+        await router.close()
+        await bot.session.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,222 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Запросы дольше этого числа секунд пишутся в лог с разбивкой по этапам; 0 - не писать
+METRICS_SLOW_REQUEST = float(os.getenv("METRICS_SLOW_REQUEST", "0"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+logger = logging.getLogger("bot.metrics")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels_text(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels_text(self.labels, label_values)} {value:g}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как в Prometheus: счетчики накопительные при выводе."""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple[str, ...], list] = {}  # метки -> [счетчики по корзинам, сумма, количество]
+
+    def observe(self, value: float, *label_values: str):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"' if bound == "+Inf" else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_labels_text(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labels, label_values)} {total:.6f}")
+            lines.append(f"{self.name}_count{_labels_text(self.labels, label_values)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Метрики процесса в текстовом формате Prometheus.
+
+    Кроме собственных счетчиков и гистограмм, выводит числовые поля из stats() компонентов бота как gauge.
+    """
+
+    def __init__(self):
+        self.metrics: List = []
+        self.stats_sources: List[Tuple[str, Callable[[], object]]] = []
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, stats: Callable[[], object]):
+        """stats() возвращает dict или список dict с полем model (как ModelRegistry.stats)."""
+        self.stats_sources.append((prefix, stats))
+
+    def _render_stats(self) -> List[str]:
+        lines = []
+        for prefix, stats in self.stats_sources:
+            try:
+                value = stats()
+            except Exception as e:
+                logger.warning(f"Metrics: stats source {prefix} failed: {e}")
+                continue
+            rows = value if isinstance(value, list) else [value]
+            for row in rows:
+                labels = f'{{model="{_escape(row["model"])}"}}' if "model" in row else ""
+                for key, number in self._numbers(row):
+                    lines.append(f"bot_{prefix}_{key}{labels} {number:g}")
+        return lines
+
+    @staticmethod
+    def _numbers(row: dict, prefix: str = ""):
+        for key, value in row.items():
+            if isinstance(value, bool):
+                yield prefix + key, int(value)
+            elif isinstance(value, (int, float)):
+                yield prefix + key, value
+            elif isinstance(value, dict):
+                yield from MetricsRegistry._numbers(value, f"{prefix}{key}_")
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.extend(self._render_stats())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+stage_seconds = registry.histogram("bot_stage_seconds", "Duration of request processing stages",
+                                   ("stage", "model", "outcome"))
+request_seconds = registry.histogram("bot_request_seconds", "Total duration of user requests", ("model", "outcome"))
+requests_total = registry.counter("bot_requests_total", "User requests by model and outcome", ("model", "outcome"))
+
+
+class RequestTrace:
+    """Этапы одного запроса пользователя: для гистограммы запросов и лога медленных запросов."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.model = "-"
+        self.outcome = "ok"
+        self.spans: List[Tuple[str, float, float]] = []  # (этап, начало от старта запроса, длительность)
+
+    def add(self, name: str, started: float, duration: float):
+        self.spans.append((name, started - self.started, duration))
+
+    def describe(self) -> str:
+        return ", ".join(f"{name} +{offset * 1000:.0f}ms {duration * 1000:.0f}ms" for name, offset, duration in self.spans)
+
+
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar("request_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_request(user_id):
+    """Оборачивает обработку запроса пользователя; этапы внутри попадают в его трассу."""
+    trace = RequestTrace(user_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except asyncio.CancelledError:
+        trace.outcome = "cancelled"
+        raise
+    except Exception:
+        trace.outcome = "error"
+        raise
+    finally:
+        _current_trace.reset(token)
+        elapsed = time.perf_counter() - trace.started
+        request_seconds.observe(elapsed, trace.model, trace.outcome)
+        requests_total.inc(trace.model, trace.outcome)
+        if METRICS_SLOW_REQUEST and elapsed >= METRICS_SLOW_REQUEST:
+            logger.warning("Slow request for %s: %.0f ms, model %s, outcome %s: %s",
+                           trace.user_id, elapsed * 1000, trace.model, trace.outcome, trace.describe())
+
+
+@contextmanager
+def stage(name: str, model: str = "-"):
+    """Замеряет этап: гистограмма по этапу, модели и исходу плюс запись в трассу текущего запроса."""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception:
+        outcome = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        stage_seconds.observe(duration, name, model, outcome)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, started, duration)
+
+
+def timed(name: str):
+    """Декоратор для корутин: весь вызов считается одним этапом name."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,88 @@
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from gemini_api import GeminiModel, create_client
+from gemini_resilience import GEMINI_TIMEOUT, ResilientModel
+
+logger = logging.getLogger("bot.models")
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """Описание модели: id в API, название на кнопке и параметры запросов."""
+    id: str
+    title: str
+    description: str
+    tools: Tuple[str, ...] = ()  # "google_search"
+    system_instruction: Optional[str] = None  # None - общая инструкция из gemini_api
+    max_output_tokens: Optional[int] = None
+    timeout: float = GEMINI_TIMEOUT  # таймаут одной попытки
+    fallback: Optional[str] = None  # id модели, отвечающей, пока эта недоступна
+
+
+# Новая модель - это новая запись здесь; первая запись - модель по умолчанию
+MODELS = [
+    ModelSpec(
+        id="gemini-2.0-flash-exp",
+        title="Gemini 2.0 Flash",
+        description="Молниеносные ответы и всегда свежие новости. Анализирует изображения и обрабатывает информацию "
+                    "как целую библиотеку книг. Идеально для скорости и точности.",
+        tools=("google_search",),
+    ),
+    ModelSpec(
+        id="gemini-2.0-flash-thinking-exp-1219",
+        title="Gemini 2.0 Flash Thinking",
+        description="Глубокий анализ и развернутые ответы, анализирует изображения. Может погрузиться в детали, "
+                    "как в несколько книг, опираясь на знания, полученные в процессе обучения. Подходит для сложных "
+                    "задач и экспертного мнения.",
+        timeout=GEMINI_TIMEOUT * 2,  # модель долго думает перед первым токеном
+        fallback="gemini-2.0-flash-exp",
+    ),
+]
+
+DEFAULT_MODEL_ID = MODELS[0].id
+
+
+class ModelRegistry:
+    """Модели бота по id: все работают через один клиент genai и общий пул соединений."""
+
+    def __init__(self, specs: List[ModelSpec] = MODELS, client=None):
+        self.specs: Dict[str, ModelSpec] = {spec.id: spec for spec in specs}
+        self.default_id = specs[0].id
+        self.client = client or create_client()
+        self.models: Dict[str, ResilientModel] = {}
+        for spec in specs:
+            self._build(spec)
+
+    def _build(self, spec: ModelSpec) -> ResilientModel:
+        model = self.models.get(spec.id)
+        if model is None:
+            fallback = self._build(self.specs[spec.fallback]) if spec.fallback else None
+            model = ResilientModel(GeminiModel(spec, self.client), fallback=fallback, timeout=spec.timeout)
+            self.models[spec.id] = model
+        return model
+
+    def spec(self, model_id: str) -> ModelSpec:
+        """Спецификация по id; неизвестные id (например, удаленных моделей) заменяются моделью по умолчанию."""
+        return self.specs.get(model_id) or self.specs[self.default_id]
+
+    def get(self, model_id: str) -> ResilientModel:
+        return self.models[self.spec(model_id).id]
+
+    @property
+    def default(self) -> ResilientModel:
+        return self.models[self.default_id]
+
+    def find(self, text: str) -> Optional[ModelSpec]:
+        """Модель по названию с кнопки или по id."""
+        for spec in self.specs.values():
+            if text in (spec.title, spec.id):
+                return spec
+        return None
+
+    def list(self) -> List[ModelSpec]:
+        return list(self.specs.values())
+
+    def stats(self) -> List[dict]:
+        return [model.stats() for model in self.models.values()]
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Кэш ответов на одинаковые запросы без истории (первое сообщение, одно и то же фото с той же подписью)
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+logger = logging.getLogger("bot.response_cache")
+
+
+class CachedResponse(NamedTuple):
+    text: str
+    expires_at: float
+    size: int
+
+
+def normalize_query(text: str) -> str:
+    """Регистр и пробелы не влияют на ответ модели, поэтому не должны влиять и на ключ."""
+    return WHITESPACE_RE.sub(" ", text).strip().casefold()
+
+
+def response_key(model_id: str, system_instruction: str, query: str, image_hashes: Iterable[str] = ()) -> str:
+    digest = hashlib.sha256()
+    for part in (model_id, system_instruction or "", normalize_query(query), *image_hashes):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """LRU-кэш готовых ответов модели с TTL и ограничением по числу записей и байтам.
+
+    Одинаковые запросы, пришедшие одновременно, ждут один вызов модели вместо того, чтобы делать свой.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, enabled: bool = RESPONSE_CACHE):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.items: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.size = 0
+        self._pending: Dict[str, asyncio.Future] = {}
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key: str) -> Optional[str]:
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item.expires_at <= time.monotonic():
+            self._discard(key)
+            self.expired += 1
+            return None
+        self.items.move_to_end(key)
+        return item.text
+
+    def put(self, key: str, text: str):
+        size = len(text.encode())
+        if size > self.max_bytes:
+            return
+        self._discard(key)
+        self.items[key] = CachedResponse(text, time.monotonic() + self.ttl, size)
+        self.size += size
+        while len(self.items) > self.max_entries or self.size > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    def _discard(self, key: str):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.size -= item.size
+
+    async def get_or_generate(self, key: str, generate: Callable[[], Awaitable[str]],
+                              cacheable: Callable[[str], bool] = bool) -> str:
+        """Ответ из кэша; иначе результат generate, общий для всех одновременных запросов с тем же ключом."""
+        while True:
+            text = self.get(key)
+            if text is not None:
+                self.hits += 1
+                return text
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # Отменили первый запрос (например, пользователь написал снова), а не этот - генерируем сами
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        # Ошибку получат ожидающие; если их нет, она не должна попасть в лог как непрочитанная
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending[key] = future
+        try:
+            text = await generate()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._pending.pop(key, None)
+        if cacheable(text):
+            self.put(key, text)
+        future.set_result(text)
+        return text
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "items": len(self.items),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expired": self.expired,
+        }
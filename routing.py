@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import os
+from typing import Dict, Optional
+
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Воркеры для режима webhook: WORKER_URLS="w1=http://10.0.0.1:8080,w2=http://10.0.0.2:8080", WORKER_ID - имя этого воркера
+WORKER_ID = os.getenv("WORKER_ID", "")
+WORKER_URLS = os.getenv("WORKER_URLS", "")
+FORWARD_TIMEOUT = 10
+
+FORWARDED_HEADER = "X-Bot-Forwarded-By"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+logger = logging.getLogger("bot.routing")
+
+
+def parse_workers(value: str) -> Dict[str, str]:
+    workers = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        worker_id, _, url = item.partition("=")
+        workers[worker_id.strip()] = url.strip().rstrip("/")
+    return workers
+
+
+def rendezvous_owner(key, workers) -> str:
+    """Воркер с наибольшим весом hash(воркер, ключ). При добавлении или удалении воркера переезжают только его ключи."""
+    def weight(worker_id):
+        return hashlib.blake2b(f"{worker_id}:{key}".encode(), digest_size=8).digest()
+    return max(workers, key=weight)
+
+
+def update_user_id(update) -> Optional[int]:
+    """id отправителя в обновлении Telegram - поле from у события (message, callback_query и т.д.).
+
+    update - разобранное тело запроса; если это не объект JSON, возвращается None.
+    """
+    if not isinstance(update, dict):
+        return None
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return None
+
+
+class WorkerRouter:
+    """Закрепляет каждого пользователя за одним воркером, чтобы его буферы, очередь и кэш сессии жили в одном процессе.
+
+    Обновление, пришедшее не на тот воркер, пересылается владельцу. Если владелец недоступен,
+    обновление обрабатывается на месте: общее состояние все равно лежит в StateBackend и базе.
+    """
+
+    def __init__(self, worker_id: str = WORKER_ID, workers: Dict[str, str] = None, webhook_path: str = "/webhook"):
+        self.worker_id = worker_id
+        self.workers = workers if workers is not None else parse_workers(WORKER_URLS)
+        self.webhook_path = webhook_path
+        self.enabled = len(self.workers) > 1 and worker_id in self.workers
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.local = 0
+        self.forwarded = 0
+        self.forward_errors = 0
+        if self.workers and not self.enabled:
+            logger.warning(f"Worker routing disabled: WORKER_ID {worker_id!r} is not in WORKER_URLS or only one worker")
+
+    def owner(self, user_id) -> str:
+        return rendezvous_owner(user_id, self.workers)
+
+    async def forward(self, owner: str, body: bytes, secret: Optional[str]) -> Optional[int]:
+        """Пересылает обновление воркеру-владельцу; возвращает HTTP-статус или None, если он недоступен."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT))
+        headers = {"Content-Type": "application/json", FORWARDED_HEADER: self.worker_id}
+        if secret:
+            headers[SECRET_HEADER] = secret
+        try:
+            async with self.session.post(self.workers[owner] + self.webhook_path, data=body, headers=headers) as response:
+                self.forwarded += 1
+                return response.status
+        except Exception as e:
+            self.forward_errors += 1
+            logger.warning(f"Failed to forward update to worker {owner}: {e}")
+            return None
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+
+    def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "workers": len(self.workers),
+            "enabled": self.enabled,
+            "local": self.local,
+            "forwarded": self.forwarded,
+            "forward_errors": self.forward_errors,
+        }
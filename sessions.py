@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from context import CONTEXT_MAX_TURNS
+from db import Database
+from model_registry import DEFAULT_MODEL_ID
+from state import MemoryBackend, StateBackend
+
+load_dotenv()
+
+# Время жизни сессии в памяти, максимум пользователей и примерный лимит памяти на все сессии
+SESSION_TTL = float(os.getenv("SESSION_TTL", "1800"))
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(32 * 1024 * 1024)))
+
+RECORD_OVERHEAD = 200  # примерный размер словаря записи без учета строк
+
+logger = logging.getLogger("bot.sessions")
+
+
+def record_size(record: Dict) -> int:
+    return len(record["query"] or "") + len(record["response"] or "") + len(record["image_ids"] or "") + RECORD_OVERHEAD
+
+
+@dataclass
+class UserSession:
+    model_type: str
+    turns: List[Dict] = field(default_factory=list)
+    summary: Optional[Dict] = None
+    size: int = 0
+    expires_at: float = 0.0
+    shared_version: int = 0
+
+
+class SessionStore:
+    """Кэш сессий пользователей перед базой: последние записи истории, модель и сводка.
+
+    Повторяет интерфейс Database, поэтому обработчики и ContextWindow работают с ним так же, как с базой.
+    Новые записи сразу попадают в память, а в базу уходят через очередь пакетной записи Database.
+    С общим StateBackend каждое изменение увеличивает версию сессии в нем, и другие воркеры
+    перечитывают свою копию из базы.
+    """
+
+    def __init__(self, db: Database, state: StateBackend = None, max_turns: int = CONTEXT_MAX_TURNS,
+                 ttl: float = SESSION_TTL, max_users: int = SESSION_MAX_USERS, max_bytes: int = SESSION_MAX_BYTES):
+        self.db = db
+        self.state = state or MemoryBackend()
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.sessions: "OrderedDict[int, UserSession]" = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+        # Блокировки и версии живут только пока сессия загружается, иначе копились бы по всем пользователям
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._versions: Dict[int, int] = {}
+        self._loading: Dict[int, int] = {}  # сколько загрузок сессии идет или ждет блокировку
+
+    async def _shared_version(self, user_id) -> int:
+        if not self.state.shared:
+            return 0
+        value = await self.state.get(f"session:{user_id}:version")
+        return int(value) if value else 0
+
+    async def _publish(self, user_id, session: Optional[UserSession]):
+        """Сообщает другим воркерам, что их копия сессии устарела."""
+        if self.state.shared:
+            version = await self.state.incr(f"session:{user_id}:version")
+            if session:
+                session.shared_version = version
+
+    async def _session(self, user_id) -> UserSession:
+        session = self.sessions.get(user_id)
+        if session and session.expires_at > time.monotonic():
+            if session.shared_version == await self._shared_version(user_id):
+                self.sessions.move_to_end(user_id)
+                self.hits += 1
+                return session
+            self.stale += 1
+            self.invalidate(user_id)
+
+        self._loading[user_id] = self._loading.get(user_id, 0) + 1
+        lock = self._locks.setdefault(user_id, asyncio.Lock())
+        try:
+            async with lock:
+                session = self.sessions.get(user_id)
+                if session and session.expires_at > time.monotonic():
+                    self.hits += 1
+                    return session
+                self.misses += 1
+                self._drop(user_id)
+
+                version = self._versions.get(user_id, 0)
+                shared_version = await self._shared_version(user_id)
+                # Database.get_history уже учитывает строки, ожидающие пакетной записи
+                turns = await self.db.get_history(user_id, limit=self.max_turns)
+                model_type = await self.db.get_current_model(user_id)
+                summary = await self.db.get_summary(user_id)
+
+                session = UserSession(model_type=model_type, turns=turns, summary=summary,
+                                      expires_at=time.monotonic() + self.ttl, shared_version=shared_version)
+                session.size = sum(record_size(record) for record in session.turns)
+
+                if self._versions.get(user_id, 0) != version:
+                    # Пока читали базу, сессию изменили или сбросили - не кэшируем устаревший снимок
+                    return session
+                self.sessions[user_id] = session
+                self.size += session.size
+                self._evict()
+                return session
+        finally:
+            self._loading[user_id] -= 1
+            if not self._loading[user_id]:
+                del self._loading[user_id]
+                self._locks.pop(user_id, None)
+                self._versions.pop(user_id, None)
+
+    def _drop(self, user_id):
+        session = self.sessions.pop(user_id, None)
+        if session:
+            self.size -= session.size
+
+    def _evict(self):
+        while self.sessions and (len(self.sessions) > self.max_users or self.size > self.max_bytes):
+            user_id, session = self.sessions.popitem(last=False)
+            self.size -= session.size
+            self.evictions += 1
+
+    def _touch(self, user_id):
+        # Изменение во время загрузки увеличивает версию, чтобы загрузка не закэшировала старые данные
+        if user_id in self._loading:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def invalidate(self, user_id):
+        self._touch(user_id)
+        self._drop(user_id)
+
+    async def get_history(self, user_id, limit: int = None) -> List[Dict]:
+        if limit is None or limit > self.max_turns:
+            return await self.db.get_history(user_id, limit=limit)
+        session = await self._session(user_id)
+        return list(session.turns[-limit:])
+
+    async def get_current_model(self, user_id) -> str:
+        return (await self._session(user_id)).model_type
+
+    async def get_summary(self, user_id) -> Optional[Dict]:
+        return (await self._session(user_id)).summary
+
+    async def add_record(self, user_id, query, response, image_ids: List[str] = None, model_type: str = DEFAULT_MODEL_ID):
+        record = {
+            "query": query,
+            "response": response,
+            "image_ids": ",".join(image_ids) if image_ids else None,
+            "model_type": model_type,
+            "timestamp": datetime.utcnow(),
+        }
+        self._touch(user_id)
+        session = self.sessions.get(user_id)
+        if session:
+            session.turns.append(record)
+            session.size += record_size(record)
+            self.size += record_size(record)
+            while len(session.turns) > self.max_turns:
+                removed = session.turns.pop(0)
+                session.size -= record_size(removed)
+                self.size -= record_size(removed)
+            self._evict()
+
+        await self.db.add_record(user_id, query, response, image_ids, model_type, timestamp=record["timestamp"])
+        await self._publish(user_id, session)
+
+    async def set_model(self, user_id, model_id: str):
+        model_id = await self.db.set_model(user_id, model_id)
+        self._touch(user_id)
+        session = self.sessions.get(user_id)
+        if session:
+            session.model_type = model_id
+        await self._publish(user_id, session)
+        return model_id
+
+    async def set_summary(self, user_id, summary: str, covered_until: datetime):
+        await self.db.set_summary(user_id, summary, covered_until)
+        self._touch(user_id)
+        session = self.sessions.get(user_id)
+        if session:
+            session.summary = {"summary": summary, "covered_until": covered_until}
+        await self._publish(user_id, session)
+
+    async def clear_history(self, user_id):
+        self.invalidate(user_id)
+        await self.db.clear_history(user_id)
+        self.invalidate(user_id)
+        await self._publish(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale": self.stale,
+        }
@@ -0,0 +1,156 @@
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# memory:// - состояние в памяти процесса (один воркер), redis://host:6379/0 - общее для нескольких воркеров
+STATE_BACKEND_URL = os.getenv("STATE_BACKEND_URL", "memory://")
+
+logger = logging.getLogger("bot.state")
+
+
+class StateBackend(ABC):
+    """Хранилище состояния, которое должно быть общим для воркеров: буферы debounce, версии сессий, изображения.
+
+    Ключи - строки, значения - bytes. shared=False означает, что данные видны только этому процессу.
+    """
+
+    shared = False
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        """Значение key или None, если ключа нет или он просрочен."""
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float = None):
+        """Записывает значение; ttl - срок жизни в секундах, None - бессрочно."""
+
+    @abstractmethod
+    async def delete(self, *keys: str):
+        """Удаляет ключи; отсутствующие пропускаются."""
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        """Атомарно увеличивает счетчик key на 1 и возвращает новое значение."""
+
+    @abstractmethod
+    async def append(self, key: str, value: bytes, ttl: float = None) -> int:
+        """Добавляет значение в конец списка key и возвращает его длину."""
+
+    @abstractmethod
+    async def pop_all(self, key: str) -> List[bytes]:
+        """Атомарно забирает и удаляет весь список key."""
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """Состояние в памяти процесса; просроченные ключи удаляются при обращении."""
+
+    def __init__(self):
+        self.values: Dict[str, object] = {}
+        self.expires: Dict[str, float] = {}
+
+    def _alive(self, key: str) -> bool:
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.values
+
+    def _expire(self, key: str, ttl: float = None):
+        if ttl:
+            self.expires[key] = time.monotonic() + ttl
+        else:
+            self.expires.pop(key, None)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.values[key] if self._alive(key) else None
+
+    async def set(self, key: str, value: bytes, ttl: float = None):
+        self.values[key] = value
+        self._expire(key, ttl)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+
+    async def incr(self, key: str) -> int:
+        value = (self.values[key] if self._alive(key) else 0) + 1
+        self.values[key] = value
+        return value
+
+    async def append(self, key: str, value: bytes, ttl: float = None) -> int:
+        if not self._alive(key):
+            self.values[key] = []
+        self.values[key].append(value)
+        self._expire(key, ttl)
+        return len(self.values[key])
+
+    async def pop_all(self, key: str) -> List[bytes]:
+        values = self.values.pop(key, []) if self._alive(key) else []
+        self.expires.pop(key, None)
+        return values
+
+
+class RedisBackend(StateBackend):
+    """Состояние в Redis (или совместимом сервере) - общее для всех воркеров. Нужен пакет redis."""
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = "bot:"):
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise ImportError("STATE_BACKEND_URL points to Redis, install it with: pip install redis") from e
+        self.client = redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: float = None):
+        await self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self.client.delete(*(self.prefix + key for key in keys))
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(self.prefix + key)
+
+    async def append(self, key: str, value: bytes, ttl: float = None) -> int:
+        key = self.prefix + key
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, value)
+            if ttl:
+                pipe.pexpire(key, int(ttl * 1000))
+            length, *_ = await pipe.execute()
+        return length
+
+    async def pop_all(self, key: str) -> List[bytes]:
+        key = self.prefix + key
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            values, _ = await pipe.execute()
+        return values
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_backend(url: str = STATE_BACKEND_URL) -> StateBackend:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        logger.info(f"State backend: Redis at {url.split('@')[-1]}")
+        return RedisBackend(url)
+    if url.startswith("memory://"):
+        return MemoryBackend()
+    raise ValueError(f"Unsupported STATE_BACKEND_URL: {url}")
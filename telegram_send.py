@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List
+
+from aiogram import Bot
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
+from dotenv import load_dotenv
+
+from formatting import MAX_MESSAGE_LENGTH, html_to_plain, split_html
+
+load_dotenv()
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный чат, 20 в минуту в группу
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "5"))
+SEND_BACKOFF_BASE = 1.0
+SEND_BACKOFF_MAX = 30.0
+MAX_TRACKED_CHATS = 10000
+
+logger = logging.getLogger("bot.send")
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class SendLimiter:
+    """Общий лимит бота и отдельные лимиты для каждого чата."""
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 group_rate: float = TELEGRAM_GROUP_RATE, chat_burst: int = TELEGRAM_CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            # У групп и каналов отрицательные id
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self.chats[chat_id] = TokenBucket(rate, self.chat_burst)
+            if len(self.chats) > MAX_TRACKED_CHATS:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id: int):
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    def block(self, chat_id: int, seconds: float):
+        """Telegram прислал retry_after - чат ждет указанное время."""
+        self._chat_bucket(chat_id).block(seconds)
+
+
+@dataclass
+class SendResult:
+    delivered: List[int] = field(default_factory=list)  # индексы доставленных частей
+    plain: List[int] = field(default_factory=list)  # части, отправленные без форматирования
+    failed: List[int] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+def is_parse_error(error: TelegramBadRequest) -> bool:
+    return "can't parse" in str(error).lower()
+
+
+def backoff_delay(attempt: int) -> float:
+    """Экспоненциальная задержка со случайным разбросом, чтобы повторы не шли синхронно."""
+    return min(SEND_BACKOFF_MAX, SEND_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+class MessageSender:
+    """Отправляет длинные ответы частями с учетом лимитов Telegram и повторами только для неотправленных частей."""
+
+    def __init__(self, bot: Bot, limiter: SendLimiter, retries: int = SEND_RETRIES):
+        if retries < 1:
+            # Без единой попытки _send ничего не отправил бы, а send_html посчитал бы часть доставленной
+            raise ValueError(f"retries must be at least 1, got {retries}")
+        self.bot = bot
+        self.limiter = limiter
+        self.retries = retries
+        self.sent = 0
+        self.plain_fallbacks = 0
+        self.failed = 0
+        self.retried = 0
+        self.flood_waits = 0
+
+    async def send_html(self, chat_id: int, text: str) -> SendResult:
+        chunks = split_html(text, MAX_MESSAGE_LENGTH)
+        result = SendResult()
+        for index, chunk in enumerate(chunks):
+            try:
+                try:
+                    await self._send(chat_id, chunk, parse_mode="HTML")
+                except TelegramBadRequest as e:
+                    if not is_parse_error(e):
+                        raise
+                    # Без форматирования отправляется только та часть, которую Telegram не смог разобрать
+                    logger.warning(f"Chat {chat_id}: part {index + 1}/{len(chunks)} rejected as HTML ({e}), sending as plain text")
+                    await self._send(chat_id, html_to_plain(chunk), parse_mode=None)
+                    result.plain.append(index)
+                    self.plain_fallbacks += 1
+                result.delivered.append(index)
+            except TelegramForbiddenError as e:
+                # Пользователь заблокировал бота - остальные части отправлять бессмысленно
+                logger.warning(f"Chat {chat_id}: bot is blocked, dropping {len(chunks) - index} parts: {e}")
+                result.failed.extend(range(index, len(chunks)))
+                self.failed += len(chunks) - index
+                break
+            except Exception as e:
+                logger.error(f"Chat {chat_id}: failed to deliver part {index + 1}/{len(chunks)}: {e}")
+                result.failed.append(index)
+                self.failed += 1
+        return result
+
+    async def _send(self, chat_id: int, text: str, parse_mode):
+        for attempt in range(self.retries):
+            await self.limiter.acquire(chat_id)
+            try:
+                message = await self.bot.send_message(chat_id, text, parse_mode=parse_mode, disable_web_page_preview=True)
+                self.sent += 1
+                return message
+            except TelegramRetryAfter as e:
+                if attempt == self.retries - 1:
+                    raise
+                self.flood_waits += 1
+                logger.warning(f"Chat {chat_id}: flood control, retry after {e.retry_after}s")
+                # Следующий acquire для этого чата подождет, сколько просит Telegram
+                self.limiter.block(chat_id, e.retry_after + random.uniform(0, 1))
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self.retries - 1:
+                    raise
+                self.retried += 1
+                delay = backoff_delay(attempt)
+                logger.warning(f"Chat {chat_id}: send failed (attempt {attempt + 1}/{self.retries}): {e}, retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        raise RuntimeError(f"Chat {chat_id}: no send attempts were made")
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "plain_fallbacks": self.plain_fallbacks,
+            "failed": self.failed,
+            "retried": self.retried,
+            "flood_waits": self.flood_waits,
+        }
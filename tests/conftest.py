@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from db import Database
+from fake_gemini import FakeGemini
+
+
+# Асинхронные тесты и фикстуры запускает pytest-asyncio (asyncio_mode = auto в pytest.ini): у каждого теста свой
+# event loop, а фикстуры ниже создаются и закрываются в нем же.
+
+@pytest.fixture
+async def db(tmp_path):
+    """Пустая база SQLite во временном каталоге теста."""
+    database = Database(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+    await database.init()
+    yield database
+    await database.close()
+
+
+@pytest.fixture
+async def fake_gemini():
+    """Локальный стенд Gemini API, см. fake_gemini.py."""
+    fake = await FakeGemini().start()
+    yield fake
+    await fake.stop()
@@ -0,0 +1,137 @@
+"""Локальный стенд Gemini API для тестов: Files API, кэши контекста и generateContent.
+
+Клиент SDK направляется на стенд через http_options={"base_url": ...} - так же, как бот через GEMINI_BASE_URL.
+Стенд работает в том же event loop, что и тест: вызовы SDK идут из потоков generation_pool.
+"""
+import asyncio
+import itertools
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+from google import genai
+
+from gemini_api import create_client
+
+
+def _timestamp(moment: datetime) -> str:
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def file_uri(part: dict):
+    """URI файла из части запроса. SDK 0.3.0 пишет поля FileData в snake_case, API принимает оба написания."""
+    file_data = part.get("fileData") or {}
+    return file_data.get("fileUri") or file_data.get("file_uri")
+
+
+class FakeGemini:
+    def __init__(self, file_ttl: timedelta = timedelta(hours=48)):
+        self.file_ttl = file_ttl
+        self.files = {}  # имя файла -> загруженные байты
+        self.caches = {}  # имя кэша -> тело запроса на создание
+        self.deleted_caches = []
+        self.requests = []  # тела запросов generateContent
+        self.connections = set()  # адреса клиентов generateContent: по ним видно, переиспользуются ли соединения
+        self.fail_uploads = False
+        self.reject_caches = False
+        self.stall = False  # generateContent не отвечает, пока стенд не остановят
+        self.cached_tokens = 100  # столько входных токенов стенд считает взятыми из кэша
+        self._ids = itertools.count(1)
+        self._sessions = {}  # id сессии загрузки -> метаданные файла
+        self.url = ""
+        self._runner = None
+        self._released = None
+
+    async def start(self) -> "FakeGemini":
+        self._released = asyncio.Event()
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/upload/v1beta/files", self._start_upload)
+        app.router.add_post("/upload/session/{session}", self._finish_upload)
+        app.router.add_post("/v1beta/cachedContents", self._create_cache)
+        app.router.add_delete("/v1beta/cachedContents/{cache}", self._delete_cache)
+        app.router.add_post("/v1beta/models/{call}", self._generate)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        if self._released:
+            self._released.set()
+        if self._runner:
+            await self._runner.cleanup()
+
+    def client(self) -> genai.Client:
+        return create_client(api_key="test", base_url=self.url)
+
+    @staticmethod
+    def _error(status: int, message: str) -> web.Response:
+        return web.json_response({"error": {"code": status, "message": message, "status": "ERROR"}}, status=status)
+
+    async def _start_upload(self, request: web.Request) -> web.Response:
+        if self.fail_uploads:
+            return self._error(503, "upload unavailable")
+        assert request.headers["X-Goog-Upload-Command"] == "start"
+        metadata = (await request.json())["file"]
+        session = str(next(self._ids))
+        self._sessions[session] = metadata
+        return web.json_response({}, headers={"X-Goog-Upload-URL": f"{self.url}/upload/session/{session}"})
+
+    async def _finish_upload(self, request: web.Request) -> web.Response:
+        metadata = self._sessions.pop(request.match_info["session"])
+        assert "finalize" in request.headers["X-Goog-Upload-Command"]
+        name = f"files/f{next(self._ids)}"
+        self.files[name] = await request.read()
+        body = {"file": {
+            "name": name,
+            "displayName": metadata.get("displayName"),
+            "mimeType": metadata.get("mimeType"),
+            "sizeBytes": str(len(self.files[name])),
+            "uri": f"{self.url}/v1beta/{name}",
+            "expirationTime": _timestamp(datetime.now(timezone.utc) + self.file_ttl),
+            "state": "ACTIVE",
+        }}
+        return web.json_response(body, headers={"X-Goog-Upload-Status": "final"})
+
+    async def _create_cache(self, request: web.Request) -> web.Response:
+        if self.reject_caches:
+            return self._error(400, "caching is not supported for this model")
+        body = await request.json()
+        name = f"cachedContents/c{next(self._ids)}"
+        self.caches[name] = body
+        return web.json_response({"name": name, "model": body.get("model"),
+                                  "expireTime": _timestamp(datetime.now(timezone.utc) + timedelta(hours=1))})
+
+    async def _delete_cache(self, request: web.Request) -> web.Response:
+        name = "cachedContents/" + request.match_info["cache"]
+        if self.caches.pop(name, None) is None:
+            return self._error(404, f"{name} not found")
+        self.deleted_caches.append(name)
+        return web.json_response({})
+
+    async def _generate(self, request: web.Request) -> web.Response:
+        model, _, method = request.match_info["call"].partition(":")
+        if method != "generateContent":
+            return self._error(404, f"unsupported method {method}")
+        body = await request.json()
+        self.requests.append(body)
+        self.connections.add(request.transport.get_extra_info("peername"))
+        if self.stall:
+            await self._released.wait()
+        cache = body.get("cachedContent")
+        if cache is not None and cache not in self.caches:
+            return self._error(404, f"{cache} not found")
+        for part in body["contents"][-1]["parts"]:
+            uri = file_uri(part)
+            if uri is not None and uri.rsplit("/v1beta/", 1)[-1] not in self.files:
+                return self._error(400, f"unknown file {uri}")
+        usage = {"promptTokenCount": 1000, "candidatesTokenCount": 5, "totalTokenCount": 1005}
+        if cache is not None:
+            usage["cachedContentTokenCount"] = self.cached_tokens
+        return web.json_response({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": f"ответ {model}"}]}, "finishReason": "STOP"}],
+            "usageMetadata": usage,
+        })
+
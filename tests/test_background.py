@@ -0,0 +1,21 @@
+import asyncio
+import gc
+
+from background import BackgroundTasks
+
+
+async def test_tasks_are_kept_until_done():
+    tasks = BackgroundTasks()
+    done = []
+
+    async def job(value):
+        await asyncio.sleep(0.01)
+        done.append(value)
+        if value == 1:
+            tasks.spawn(job(2))  # задача, запущенная во время wait, тоже дожидается
+
+    tasks.spawn(job(1))
+    gc.collect()
+    assert len(tasks) == 1
+    await tasks.wait()
+    assert done == [1, 2] and len(tasks) == 0
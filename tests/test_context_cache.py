@@ -0,0 +1,109 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from context_cache import ContextCacheManager
+from gemini_api import GeminiModel
+from model_registry import MODELS
+
+SPEC = MODELS[0]
+USER = 1
+HEADER = ["Сводка: пользователь изучает Python."]
+TAIL = ["Текущий запрос: что дальше?"]
+START = datetime(2026, 1, 1)
+
+
+def turns(count: int):
+    records = [{"timestamp": START + timedelta(minutes=i), "query": f"вопрос {i}", "response": f"ответ {i}"}
+               for i in range(count)]
+    return [(record, f"Запрос: {record['query']}\nОтвет: {record['response']}") for record in records]
+
+
+@pytest.fixture
+def model(fake_gemini):
+    return GeminiModel(SPEC, fake_gemini.client())
+
+
+@pytest.fixture
+def manager(model):
+    """Менеджер с низкими порогами; создание и удаление кэшей дожидаются через manager.tasks.wait()."""
+    return ContextCacheManager(lambda model_id: model, enabled=True, min_tokens=1, rebuild_turns=3)
+
+
+async def test_stable_prefix_is_cached_and_reused(fake_gemini, model, manager):
+    text, cache = manager.prompt(USER, SPEC.id, HEADER, turns(4), TAIL)
+    assert cache is None
+    await manager.tasks.wait()
+    (name, body), = fake_gemini.caches.items()
+    assert body["contents"][0]["parts"][0]["text"] == text[:-len(TAIL[0]) - 1]
+    assert "systemInstruction" in body or "system_instruction" in body
+
+    text, cache = manager.prompt(USER, SPEC.id, HEADER, turns(5), TAIL)
+    assert cache.name == name
+    assert cache.query == "\n".join([turns(5)[4][1]] + TAIL)
+    assert await model.generate_content(text, cache=cache) == f"ответ {SPEC.id}"
+    request = fake_gemini.requests[-1]
+    assert request["cachedContent"] == name
+    assert request["contents"][-1]["parts"][0]["text"] == cache.query
+    assert (model.prompt_tokens, model.cached_tokens) == (1000, fake_gemini.cached_tokens)
+    assert (manager.hits, manager.misses) == (1, 1)
+
+
+async def test_cache_is_rebuilt_after_many_new_turns(fake_gemini, manager):
+    manager.prompt(USER, SPEC.id, HEADER, turns(2), TAIL)
+    await manager.tasks.wait()
+    old = manager.entries[USER, SPEC.id].name
+    _, cache = manager.prompt(USER, SPEC.id, HEADER, turns(5), TAIL)
+    assert cache.name == old  # текущий запрос идет со старым кэшем, новый создается в фоне
+    await manager.tasks.wait()
+    assert old in fake_gemini.deleted_caches
+    assert manager.entries[USER, SPEC.id].name != old
+    assert len(manager.entries[USER, SPEC.id].turn_keys) == 5
+
+
+async def test_clear_and_model_switch_delete_caches(fake_gemini, manager):
+    manager.prompt(USER, SPEC.id, HEADER, turns(2), TAIL)
+    manager.prompt(USER, "other-model", HEADER, turns(2), TAIL)
+    manager.prompt(USER + 1, SPEC.id, HEADER, turns(2), TAIL)
+    await manager.tasks.wait()
+    assert len(manager.entries) == 3
+
+    manager.invalidate(USER, "other-model")
+    assert set(manager.entries) == {(USER, SPEC.id), (USER + 1, SPEC.id)}
+    manager.invalidate(USER)
+    assert set(manager.entries) == {(USER + 1, SPEC.id)}
+    await manager.tasks.wait()
+    assert len(fake_gemini.deleted_caches) == 2
+    assert len(fake_gemini.caches) == 1
+
+
+async def test_changed_summary_invalidates_cache(fake_gemini, manager):
+    manager.prompt(USER, SPEC.id, HEADER, turns(2), TAIL)
+    await manager.tasks.wait()
+    _, cache = manager.prompt(USER, SPEC.id, ["Сводка: новая тема."], turns(2), TAIL)
+    assert cache is None
+    await manager.tasks.wait()
+    assert fake_gemini.deleted_caches
+
+
+async def test_rejected_cache_falls_back_to_full_prompt(fake_gemini, model, manager):
+    manager.prompt(USER, SPEC.id, HEADER, turns(2), TAIL)
+    await manager.tasks.wait()
+    fake_gemini.caches.clear()  # кэш истек на стороне API раньше срока
+    text, cache = manager.prompt(USER, SPEC.id, HEADER, turns(3), TAIL)
+    assert await model.generate_content(text, cache=cache) == f"ответ {SPEC.id}"
+    assert cache.failed
+    assert "cachedContent" not in fake_gemini.requests[-1]
+    assert fake_gemini.requests[-1]["contents"][-1]["parts"][0]["text"] == text
+    manager.release(USER, cache)
+    assert not manager.entries and manager.rejected == 1
+
+
+async def test_model_without_caching_is_not_retried(fake_gemini, manager):
+    fake_gemini.reject_caches = True
+    manager.prompt(USER, SPEC.id, HEADER, turns(2), TAIL)
+    await manager.tasks.wait()
+    assert manager.create_errors == 1 and SPEC.id in manager.unsupported
+    manager.prompt(USER, SPEC.id, HEADER, turns(3), TAIL)
+    await manager.tasks.wait()
+    assert manager.create_errors == 1 and not manager.entries
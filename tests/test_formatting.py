@@ -0,0 +1,125 @@
+import re
+import time
+
+from hypothesis import given, settings, strategies as st
+
+from formatting import TAG_NAME_RE, html_to_plain, render_html, split_html, split_text, utf16_len
+
+TAG_RE = re.compile(r"<[^<>]*>")
+AMPERSAND_RE = re.compile(r"&(?![#\w]+;)")
+WHITESPACE_RE = re.compile(r"\s+")
+
+# Markdown из ответов Gemini: разметка, переносы, HTML-символы и символы вне BMP
+MARKDOWN = st.lists(st.sampled_from(list("ab cd\n*_~`#-[]()<>&") + ["😀", "é", "```", "```py\n", "**", "***", "___"]),
+                    max_size=400).map("".join)
+LIMITS = st.integers(min_value=16, max_value=300)
+
+
+def _element(children):
+    language = st.text(alphabet="py😀é", min_size=1, max_size=40)
+    opening = st.one_of(
+        st.sampled_from(["<b>", "<i>", "<u>", "<s>", "<code>", "<pre>"]),
+        language.map(lambda name: f'<code class="language-{name}">'),
+        st.text(alphabet="abc/😀", min_size=1, max_size=60).map(lambda url: f'<a href="https://{url}">'),
+    )
+    return st.tuples(opening, st.lists(children, max_size=4)).map(
+        lambda pair: pair[0] + "".join(pair[1]) + "</" + TAG_NAME_RE.match(pair[0]).group(2) + ">")
+
+
+HTML = st.recursive(
+    st.lists(st.sampled_from(list("ab \n") + ["😀", "&amp;", "&lt;", "x" * 24]), max_size=60).map("".join),
+    _element,
+    max_leaves=20,
+).map(lambda node: node if isinstance(node, str) else "".join(node))
+
+
+def assert_balanced(chunk: str):
+    stack = []
+    for tag in TAG_RE.findall(chunk):
+        closing, name = TAG_NAME_RE.match(tag).groups()
+        if closing:
+            assert stack and stack.pop() == name, chunk
+        else:
+            stack.append(name)
+    assert not stack, chunk
+
+
+def assert_valid_split(text: str, chunks: list, limit: int):
+    for chunk in chunks:
+        assert chunk
+        assert utf16_len(chunk) <= limit, chunk
+        assert_balanced(chunk)
+        assert not AMPERSAND_RE.search(chunk), chunk
+    # Разрезы могут съесть пробелы на границах, но не видимый текст
+    expected = WHITESPACE_RE.sub("", html_to_plain(text))
+    assert WHITESPACE_RE.sub("", "".join(html_to_plain(chunk) for chunk in chunks)) == expected
+
+
+@settings(max_examples=300)
+@given(MARKDOWN, LIMITS)
+def test_split_rendered_markdown(markdown, limit):
+    text = render_html(markdown)
+    assert_valid_split(text, split_html(text, limit), limit)
+
+
+@settings(max_examples=300)
+@given(HTML, LIMITS)
+def test_split_nested_html(text, limit):
+    assert_valid_split(text, split_html(text, limit), limit)
+
+
+@settings(max_examples=300)
+@given(st.text(alphabet="ab \n😀é", max_size=600), LIMITS)
+def test_split_text(text, limit):
+    chunks = split_text(text, limit)
+    assert all(utf16_len(chunk) <= limit for chunk in chunks)
+    assert WHITESPACE_RE.sub("", "".join(chunks)) == WHITESPACE_RE.sub("", text)
+
+
+def test_reopened_tags_longer_than_limit():
+    text = '<pre><code class="language-py">' + "a" * 50 + "</code></pre>"
+    chunks = split_html(text, 20)
+    assert_valid_split(text, chunks, 20)
+
+
+def test_astral_characters_in_tags_count_as_two_units():
+    text = '<code class="language-😀">' + "x" * 5000 + "</code>"
+    chunks = split_html(text)
+    assert_valid_split(text, chunks, 4096)
+    assert len(chunks) == 2
+
+
+@given(st.text(alphabet="a😀", min_size=1, max_size=2000), LIMITS)
+def test_astral_text_fills_chunks(text, limit):
+    # Без пробелов текст режется как есть: каждый кусок, кроме последнего, заполнен почти до лимита
+    chunks = split_text(text, limit)
+    assert all(utf16_len(chunk) >= limit - 1 for chunk in chunks[:-1])
+
+
+def test_short_text_is_returned_as_is():
+    assert split_html("<b>hi</b>") == ["<b>hi</b>"]
+    assert split_html("") == []
+
+
+@settings(max_examples=300)
+@given(MARKDOWN)
+def test_rendered_markdown_is_balanced(markdown):
+    assert_balanced(render_html(markdown))
+
+
+def test_triple_markers_are_bold_italic():
+    assert render_html("***x***") == "<b><i>x</i></b>"
+    assert render_html("___x___") == "<u><i>x</i></u>"
+    assert render_html("**a *b***") == "<b>a <i>b</i></b>"
+    assert render_html("*a **b***") == "<i>a <b>b</b></i>"
+    assert render_html("***x** y*") == "<i><b>x</b> y</i>"
+    assert render_html("***x* y**") == "<b><i>x</i> y</b>"
+    assert render_html("snake___case") == "snake___case"
+
+
+def test_unmatched_brackets_are_linear():
+    started = time.perf_counter()
+    assert render_html("[" * 100000) == "[" * 100000
+    render_html(("[" + "a" * 999) * 100)
+    assert time.perf_counter() - started < 1
+    assert render_html("[[a](https://x.y)]") == '[<a href="https://x.y">a</a>]'
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import gemini_api
+from gemini_api import GeminiModel, GenerationPool, generation_pool
+from model_registry import MODELS
+
+
+async def test_slot_wait_counts_against_timeout():
+    pool = GenerationPool(max_workers=2, max_concurrency=2)
+    hang = threading.Event()
+    try:
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                await pool.run(hang.wait, timeout=0.05)
+        assert pool.in_flight == 2  # брошенные потоки все еще держат слоты
+
+        started = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.run(lambda: "ответ", timeout=0.2)
+        assert time.monotonic() - started < 1
+        with pytest.raises(asyncio.TimeoutError):
+            async for _ in pool.stream(lambda: iter(["чанк"]), timeout=0.2):
+                pass
+        assert pool.waiting == 0
+    finally:
+        hang.set()
+        pool.shutdown()
+
+
+async def test_hung_http_request_frees_its_slot(fake_gemini, monkeypatch):
+    monkeypatch.setattr(gemini_api, "GEMINI_HTTP_SLACK", 0.2)
+    fake_gemini.stall = True
+    # Пул общий на процесс: потоки из прошлых тестов, завершившиеся после их event loop, остаются в счетчике
+    before = generation_pool.in_flight
+    model = GeminiModel(MODELS[0], fake_gemini.client())
+    with pytest.raises(asyncio.TimeoutError):
+        await model.generate_content("вопрос", timeout=0.2)
+    # Поток SDK получает свой HTTP-таймаут и возвращает слот, не дожидаясь ответа сервера
+    for _ in range(300):
+        if generation_pool.in_flight == before:
+            break
+        await asyncio.sleep(0.01)
+    assert generation_pool.in_flight == before
+
+
+async def test_models_share_one_connection(fake_gemini):
+    client = fake_gemini.client()
+    models = [GeminiModel(spec, client) for spec in MODELS[:2]]
+    for _ in range(3):
+        for model in models:
+            assert await model.generate_content("вопрос") == f"ответ {model.model_id}"
+    assert len(fake_gemini.requests) == 6
+    assert len(fake_gemini.connections) == 1
@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from fake_gemini import file_uri
+from gemini_api import GeminiModel, UploadedFile
+from gemini_files import GeminiFileUploader
+from image_cache import CachedImage
+from model_registry import MODELS
+
+IMAGE = CachedImage(b"\xff\xd8\xff" + b"jpeg" * 1000, "image/jpeg", "photo-1")
+
+
+async def test_image_is_uploaded_once(fake_gemini, db):
+    uploader = GeminiFileUploader(fake_gemini.client(), db)
+    first, = await uploader.resolve([IMAGE])
+    second, = await uploader.resolve([IMAGE._replace(file_id="photo-2")])
+    assert isinstance(first, UploadedFile) and first.uri.startswith(fake_gemini.url)
+    assert (second.uri, second.file_id) == (first.uri, "photo-2")
+    assert list(fake_gemini.files.values()) == [IMAGE.data]
+    assert (uploader.uploaded, uploader.reused, uploader.bytes_saved) == (1, 1, len(IMAGE.data))
+
+
+async def test_concurrent_requests_share_one_upload(fake_gemini, db):
+    uploader = GeminiFileUploader(fake_gemini.client(), db)
+    resolved = await uploader.resolve([IMAGE, IMAGE, IMAGE])
+    assert len({image.uri for image in resolved}) == 1
+    assert len(fake_gemini.files) == 1
+
+
+async def test_reference_is_reused_after_restart(fake_gemini, db):
+    first, = await GeminiFileUploader(fake_gemini.client(), db).resolve([IMAGE])
+    restarted = GeminiFileUploader(fake_gemini.client(), db)
+    second, = await restarted.resolve([IMAGE])
+    assert second.uri == first.uri
+    assert (restarted.uploaded, restarted.reused) == (0, 1)
+
+
+async def test_expiring_file_is_uploaded_again(fake_gemini, db):
+    # Файл истекает раньше запаса GEMINI_FILE_EXPIRY_MARGIN, поэтому ссылка сразу считается устаревшей
+    fake_gemini.file_ttl = timedelta(minutes=30)
+    uploader = GeminiFileUploader(fake_gemini.client(), db)
+    first, = await uploader.resolve([IMAGE])
+    second, = await uploader.resolve([IMAGE])
+    assert second.uri != first.uri
+    assert (uploader.uploaded, uploader.reuploaded) == (2, 1)
+
+
+async def test_failed_upload_falls_back_to_inline_bytes(fake_gemini, db):
+    fake_gemini.fail_uploads = True
+    uploader = GeminiFileUploader(fake_gemini.client(), db)
+    assert await uploader.resolve([IMAGE]) == [IMAGE]
+    assert uploader.failed == 1
+
+
+async def test_request_references_uploaded_file(fake_gemini, db):
+    client = fake_gemini.client()
+    uploaded, = await GeminiFileUploader(client, db).resolve([IMAGE])
+    model = GeminiModel(MODELS[0], client)
+    assert await model.generate_content("что на фото?", [uploaded]) == f"ответ {MODELS[0].id}"
+    parts = fake_gemini.requests[-1]["contents"][-1]["parts"]
+    assert parts[0] == {"text": "что на фото?"}
+    assert file_uri(parts[1]) == uploaded.uri
+    assert "inlineData" not in parts[1] and "inline_data" not in parts[1]
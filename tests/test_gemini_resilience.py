@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+from gemini_resilience import CircuitBreaker, ResilientModel
+
+
+class HangingModel:
+    """Модель, которая никогда не отвечает: запрос висит, пока его не отменят."""
+
+    model_id = "m"
+
+    async def generate_content(self, query, files=None, timeout=None, cache=None):
+        await asyncio.Event().wait()
+
+    async def generate_content_stream(self, query, files=None, timeout=None, cache=None):
+        yield "первый чанк"
+        await asyncio.Event().wait()
+
+    def usage(self):
+        return {}
+
+
+def half_open_ready(model: ResilientModel):
+    model.breaker.state = CircuitBreaker.OPEN
+    model.breaker.opened_at = 0.0
+    model.breaker.reset_timeout = 0.0
+
+
+async def test_cancelled_probe_releases_breaker():
+    model = ResilientModel(HangingModel())
+    half_open_ready(model)
+    task = asyncio.create_task(model.generate_content("q"))
+    await asyncio.sleep(0)
+    assert model.breaker.state == CircuitBreaker.HALF_OPEN
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert model.breaker.state == CircuitBreaker.OPEN
+    assert model.breaker.allow()
+
+
+async def test_closed_probe_stream_releases_breaker():
+    model = ResilientModel(HangingModel())
+    half_open_ready(model)
+    stream = model.generate_content_stream("q")
+    assert await stream.__anext__() == "первый чанк"
+    assert model.breaker.state == CircuitBreaker.HALF_OPEN
+    await stream.aclose()
+    assert model.breaker.state == CircuitBreaker.OPEN
+    assert model.breaker.allow()
+
+
+def test_zero_retries_is_rejected():
+    with pytest.raises(ValueError):
+        ResilientModel(HangingModel(), retries=0)
@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+import aiofiles.os
+import pytest
+from sqlalchemy import update
+
+import image_store
+from db import UserImage
+from image_cache import ImageCache
+from image_store import ImageStore
+
+JPEG = b"\xff\xd8\xff" + b"jpeg" * 50000
+
+
+async def chunked(data: bytes, size: int = 65536, fail_after: int = None):
+    for index, start in enumerate(range(0, len(data), size)):
+        if fail_after is not None and index == fail_after:
+            raise ConnectionError("download interrupted")
+        await asyncio.sleep(0)
+        yield data[start:start + size]
+
+
+@pytest.fixture
+async def store(db, tmp_path):
+    store = ImageStore(db, str(tmp_path / "photos"), ImageCache())
+    yield store
+    await store.stop()
+
+
+async def test_streamed_image_is_stored_by_content_hash(store):
+    image = await store.save_stream(1, "photo-1", chunked(JPEG))
+    assert image.data == JPEG and image.mime_type == "image/jpeg"
+    path = store.path(hashlib.sha256(JPEG).hexdigest(), "image/jpeg")
+    with open(path, "rb") as f:
+        assert f.read() == JPEG
+    assert os.listdir(store.partial_dir) == []
+    assert (await store.load(1, "photo-1")).data == JPEG
+
+
+async def test_same_image_is_stored_once(store):
+    await store.save_stream(1, "photo-1", chunked(JPEG))
+    await store.save(2, "photo-2", JPEG)
+    assert store.deduplicated == 1
+    assert os.listdir(store.partial_dir) == []
+
+
+async def test_interrupted_download_leaves_no_files(store):
+    with pytest.raises(ConnectionError):
+        await store.save_stream(1, "photo-1", chunked(JPEG, fail_after=2))
+    assert os.listdir(store.partial_dir) == []
+    assert await store.load(1, "photo-1") is None
+
+
+async def test_garbage_collection_pages_through_users_and_history(store, db, monkeypatch):
+    monkeypatch.setattr(image_store, "GC_BATCH", 1)
+    for user_id in (1, 2, 3):
+        await store.save(user_id, f"kept-{user_id}", JPEG + bytes([user_id]))
+        await store.save(user_id, f"orphan-{user_id}", JPEG + bytes([user_id + 10]))
+        # Ссылка не в первой записи истории - сборщику нужно дочитать следующие страницы
+        await db.add_record(user_id, "q", "a", image_ids=["other"])
+        await db.add_record(user_id, "q", "a")
+        await db.add_record(user_id, "q", "a", image_ids=[f"kept-{user_id}"])
+    await store.save(3, "fresh", JPEG + b"fresh")
+    if db.writer:
+        await db.writer.flush()
+    old = datetime.utcnow() - timedelta(hours=2)
+    async with db.Session() as session:
+        await session.execute(update(UserImage).where(UserImage.file_id != "fresh").values(created_at=old))
+        await session.commit()
+
+    await store.collect_garbage()
+    for user_id in (1, 2, 3):
+        assert await store.load(user_id, f"kept-{user_id}") is not None
+        assert await store.load(user_id, f"orphan-{user_id}") is None
+    assert await store.load(3, "fresh") is not None
+
+
+async def test_concurrent_save_keeps_file_that_is_being_deleted(store, monkeypatch):
+    remove = aiofiles.os.remove
+
+    async def slow_remove(path):
+        await asyncio.sleep(0.05)
+        await remove(path)
+
+    async def save_later():
+        await asyncio.sleep(0.02)  # удаление уже закоммичено в базе, но файл еще на диске
+        await store.save(2, "photo-2", JPEG)
+
+    monkeypatch.setattr(aiofiles.os, "remove", slow_remove)
+    await store.save(1, "photo-1", JPEG)
+    await asyncio.gather(store.clear_user(1), save_later())
+    assert os.path.exists(store.path(hashlib.sha256(JPEG).hexdigest(), "image/jpeg"))
+    store.cache.discard("photo-2")
+    assert (await store.load(2, "photo-2")).data == JPEG
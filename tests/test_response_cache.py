@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from response_cache import ResponseCache, response_key
+
+
+def test_key_ignores_case_and_spacing():
+    assert response_key("m", "i", "Привет,  МИР ") == response_key("m", "i", "привет, мир")
+    assert response_key("m", "i", "q") != response_key("m", "other", "q")
+    assert response_key("m", "i", "q", ["a"]) != response_key("m", "i", "q", ["b"])
+
+
+async def test_entries_expire_after_ttl():
+    cache = ResponseCache(ttl=0.05, enabled=True)
+    cache.put("k", "ответ")
+    assert cache.get("k") == "ответ"
+    await asyncio.sleep(0.1)
+    assert cache.get("k") is None
+    assert (cache.expired, cache.size, len(cache.items)) == (1, 0, 0)
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2, enabled=True)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+    assert list(cache.items) == ["a", "c"]
+    assert cache.evictions == 1
+
+
+def test_byte_limit():
+    cache = ResponseCache(max_bytes=10, enabled=True)
+    cache.put("huge", "x" * 11)
+    assert cache.get("huge") is None
+    cache.put("a", "12345")
+    cache.put("b", "ы" * 3)  # 6 байт в UTF-8
+    assert list(cache.items) == ["b"] and cache.size == 6
+
+
+async def test_concurrent_requests_share_one_generation():
+    cache = ResponseCache(enabled=True)
+    calls = 0
+
+    async def generate():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "ответ"
+
+    results = await asyncio.gather(*(cache.get_or_generate("k", generate) for _ in range(5)))
+    assert results == ["ответ"] * 5
+    assert await cache.get_or_generate("k", generate) == "ответ"
+    assert calls == 1
+    assert (cache.misses, cache.coalesced, cache.hits) == (1, 4, 1)
+
+
+async def test_waiters_generate_themselves_when_first_request_is_cancelled():
+    cache = ResponseCache(enabled=True)
+    calls = 0
+
+    async def generate():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return f"ответ {calls}"
+
+    first = asyncio.create_task(cache.get_or_generate("k", generate))
+    await asyncio.sleep(0)
+    waiters = [asyncio.create_task(cache.get_or_generate("k", generate)) for _ in range(3)]
+    await asyncio.sleep(0)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    assert await asyncio.gather(*waiters) == ["ответ 2"] * 3
+    assert calls == 2 and not cache._pending
+
+
+async def test_error_reaches_waiters_and_is_not_cached():
+    cache = ResponseCache(enabled=True)
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("модель недоступна")
+
+    results = await asyncio.gather(*(cache.get_or_generate("k", fail) for _ in range(3)), return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert cache.get("k") is None and not cache._pending
+
+    async def empty():
+        return ""
+
+    assert await cache.get_or_generate("k", empty, cacheable=bool) == ""
+    assert cache.get("k") is None
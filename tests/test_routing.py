@@ -0,0 +1,22 @@
+from routing import parse_workers, rendezvous_owner, update_user_id
+
+
+def test_update_user_id():
+    assert update_user_id({"update_id": 1, "message": {"from": {"id": 42}, "text": "hi"}}) == 42
+    assert update_user_id({"update_id": 1, "callback_query": {"from": {"id": 7}}}) == 7
+    assert update_user_id({"update_id": 1}) is None
+
+
+def test_update_user_id_ignores_non_objects():
+    for body in ([], [{"message": {"from": {"id": 1}}}], 5, "text", None):
+        assert update_user_id(body) is None
+
+
+def test_rendezvous_owner_moves_only_removed_workers_users():
+    workers = parse_workers("w1=http://a:8080, w2=http://b:8080/ ,w3=http://c:8080")
+    assert workers["w2"] == "http://b:8080"
+    before = {user_id: rendezvous_owner(user_id, workers) for user_id in range(1000)}
+    del workers["w3"]
+    for user_id, owner in before.items():
+        if owner != "w3":
+            assert rendezvous_owner(user_id, workers) == owner
@@ -0,0 +1,55 @@
+import asyncio
+
+from sessions import SessionStore
+
+
+class FakeDatabase:
+    """История в памяти; get_history можно придержать, чтобы изменить сессию посреди загрузки."""
+
+    def __init__(self):
+        self.history = {}
+        self.reads = 0
+        self.hold = None
+
+    async def get_history(self, user_id, limit=None):
+        self.reads += 1
+        turns = list(self.history.get(user_id, []))
+        if self.hold:
+            await self.hold.wait()
+        return turns[-limit:] if limit else turns
+
+    async def get_current_model(self, user_id):
+        return "model"
+
+    async def get_summary(self, user_id):
+        return None
+
+    async def add_record(self, user_id, query, response, image_ids=None, model_type=None, timestamp=None):
+        self.history.setdefault(user_id, []).append(
+            {"query": query, "response": response, "image_ids": None, "model_type": model_type, "timestamp": timestamp})
+
+
+async def test_bookkeeping_does_not_outlive_sessions():
+    store = SessionStore(FakeDatabase(), max_users=10)
+    for user_id in range(100):
+        await store.get_history(user_id, limit=5)
+        await store.add_record(user_id, "q", "a")
+        store.invalidate(user_id)
+    assert len(store.sessions) <= 10
+    assert store._locks == {} and store._versions == {} and store._loading == {}
+
+
+async def test_change_during_load_is_not_cached():
+    db = FakeDatabase()
+    store = SessionStore(db)
+    db.hold = asyncio.Event()
+    load = asyncio.create_task(store.get_history(1, limit=5))
+    await asyncio.sleep(0)
+    await store.add_record(1, "q", "a")
+    db.hold.set()
+    assert await load == []
+    db.hold = None
+
+    assert len(await store.get_history(1, limit=5)) == 1
+    assert db.reads == 2
+    assert store._versions == {}
@@ -0,0 +1,72 @@
+import asyncio
+
+import fakeredis
+import pytest
+from redis import asyncio as redis
+
+from state import MemoryBackend, RedisBackend, StateBackend, create_backend
+
+
+@pytest.fixture(params=["memory", "redis"])
+async def backend(request, monkeypatch):
+    """Хранилище в памяти процесса или RedisBackend поверх fakeredis вместо настоящего сервера."""
+    if request.param == "memory":
+        backend = MemoryBackend()
+    else:
+        monkeypatch.setattr(redis, "from_url", fakeredis.FakeAsyncRedis.from_url)
+        backend = create_backend("redis://localhost:6379/0")
+    yield backend
+    await backend.close()
+
+
+async def test_get_set_delete(backend):
+    assert await backend.get("missing") is None
+    await backend.set("a", b"1")
+    await backend.set("b", b"2")
+    assert await backend.get("a") == b"1"
+    await backend.delete("a", "b", "missing")
+    assert await backend.get("a") is None
+    assert await backend.get("b") is None
+    await backend.delete()
+
+
+async def test_ttl_expires(backend):
+    await backend.set("short", b"x", ttl=0.05)
+    await backend.set("long", b"y")
+    await backend.append("list", b"z", ttl=0.05)
+    await asyncio.sleep(0.1)
+    assert await backend.get("short") is None
+    assert await backend.get("long") == b"y"
+    assert await backend.pop_all("list") == []
+
+
+async def test_incr(backend):
+    assert await backend.incr("version") == 1
+    assert await backend.incr("version") == 2
+    await backend.delete("version")
+    assert await backend.incr("version") == 1
+
+
+async def test_append_and_pop_all(backend):
+    assert await backend.pop_all("buffer") == []
+    assert await backend.append("buffer", b"first") == 1
+    assert await backend.append("buffer", b"second", ttl=60) == 2
+    assert await backend.pop_all("buffer") == [b"first", b"second"]
+    assert await backend.pop_all("buffer") == []
+
+
+async def test_redis_keys_are_prefixed(monkeypatch):
+    monkeypatch.setattr(redis, "from_url", fakeredis.FakeAsyncRedis.from_url)
+    backend = create_backend("redis://localhost:6379/0")
+    assert isinstance(backend, RedisBackend) and backend.shared
+    await backend.set("key", b"value")
+    assert await backend.client.get("bot:key") == b"value"
+    assert await backend.client.get("key") is None
+    await backend.close()
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        StateBackend()
+    with pytest.raises(ValueError):
+        create_backend("postgres://localhost")
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import telegram_send
+from telegram_send import MessageSender, SendLimiter, TokenBucket
+
+CHAT = 42
+METHOD = SendMessage(chat_id=CHAT, text="")
+
+
+class FakeBot:
+    """Записывает отправленные сообщения; failures - ошибки, которые вернут очередные вызовы send_message."""
+
+    def __init__(self, failures=(), reject_html=lambda text: False):
+        self.failures = list(failures)
+        self.reject_html = reject_html
+        self.messages = []  # (время, текст, parse_mode)
+
+    async def send_message(self, chat_id, text, parse_mode=None, disable_web_page_preview=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        if parse_mode == "HTML" and self.reject_html(text):
+            raise TelegramBadRequest(METHOD, "Bad Request: can't parse entities: unclosed tag")
+        self.messages.append((time.monotonic(), text, parse_mode))
+        return len(self.messages)
+
+
+def fast_limiter() -> SendLimiter:
+    return SendLimiter(global_rate=1000, chat_rate=1000, group_rate=1000, chat_burst=1000)
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(telegram_send.random, "uniform", lambda low, high: low)
+    monkeypatch.setattr(telegram_send, "SEND_BACKOFF_BASE", 0.01)
+
+
+def test_zero_retries_is_rejected():
+    with pytest.raises(ValueError):
+        MessageSender(FakeBot(), fast_limiter(), retries=0)
+
+
+async def test_flood_wait_blocks_the_chat_and_retries():
+    bot = FakeBot([TelegramRetryAfter(METHOD, "Flood control exceeded", retry_after=1)])
+    sender = MessageSender(bot, fast_limiter())
+    started = time.monotonic()
+    result = await sender.send_html(CHAT, "ответ")
+    assert result.ok and result.delivered == [0]
+    assert bot.messages[0][0] - started >= 1
+    assert (sender.flood_waits, sender.sent) == (1, 1)
+
+
+async def test_flood_wait_on_last_attempt_fails_the_part():
+    bot = FakeBot([TelegramRetryAfter(METHOD, "Flood control exceeded", retry_after=0)] * 2)
+    sender = MessageSender(bot, fast_limiter(), retries=2)
+    result = await sender.send_html(CHAT, "ответ")
+    assert result.failed == [0] and not bot.messages
+
+
+async def test_network_errors_are_retried():
+    bot = FakeBot([TelegramNetworkError(METHOD, "connection reset")] * 2)
+    sender = MessageSender(bot, fast_limiter(), retries=3)
+    assert (await sender.send_html(CHAT, "ответ")).delivered == [0]
+    assert sender.retried == 2
+
+
+async def test_only_rejected_part_falls_back_to_plain_text():
+    text = " ".join(["<b>первая</b>"] * 400 + ["<i>сломанная</i>"] * 400 + ["<b>третья</b>"] * 400)
+    bot = FakeBot(reject_html=lambda chunk: "сломанная" in chunk and "первая" not in chunk and "третья" not in chunk)
+    sender = MessageSender(bot, fast_limiter())
+    result = await sender.send_html(CHAT, text)
+    assert len(result.delivered) == len(bot.messages) > 2
+    assert result.plain and sender.plain_fallbacks == len(result.plain)
+    for index, (_, sent, parse_mode) in enumerate(bot.messages):
+        if index in result.plain:
+            assert parse_mode is None and "<" not in sent and "сломанная" in sent
+        else:
+            assert parse_mode == "HTML"
+
+
+async def test_blocked_bot_drops_remaining_parts():
+    bot = FakeBot([TelegramForbiddenError(METHOD, "Forbidden: bot was blocked by the user")])
+    sender = MessageSender(bot, fast_limiter())
+    result = await sender.send_html(CHAT, "слово " * 2000)
+    assert result.delivered == [] and result.failed == [0, 1, 2]
+    assert not bot.messages
+
+
+async def test_token_bucket_limits_rate_after_burst():
+    bucket = TokenBucket(rate=20, capacity=2)
+    started = time.monotonic()
+    for _ in range(2):
+        await bucket.acquire()
+    assert time.monotonic() - started < 0.05
+    for _ in range(4):
+        await bucket.acquire()
+    assert time.monotonic() - started >= 0.15
+
+
+async def test_limiter_keeps_chats_separate():
+    limiter = SendLimiter(global_rate=1000, chat_rate=1, group_rate=0.5, chat_burst=1)
+    assert limiter._chat_bucket(-100).rate == 0.5 and limiter._chat_bucket(CHAT).rate == 1
+    limiter.block(CHAT, 10)
+    started = time.monotonic()
+    await limiter.acquire(CHAT + 1)
+    await limiter.acquire(-100)
+    assert time.monotonic() - started < 0.05
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(limiter.acquire(CHAT), 0.1)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Что делать с новым сообщением, пока предыдущее еще обрабатывается:
+# queue - ждет своей очереди, coalesce - все ожидающие объединяются в один запрос, cancel - текущая генерация прерывается
+WORK_POLICY = os.getenv("WORK_POLICY", "queue")
+WORK_MAX_CONCURRENCY = int(os.getenv("WORK_MAX_CONCURRENCY", "16"))
+WORK_MAX_PENDING = int(os.getenv("WORK_MAX_PENDING", "5"))
+
+POLICIES = ("queue", "coalesce", "cancel")
+
+logger = logging.getLogger("bot.work_queue")
+
+
+class UserWorkQueue:
+    """Последовательная обработка запросов каждого пользователя с общим лимитом параллельности.
+
+    У пользователя одновременно выполняется не больше одного задания. Пользователи с ожидающими заданиями
+    стоят в общей очереди по кругу: после своего задания пользователь встает в конец, поэтому один
+    активный пользователь не занимает все слоты.
+    """
+
+    def __init__(self, handler: Callable[[Any, List[Any]], Awaitable[None]], policy: str = WORK_POLICY,
+                 max_concurrency: int = WORK_MAX_CONCURRENCY, max_pending: int = WORK_MAX_PENDING):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown work queue policy {policy!r}, expected one of {POLICIES}")
+        self.handler = handler
+        self.policy = policy
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.pending: Dict[Any, Deque] = {}
+        self.running: Dict[Any, asyncio.Task] = {}
+        self.ready: Deque = deque()  # пользователи с заданиями, ожидающие свободного слота
+        self._ready_set = set()
+        # Метрики
+        self.submitted = 0
+        self.completed = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.dropped = 0
+        self.peak_ready = 0
+
+    def submit(self, user_id, job):
+        """Ставит задание в очередь пользователя и сразу возвращает управление."""
+        self.submitted += 1
+        queue = self.pending.setdefault(user_id, deque())
+        if self.policy == "cancel":
+            # Актуален только последний запрос: ожидающие выбрасываются, текущий прерывается
+            self.dropped += len(queue)
+            queue.clear()
+            task = self.running.get(user_id)
+            if task and not task.done():
+                self.cancelled += 1
+                task.cancel()
+                logger.info("User %s: in-flight request cancelled by a newer one", user_id)
+        elif len(queue) >= self.max_pending:
+            queue.popleft()
+            self.dropped += 1
+            logger.warning(f"User {user_id}: pending queue is full, oldest request dropped")
+        queue.append(job)
+
+        if user_id not in self.running and user_id not in self._ready_set:
+            self.ready.append(user_id)
+            self._ready_set.add(user_id)
+            self.peak_ready = max(self.peak_ready, len(self.ready))
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.ready and len(self.running) < self.max_concurrency:
+            user_id = self.ready.popleft()
+            self._ready_set.discard(user_id)
+            queue = self.pending[user_id]
+            if self.policy == "coalesce":
+                jobs = list(queue)
+                queue.clear()
+                self.coalesced += len(jobs) - 1
+            else:
+                jobs = [queue.popleft()]
+            task = asyncio.create_task(self._run(user_id, jobs), name=f"work-{user_id}")
+            # Callback, а не finally: задача, отмененная до первого шага, свой код не выполняет вовсе
+            task.add_done_callback(lambda _, user_id=user_id: self._finish(user_id))
+            self.running[user_id] = task
+
+    async def _run(self, user_id, jobs: List):
+        try:
+            await self.handler(user_id, jobs)
+        except asyncio.CancelledError:
+            logger.debug("User %s: request cancelled", user_id)
+        except Exception as e:
+            logger.exception(f"User {user_id}: error processing request: {e}")
+
+    def _finish(self, user_id):
+        self.completed += 1
+        self.running.pop(user_id, None)
+        if self.pending.get(user_id):
+            self.ready.append(user_id)  # в конец очереди - сначала обслуживаются остальные
+            self._ready_set.add(user_id)
+        else:
+            self.pending.pop(user_id, None)
+        self._dispatch()
+
+    async def drain(self, timeout: float = None):
+        """Ждет, пока выполнятся все принятые задания."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while self.running:
+            remaining = deadline - loop.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+            await asyncio.wait(list(self.running.values()), timeout=remaining)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "running": len(self.running),
+            "ready": len(self.ready),
+            "peak_ready": self.peak_ready,
+            "pending": sum(len(queue) for queue in self.pending.values()),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "dropped": self.dropped,
+        }